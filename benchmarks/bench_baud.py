@@ -0,0 +1,147 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# Measure the throughput of the serial link at each baud rate s2m can
+# switch to: poll round trips, whole frame commands and streamed sensor
+# samples per second. Rates that s2mb.py or the serial port cannot use
+# are reported as failed.
+#
+# The micro:bit simulator limits its link speed to the baud rate it is
+# set to, so it can be used to compare the rates without a micro:bit:
+#
+#   python benchmarks/microbit_sim.py
+#   python benchmarks/bench_baud.py -p /dev/pts/3
+#
+# Usage: python benchmarks/bench_baud.py [-p port] [-n requests] [-s seconds]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from s2m.s2m_serial import find_micro_bits, list_candidate_ports, change_baud_rate, \
+    get_firmware_version, BAUD_RATES, BAUD_VERSION, DEFAULT_BAUD_RATE
+
+# seconds to wait for a sensor reply before giving up
+REPLY_TIMEOUT = 2
+
+# a whole frame with every pixel lit, followed by a sensor request
+# so that the next frame is only sent once this one has been handled
+FRAME_COMMAND = b'f,' + b'9' * 25 + b'\ng\n'
+
+
+def wait_for_sensors(micro_bit_serial):
+    """
+    Read lines until a sensor reply arrives.
+
+    :return: True if a reply arrived before the timeout
+    """
+    deadline = time.time() + REPLY_TIMEOUT
+    while time.time() < deadline:
+        line = micro_bit_serial.readline()
+        if line.count(b',') in (10, 11):
+            return True
+    return False
+
+
+def measure_requests(micro_bit_serial, request, count):
+    """
+    :param request: bytes to send, ending with a sensor request
+    :return: requests per second, or None if the micro:bit stopped answering
+    """
+    start = time.time()
+    for _ in range(count):
+        micro_bit_serial.write(request)
+        if not wait_for_sensors(micro_bit_serial):
+            return None
+    return count / (time.time() - start)
+
+
+def measure_streaming(micro_bit_serial, seconds):
+    """
+    Have s2mb.py stream as fast as it can.
+
+    :return: (sensor samples per second, bytes per second)
+    """
+    micro_bit_serial.write(b'r,1\n')
+    samples = 0
+    received = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        line = micro_bit_serial.readline()
+        received += len(line)
+        if line.count(b',') in (10, 11):
+            samples += 1
+    elapsed = time.time() - start
+    micro_bit_serial.write(b'r,0\n')
+    # let the last samples arrive and throw them away
+    time.sleep(.2)
+    micro_bit_serial.flushInput()
+    return samples / elapsed, received / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="count", default="200",
+                        help="number of polls and frames sent at each rate")
+    parser.add_argument("-p", dest="com_port", default="None",
+                        help="micro:bit COM port - e.g. /dev/ttyACMO or COM3")
+    parser.add_argument("-s", dest="seconds", default="2",
+                        help="seconds of streaming measured at each rate")
+    args = parser.parse_args()
+
+    if args.com_port == 'None':
+        ports = list_candidate_ports()
+    else:
+        ports = [args.com_port]
+    found = find_micro_bits(ports)
+    if not found:
+        print('Could not find a micro:bit running s2mb.py')
+        sys.exit(0)
+    micro_bit_serial, port, sensor_line, v_string = found[0]
+    print('{} on {}\n'.format(v_string, port))
+    if get_firmware_version(v_string) < BAUD_VERSION:
+        print('This s2mb.py cannot change its baud rate')
+        sys.exit(0)
+
+    count = int(args.count)
+    seconds = float(args.seconds)
+    print('{:>10}{:>12}{:>12}{:>14}{:>14}'.format('baud', 'polls/s', 'frames/s',
+                                                  'streamed/s', 'stream KB/s'))
+    for rate in (DEFAULT_BAUD_RATE,) + tuple(sorted(BAUD_RATES)):
+        if rate != DEFAULT_BAUD_RATE and not change_baud_rate(micro_bit_serial, rate):
+            print('{:>10}{:>12}'.format(rate, 'failed'))
+            continue
+        polls = measure_requests(micro_bit_serial, b'g\n', count)
+        frames = measure_requests(micro_bit_serial, FRAME_COMMAND, count)
+        samples, received = measure_streaming(micro_bit_serial, seconds)
+        print('{:>10}{:>12}{:>12}{:>14.0f}{:>14.1f}'.format(
+            rate,
+            'no reply' if polls is None else '{:.0f}'.format(polls),
+            'no reply' if frames is None else '{:.0f}'.format(frames),
+            samples, received / 1024))
+        if rate != DEFAULT_BAUD_RATE:
+            change_baud_rate(micro_bit_serial, DEFAULT_BAUD_RATE)
+
+    micro_bit_serial.write(b'c\n')
+    micro_bit_serial.close()
+
+
+if __name__ == '__main__':
+    main()
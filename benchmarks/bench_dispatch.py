@@ -0,0 +1,183 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# Measure the per request cost of GetHandler.process_command, comparing
+# the dispatch table with the if/elif chain it replaced. Both record the
+# same request metrics.
+#
+# The dispatch table is there so that commands can be added or replaced
+# with GetHandler.register_command, not to make dispatch faster. This
+# checks that it does not cost more per request than the chain did.
+#
+# Usage: python benchmarks/bench_dispatch.py
+
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from s2m.s2m_http_server import GetHandler
+from s2m.s2m_metrics import Metrics, timer
+
+# the command mix sent by a typical Scratch project
+REQUESTS = ['/display_image/HAPPY',
+            '/scroll/Hello',
+            '/write_pixel/1/2/9',
+            '/display_clear',
+            '/digital_write/0/1',
+            '/analog_write/1/512',
+            '/reset_all',
+            '/unknown_command']
+
+ITERATIONS = 20000
+
+
+class NullS2M:
+    """
+    Stands in for the S2M class so that only the dispatch cost is measured.
+    """
+
+    metrics = Metrics()
+
+    def handle_display_image(self, data, device=0):
+        pass
+
+    def handle_scroll(self, data, device=0):
+        pass
+
+    def handle_write_pixel(self, data, device=0):
+        pass
+
+    def handle_display_frame(self, data, device=0):
+        pass
+
+    def handle_display_clear(self, device=0):
+        pass
+
+    def handle_digital_write(self, data, device=0):
+        pass
+
+    def handle_analog_write(self, data, device=0):
+        pass
+
+    def handle_reset_all(self, device=0):
+        pass
+
+    def handle_sensor_mask(self, data, device=0):
+        pass
+
+    def handle_metrics(self, device=0):
+        pass
+
+
+def legacy_process_command(self, cmd_list):
+    """
+    The if/elif chain used by process_command before the dispatch table,
+    with the same metrics calls as GetHandler.dispatch, so that the two
+    only differ in the way the command is looked up.
+    """
+    cmd = cmd_list[0]
+    start = timer()
+    if cmd == 'display_image':
+        resp = self.s2m.handle_display_image(cmd_list[1])
+    elif cmd == 'scroll':
+        resp = self.s2m.handle_scroll(cmd_list[1])
+    elif cmd == 'write_pixel':
+        params = cmd_list[1:]
+        cmd_params = ",".join(params)
+        resp = self.s2m.handle_write_pixel(cmd_params)
+    elif cmd == 'display_clear':
+        resp = self.s2m.handle_display_clear()
+    elif cmd == 'digital_write':
+        params = cmd_list[1:]
+        cmd_params = ",".join(params)
+        resp = self.s2m.handle_digital_write(cmd_params)
+    elif cmd == 'analog_write':
+        params = cmd_list[1:]
+        cmd_params = ",".join(params)
+        resp = self.s2m.handle_analog_write(cmd_params)
+    elif cmd == 'reset_all':
+        resp = self.s2m.handle_reset_all()
+    else:
+        self.s2m.metrics.count('unknown_commands')
+        self.send_resp('OK')
+        return
+    self.s2m.metrics.count('commands')
+    self.s2m.metrics.record('dispatch', timer() - start)
+    self.send_resp(resp)
+
+
+def make_handler():
+    """
+    Create a GetHandler that is not attached to a socket.
+    Responses are written to an in memory buffer.
+    """
+    GetHandler.set_items(NullS2M())
+    handler = GetHandler.__new__(GetHandler)
+    handler.wfile = io.BytesIO()
+    handler.close_connection = False
+    return handler
+
+
+def run(dispatch, handler, requests):
+    """
+    Dispatch each request once. The path is split the same way do_GET
+    does it, so command names are not interned strings.
+    """
+    for path in requests:
+        dispatch(handler, str.split(path[1:], '/'))
+    # keep the buffer from growing without bound
+    handler.wfile.seek(0)
+    handler.wfile.truncate()
+
+
+def measure(dispatch, handler, requests):
+    """
+    :return: best time per request in microseconds
+    """
+    best = min(timeit.repeat(lambda: run(dispatch, handler, requests),
+                             number=ITERATIONS, repeat=5))
+    return best / (ITERATIONS * len(requests)) * 1e6
+
+
+def main():
+    handler = make_handler()
+    chain = legacy_process_command
+    table = GetHandler.process_command
+
+    print('{:<24}{:>16}{:>16}'.format('us per request', 'if/elif chain', 'dispatch table'))
+    print('{:<24}{:16.3f}{:16.3f}'.format('mix with send_resp',
+                                          measure(chain, handler, REQUESTS),
+                                          measure(table, handler, REQUESTS)))
+
+    # replace the response writer to measure the dispatch alone
+    handler.send_resp = lambda response, json_response=False: None
+    print('{:<24}{:16.3f}{:16.3f}'.format('mix, dispatch only',
+                                          measure(chain, handler, REQUESTS),
+                                          measure(table, handler, REQUESTS)))
+
+    # each command on its own
+    for path in REQUESTS:
+        print('{:<24}{:16.3f}{:16.3f}'.format(path.split('/')[1],
+                                              measure(chain, handler, [path]),
+                                              measure(table, handler, [path])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# Measure how many commands per second s2mb.py can handle.
+#
+# Commands are sent one per line, the way s2m sends them to firmware that
+# does not support batching. A 'g' request follows every WINDOW commands
+# and the next window is only sent once its sensor reply has arrived, so
+# the micro:bit's small receive buffer is never overrun.
+#
+# Usage: python benchmarks/bench_firmware.py [-p port] [-n commands]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from s2m.s2m_serial import find_micro_bits, list_candidate_ports
+
+# commands sent between sensor requests
+WINDOW = 4
+
+# seconds to wait for a sensor reply before giving up
+REPLY_TIMEOUT = 2
+
+COMMANDS = [('display_image', 'd,HAPPY'),
+            ('write_pixel', 'p,1,2,9'),
+            ('display_clear', 'c'),
+            ('digital_write', 't,0,1'),
+            ('analog_write', 'a,1,512')]
+
+
+def wait_for_sensors(micro_bit_serial):
+    """
+    Read lines until a sensor reply arrives.
+
+    :return: True if a reply arrived before the timeout
+    """
+    deadline = time.time() + REPLY_TIMEOUT
+    while time.time() < deadline:
+        line = micro_bit_serial.readline()
+        if line.count(b',') in (10, 11):
+            return True
+    return False
+
+
+def measure_commands(micro_bit_serial, command, count):
+    """
+    :return: commands per second, or None if the micro:bit stopped answering
+    """
+    window = ((command + '\n') * WINDOW + 'g\n').encode()
+    start = time.time()
+    for _ in range(count // WINDOW):
+        micro_bit_serial.write(window)
+        if not wait_for_sensors(micro_bit_serial):
+            return None
+    return count // WINDOW * WINDOW / (time.time() - start)
+
+
+def measure_polls(micro_bit_serial, count):
+    """
+    :return: sensor requests per second, or None if the micro:bit stopped answering
+    """
+    start = time.time()
+    for _ in range(count):
+        micro_bit_serial.write(b'g\n')
+        if not wait_for_sensors(micro_bit_serial):
+            return None
+    return count / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", dest="com_port", default="None",
+                        help="micro:bit COM port - e.g. /dev/ttyACMO or COM3")
+    parser.add_argument("-n", dest="count", default="500",
+                        help="number of commands sent for each measurement")
+    args = parser.parse_args()
+
+    if args.com_port == 'None':
+        ports = list_candidate_ports()
+    else:
+        ports = [args.com_port]
+    found = find_micro_bits(ports)
+    if not found:
+        print('Could not find a micro:bit running s2mb.py')
+        sys.exit(0)
+    micro_bit_serial, port, sensor_line, v_string = found[0]
+    print('{} on {}\n'.format(v_string, port))
+
+    count = int(args.count)
+    print('{:<24}{:>14}'.format('command', 'per second'))
+    for name, command in COMMANDS:
+        rate = measure_commands(micro_bit_serial, command, count)
+        print('{:<24}{:>14}'.format(name, 'no reply' if rate is None else '{:.0f}'.format(rate)))
+    rate = measure_polls(micro_bit_serial, count)
+    print('{:<24}{:>14}'.format('poll round trip', 'no reply' if rate is None else '{:.0f}'.format(rate)))
+
+    micro_bit_serial.write(b'c\n')
+    micro_bit_serial.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# End to end benchmark of the Scratch -> s2m -> micro:bit pipeline.
+#
+# s2m is started as a separate process and driven over HTTP, the same way
+# Scratch drives it. Unless a port is given, it is connected to the
+# micro:bit simulator. The benchmark measures:
+#
+#   - poll latency percentiles and polls per second
+#   - requests per second and latency percentiles for each command type,
+#     along with the number of commands that never reached the micro:bit
+#     because the output shadow or the command writer dropped them
+#   - CPU used by the s2m process during each measurement
+#
+# The results are written as JSON, so that runs can be compared.
+#
+# Usage: python benchmarks/bench_pipeline.py [-p port] [-a "s2m options"]
+#                                            [-n polls] [-m commands]
+#                                            [--latency ms] [-o file]
+
+import argparse
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import psutil
+
+try:
+    # for python2
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from httplib import HTTPConnection
+except ImportError:
+    # for python3
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from http.client import HTTPConnection
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCHMARK_DIR, '..')
+
+# s2m always listens here
+HTTP_PORT = 50209
+
+# seconds to wait for s2m to start its HTTP server
+STARTUP_TIMEOUT = 15
+
+# the requests sent for each command type, in turn. The values alternate,
+# as a repeated request is dropped by the output shadow and never reaches
+# the micro:bit.
+COMMANDS = [('display_image', ['/display_image/HAPPY', '/display_image/SAD']),
+            ('scroll', ['/scroll/Hello', '/scroll/World']),
+            ('write_pixel', ['/write_pixel/1/2/9', '/write_pixel/1/2/0']),
+            ('digital_write', ['/digital_write/0/1', '/digital_write/0/0']),
+            ('analog_write', ['/analog_write/1/512', '/analog_write/1/256'])]
+
+
+def percentile(sorted_values, fraction):
+    """
+    :param sorted_values: values in ascending order
+    :param fraction: e.g. .95 for the 95th percentile
+    :return: the nearest rank percentile
+    """
+    index = int(round(fraction * len(sorted_values) + .5)) - 1
+    return sorted_values[max(0, min(index, len(sorted_values) - 1))]
+
+
+def summarize(latencies, elapsed):
+    """
+    :param latencies: request latencies in seconds
+    :param elapsed: wall clock time for all of the requests
+    :return: statistics in milliseconds
+    """
+    ordered = sorted(latencies)
+    return {'requests': len(ordered),
+            'per_second': round(len(ordered) / elapsed, 1),
+            'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+            'p50_ms': round(percentile(ordered, .50) * 1000, 3),
+            'p95_ms': round(percentile(ordered, .95) * 1000, 3),
+            'p99_ms': round(percentile(ordered, .99) * 1000, 3),
+            'max_ms': round(ordered[-1] * 1000, 3)}
+
+
+def measure(connection, process, paths, count):
+    """
+    Send count requests, one after the other, cycling through paths.
+
+    :param connection: HTTPConnection to s2m
+    :param process: psutil.Process for s2m
+    :param paths: request paths
+    :param count: number of requests
+    :return: (statistics, list of response bodies)
+    """
+    latencies = []
+    bodies = []
+    cpu_start = sum(process.cpu_times()[:2])
+    start = time.time()
+    for i in range(count):
+        sent = time.time()
+        connection.request('GET', paths[i % len(paths)])
+        bodies.append(connection.getresponse().read())
+        latencies.append(time.time() - sent)
+    elapsed = time.time() - start
+    cpu = sum(process.cpu_times()[:2]) - cpu_start
+
+    stats = summarize(latencies, elapsed)
+    stats['cpu_percent'] = round(cpu / elapsed * 100, 1)
+    stats['cpu_ms_per_request'] = round(cpu / count * 1000, 3)
+    return stats, bodies
+
+
+def get_dropped(connection):
+    """
+    :param connection: HTTPConnection to s2m
+    :return: (commands suppressed by the output shadows,
+              commands coalesced by the command writers) so far
+    """
+    connection.request('GET', '/metrics')
+    devices = json.loads(connection.getresponse().read().decode())['devices']
+    return (sum(device.get('suppressed', 0) for device in devices),
+            sum(device.get('coalesced', 0) for device in devices))
+
+
+def start_simulator(latency):
+    """
+    :param latency: simulated reply latency in ms
+    :return: (simulator process, port)
+    """
+    simulator = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, 'microbit_sim.py'),
+                                  '--latency', latency, '--seed', '1'],
+                                 stdout=subprocess.PIPE)
+    port = simulator.stdout.readline().decode().strip()
+    return simulator, port
+
+
+def start_s2m(port, s2m_args):
+    """
+    Start s2m and wait for its HTTP server.
+
+    :param port: micro:bit serial port
+    :param s2m_args: additional s2m command line options
+    :return: s2m process
+    """
+    s2m = subprocess.Popen([sys.executable, '-m', 's2m.s2m', '-c', 'no_client', '-p', port] + s2m_args,
+                           cwd=ROOT_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if s2m.poll() is not None:
+            break
+        try:
+            socket.create_connection(('localhost', HTTP_PORT), .5).close()
+            return s2m
+        except socket.error:
+            time.sleep(.1)
+    s2m.kill()
+    print(s2m.stdout.read().decode())
+    print('s2m did not start')
+    sys.exit(1)
+
+
+def stop(process):
+    """
+    Stop a process the way a user would, with Control-C.
+    """
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            psutil.Process(process.pid).wait(5)
+        except psutil.TimeoutExpired:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", dest="s2m_args", default="",
+                        help='s2m options to benchmark - e.g. "-e single -w binary"')
+    parser.add_argument("-m", dest="command_count", default="500",
+                        help="number of requests sent for each command type")
+    parser.add_argument("-n", dest="poll_count", default="1000",
+                        help="number of polls sent")
+    parser.add_argument("-o", dest="output", default="None",
+                        help="write the JSON results to this file instead of the console")
+    parser.add_argument("-p", dest="com_port", default="None",
+                        help="micro:bit COM port. The simulator is used if not specified.")
+    parser.add_argument("--latency", dest="latency", default="0",
+                        help="simulator reply latency in ms")
+    args = parser.parse_args()
+
+    simulator = None
+    if args.com_port == 'None':
+        simulator, port = start_simulator(args.latency)
+    else:
+        port = args.com_port
+
+    s2m = start_s2m(port, args.s2m_args.split())
+    results = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               's2m_args': args.s2m_args,
+               'device': 'simulator' if simulator else port,
+               'simulator_latency_ms': float(args.latency) if simulator else None}
+    try:
+        process = psutil.Process(s2m.pid)
+        connection = HTTPConnection('localhost', HTTP_PORT)
+
+        # let the first poll open the way, it is not part of the measurement
+        connection.request('GET', '/poll')
+        connection.getresponse().read()
+
+        stats, bodies = measure(connection, process, ['/poll'], int(args.poll_count))
+        stats['ignored'] = sum(1 for body in bodies if body.strip() == b'ok')
+        results['poll'] = stats
+
+        results['commands'] = {}
+        for name, paths in COMMANDS:
+            suppressed, coalesced = get_dropped(connection)
+            stats, bodies = measure(connection, process, paths, int(args.command_count))
+            after = get_dropped(connection)
+            stats['suppressed'] = after[0] - suppressed
+            stats['coalesced'] = after[1] - coalesced
+            results['commands'][name] = stats
+        connection.close()
+    finally:
+        stop(s2m)
+        if simulator:
+            stop(simulator)
+
+    report = json.dumps(results, indent=4, sort_keys=True)
+    if args.output == 'None':
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# Measure the cost of decoding scroll text, comparing S2M.scratch_fix
+# with the character at a time loop it replaced, and the cost of
+# transliterating the decoded text.
+#
+# Usage: python benchmarks/bench_scratch_fix.py
+
+import binascii
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+try:
+    # for python 3
+    from urllib.parse import quote
+except ImportError:
+    # for python 2
+    # noinspection PyUnresolvedReferences
+    from urllib import quote
+
+from s2m.s2m import S2M
+from s2m.s2m_text import transliterate
+
+# scroll text as Scratch sends it, percent encoded
+TEXTS = [('short ascii', quote('Hello World!')),
+         ('long ascii', quote('The quick brown fox jumps over the lazy dog! ' * 20)),
+         # konnichiha maikurobitto
+         ('long japanese', quote((u'\u3053\u3093\u306b\u3061\u306f'
+                                  u'\u30de\u30a4\u30af\u30ed\u30d3\u30c3\u30c8 ').encode('utf-8') * 20)),
+         # annyeonghaseyo
+         ('long korean', quote(u'\uc548\ub155\ud558\uc138\uc694 '.encode('utf-8') * 40)),
+         # shalom olam
+         ('long hebrew', quote(u'\u05e9\u05dc\u05d5\u05dd \u05e2\u05d5\u05dc\u05dd '.encode('utf-8') * 40))]
+
+ITERATIONS = 2000
+
+
+def legacy_scratch_fix(sst):
+    """
+    The decoder scratch_fix used to be: one escape at a time,
+    decoding each byte on its own.
+    """
+    result = ''
+    x = 0
+    while x < len(sst):
+        if sst[x] == '%':
+            sx = sst[x + 1] + sst[x + 2]
+            z = binascii.unhexlify(sx)
+            try:
+                result += z.decode("utf-8")
+            except UnicodeDecodeError:
+                return 'Scroll text must be in Roman characters'
+            x += 3
+        else:
+            result += sst[x]
+            x += 1
+    return result
+
+
+def main():
+    scratch_fix = S2M.__dict__['scratch_fix']
+
+    print('{:16}{:>8}{:>12}{:>12}{:>20}'.format('text', 'length', 'legacy us',
+                                                'decode us', 'transliterate us'))
+    for name, text in TEXTS:
+        legacy = min(timeit.repeat(lambda: legacy_scratch_fix(text), number=ITERATIONS, repeat=3))
+        decode = min(timeit.repeat(lambda: scratch_fix(None, text), number=ITERATIONS, repeat=3))
+        decoded = scratch_fix(None, text)
+        # the first call fills the character cache
+        transliterate(decoded)
+        convert = min(timeit.repeat(lambda: transliterate(decoded), number=ITERATIONS, repeat=3))
+        print('{:16}{:8}{:12.2f}{:12.2f}{:20.2f}'.format(name, len(text),
+                                                         legacy / ITERATIONS * 1e6,
+                                                         decode / ITERATIONS * 1e6,
+                                                         convert / ITERATIONS * 1e6))
+        if legacy_scratch_fix(text) != decoded:
+            print('{:16}legacy result: {}'.format('', legacy_scratch_fix(text)[:40]))
+        print('{:16}scrolled as: {}'.format('', transliterate(decoded)[:40]))
+
+
+if __name__ == '__main__':
+    main()
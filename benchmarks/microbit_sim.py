@@ -0,0 +1,377 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# A micro:bit simulator for benchmarking and testing s2m without a board.
+#
+# The simulator runs the real s2mb.py on a Linux pseudo-terminal, with a
+# stand-in for the MicroPython microbit module. Point s2m at the port it
+# prints:
+#
+#   python benchmarks/microbit_sim.py --latency 2
+#   s2m -c no_client -p /dev/pts/3
+#
+# Sensor values are generated: the board tilts slowly from side to side,
+# is shaken every few seconds, the buttons are pressed in turn and the
+# pins read a triangle wave. A seed makes the values repeatable.
+#
+# Usage: python benchmarks/microbit_sim.py [--firmware file] [--latency ms]
+#                                          [--baud rate] [--seed n]
+
+import argparse
+import math
+import os
+import pty
+import random
+import select
+import signal
+import sys
+import threading
+import time
+import tty
+import types
+
+FIRMWARE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        's2m', 'micro_bit_scripts', 's2mb.py')
+
+# the images s2mb.py can display
+IMAGE_NAMES = ['HAPPY', 'SAD', 'ANGRY', 'SMILE', 'CONFUSED', 'ASLEEP',
+               'SURPRISED', 'SILLY', 'FABULOUS', 'MEH', 'YES', 'NO',
+               'RABBIT', 'COW', 'ROLLERSKATE', 'HOUSE', 'SNAKE', 'HEART',
+               'DIAMOND', 'DIAMOND_SMALL', 'SQUARE', 'SQUARE_SMALL',
+               'TRIANGLE', 'TARGET', 'STICKFIGURE', 'ARROW_N', 'ARROW_NE',
+               'ARROW_E', 'ARROW_SE', 'ARROW_S', 'ARROW_SW', 'ARROW_W',
+               'ARROW_NW']
+
+# seconds between simulated shakes, and how long a shake lasts
+SHAKE_PERIOD = 5
+SHAKE_LENGTH = .3
+
+# seconds for one full side to side tilt
+TILT_PERIOD = 8
+
+# seconds between button presses, and how long a press lasts
+BUTTON_PERIOD = 4
+BUTTON_LENGTH = 1
+
+
+class Uart:
+    """
+    The micro:bit end of the serial link.
+    """
+
+    def __init__(self, master_fd, latency=0, baud=115200):
+        """
+        :param master_fd: pty master file descriptor
+        :param latency: seconds to wait before each reply is sent
+        :param baud: simulated link speed, 0 to send as fast as possible
+        """
+        self.master_fd = master_fd
+        self.latency = latency
+        self.byte_time = 10.0 / baud if baud else 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def any(self):
+        """
+        :return: True if data is waiting. When the link is idle this waits
+                 up to a millisecond, so the firmware loop does not spin.
+        """
+        ready, _, _ = select.select([self.master_fd], [], [], .001)
+        return bool(ready)
+
+    def read(self, nbytes=None):
+        """
+        :return: the data that is waiting, or None
+        """
+        ready, _, _ = select.select([self.master_fd], [], [], 0)
+        if not ready:
+            return None
+        data = os.read(self.master_fd, nbytes or 4096)
+        self.bytes_received += len(data)
+        return data
+
+    def write(self, data):
+        """
+        Send a reply to s2m, after the configured latency and at the
+        configured link speed.
+
+        :param data: bytes or string
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        if self.latency:
+            time.sleep(self.latency)
+        os.write(self.master_fd, bytes(data))
+        self.bytes_sent += len(data)
+        if self.byte_time:
+            time.sleep(len(data) * self.byte_time)
+
+    def init(self, baudrate=115200, **kwargs):
+        """
+        Change the simulated link speed, unless the link is unlimited.
+        """
+        if self.byte_time:
+            self.byte_time = 10.0 / baudrate
+
+    def print_line(self, *args, **kwargs):
+        """
+        Stands in for print on the board, which writes to the uart.
+        """
+        self.write(' '.join(str(arg) for arg in args) + '\r\n')
+
+
+class Sensors:
+    """
+    Generates sensor values from the time since the simulator started.
+    """
+
+    def __init__(self, seed=None):
+        """
+        :param seed: random seed for repeatable values
+        """
+        self.start_time = time.time()
+        self.random = random.Random(seed)
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def noise(self):
+        return self.random.randint(-20, 20)
+
+    def acceleration(self, axis):
+        """
+        :param axis: 0, 1 or 2 for x, y and z
+        :return: acceleration in milli-g
+        """
+        t = self.elapsed()
+        if t % SHAKE_PERIOD < SHAKE_LENGTH:
+            return self.random.randint(-2000, 2000)
+        angle = 2 * math.pi * t / TILT_PERIOD
+        if axis == 0:
+            return int(600 * math.sin(angle)) + self.noise()
+        if axis == 1:
+            return int(300 * math.cos(angle)) + self.noise()
+        return -1000 + self.noise()
+
+    def button(self, index):
+        """
+        :param index: 0 for button a, 1 for button b
+        :return: True while the button is pressed
+        """
+        t = (self.elapsed() + index * BUTTON_PERIOD / 2.0) % BUTTON_PERIOD
+        return t < BUTTON_LENGTH
+
+    def analog(self, pin):
+        """
+        :param pin: pin number
+        :return: a triangle wave between 0 and 1023, one per pin
+        """
+        t = (self.elapsed() + pin) % 2
+        return int(1023 * (t if t < 1 else 2 - t))
+
+
+class Accelerometer:
+    def __init__(self, sensors):
+        self.sensors = sensors
+
+    def get_x(self):
+        return self.sensors.acceleration(0)
+
+    def get_y(self):
+        return self.sensors.acceleration(1)
+
+    def get_z(self):
+        return self.sensors.acceleration(2)
+
+
+class Button:
+    def __init__(self, sensors, index):
+        self.sensors = sensors
+        self.index = index
+
+    def is_pressed(self):
+        return self.sensors.button(self.index)
+
+
+class Pin:
+    def __init__(self, sensors, index):
+        self.sensors = sensors
+        self.index = index
+        self.output = None
+
+    def read_analog(self):
+        return self.sensors.analog(self.index)
+
+    def read_digital(self):
+        return int(self.sensors.analog(self.index) > 511)
+
+    def write_analog(self, value):
+        self.output = value
+
+    def write_digital(self, value):
+        self.output = value
+
+
+class Image:
+    """
+    Stands in for the microbit Image class. Images are only compared,
+    never drawn.
+    """
+
+    def __init__(self, *args):
+        self.args = args
+
+    def __repr__(self):
+        return 'Image({})'.format(', '.join(repr(arg) for arg in self.args))
+
+
+for image_name in IMAGE_NAMES:
+    setattr(Image, image_name, Image(image_name))
+
+
+class Display:
+    """
+    Keeps the state of the 5x5 display and counts the calls made to it.
+    """
+
+    def __init__(self):
+        self.pixels = [[0] * 5 for _ in range(5)]
+        self.image = None
+        self.text = None
+        self.counts = {'show': 0, 'scroll': 0, 'set_pixel': 0, 'clear': 0}
+
+    def show(self, image, wait=True, **kwargs):
+        self.image = image
+        self.counts['show'] += 1
+
+    def scroll(self, text, wait=True, **kwargs):
+        self.text = text
+        self.counts['scroll'] += 1
+
+    def set_pixel(self, x, y, value):
+        self.pixels[y][x] = value
+        self.counts['set_pixel'] += 1
+
+    def get_pixel(self, x, y):
+        return self.pixels[y][x]
+
+    def clear(self):
+        self.pixels = [[0] * 5 for _ in range(5)]
+        self.image = None
+        self.counts['clear'] += 1
+
+
+class MicroBitSimulator:
+    """
+    Runs s2mb.py on a pseudo-terminal.
+    """
+
+    def __init__(self, firmware=FIRMWARE, latency=0, baud=115200, seed=None):
+        """
+        :param firmware: path of the s2mb.py script to run
+        :param latency: seconds to wait before each reply is sent
+        :param baud: simulated link speed, 0 to send as fast as possible
+        :param seed: random seed for repeatable sensor values
+        """
+        self.firmware = firmware
+        self.master_fd, self.slave_fd = pty.openpty()
+        # no echo and no line ending translation, like a real serial port
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+
+        self.uart = Uart(self.master_fd, latency, baud)
+        self.sensors = Sensors(seed)
+        self.display = Display()
+        self.pins = [Pin(self.sensors, i) for i in range(3)]
+
+    def build_module(self):
+        """
+        :return: a stand-in for the MicroPython microbit module
+        """
+        module = types.ModuleType('microbit')
+        module.uart = self.uart
+        module.display = self.display
+        module.Image = Image
+        module.accelerometer = Accelerometer(self.sensors)
+        module.button_a = Button(self.sensors, 0)
+        module.button_b = Button(self.sensors, 1)
+        module.pin0, module.pin1, module.pin2 = self.pins
+        module.sleep = lambda ms: time.sleep(ms / 1000.0)
+        module.running_time = lambda: int(self.sensors.elapsed() * 1000)
+        return module
+
+    def run(self):
+        """
+        Run the firmware. This does not return.
+        """
+        sys.modules['microbit'] = self.build_module()
+        with open(self.firmware) as f:
+            code = compile(f.read(), self.firmware, 'exec')
+        # print on the board writes to the uart
+        exec(code, {'__name__': 'main', 'print': self.uart.print_line})
+
+    def start(self):
+        """
+        Run the firmware in a daemon thread.
+        """
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def report(self):
+        """
+        :return: summary of the traffic and display calls
+        """
+        counts = ', '.join('{} {}'.format(name, count)
+                           for name, count in sorted(self.display.counts.items()))
+        return 'received {} bytes, sent {} bytes, {}'.format(
+            self.uart.bytes_received, self.uart.bytes_sent, counts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--firmware", dest="firmware", default=FIRMWARE,
+                        help="s2mb.py script to run")
+    parser.add_argument("--latency", dest="latency", default="0",
+                        help="milliseconds to wait before each reply is sent")
+    parser.add_argument("--baud", dest="baud", default="115200",
+                        help="simulated link speed, 0 for no limit")
+    parser.add_argument("--seed", dest="seed", default="None",
+                        help="random seed for repeatable sensor values")
+    args = parser.parse_args()
+
+    seed = None if args.seed == 'None' else int(args.seed)
+    simulator = MicroBitSimulator(args.firmware, float(args.latency) / 1000,
+                                  int(args.baud), seed)
+
+    # the first line of output is the port, for scripts that start the simulator
+    print(simulator.port)
+    sys.stdout.flush()
+
+    # exit cleanly on SIGTERM as well as Control-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    simulator.start()
+    try:
+        while True:
+            time.sleep(1)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    sys.stderr.write(simulator.report() + '\n')
+
+
+if __name__ == '__main__':
+    main()
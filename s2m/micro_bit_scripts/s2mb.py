@@ -14,247 +14,508 @@
  along with this library; if not, write to the Free Software
  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
- Last modified 5 April 2018
+ Last modified 18 October 2026
 """
 
+import struct
+
 from microbit import *
 
 
 # This is a script used to control a micro:bit from s2m
 
-# This loop continuously polls the sensors and then prints a reply string.
-# It also continuously calls readline to check for commands.
+# This loop continuously checks the uart for commands and replies with
+# the sensor values when asked to. It does not sleep between passes, so
+# commands are handled as soon as they arrive.
 # A command is specified as comma delimited string with the command
 # as the first element followed by its parameters.
+# Several commands may be sent on one line, separated by ';'.
 
 # Commands:
 #   d - display the specified image
 #   s - scroll the specified text
 #   p - control a pixel for the specified row, column and intensity
 #   c - clear the display (no parameters)
+#   f - show a frame of 25 brightness digits (0-9), one row after another
 #   a - analog write for the specified pin and value (range 0-1023)
 #   t - digital write for the specified pin and value (0 or 1)
 #   g - get sensor values string (fields are comma delimited)
 #   v - get version string
+#   r - stream sensor values every n milliseconds (0 stops streaming)
+#   b - use the binary wire protocol if 1, the ASCII protocol if 0
+#   m - only read the sensor fields whose bits are set in the mask
+#       (bit 0 = x ... bit 10 = analog input 2, see sensor_values)
+#   e - set a deadband for each sensor field, in sensor_values order.
+#       Only the fields that change by more than their deadband are sent,
+#       and nothing is streamed while nothing changes. With no deadbands,
+#       every field is sent again.
+#   u - change the uart baud rate. The reply, u and the rate, is sent at
+#       the old rate. s2m then has BAUD_CONFIRM_TIME ms to send u, the rate
+#       and ok at the new rate, which is echoed back. Otherwise the uart
+#       goes back to BAUD_RATE. Only used with the ASCII protocol.
+
+# With the binary wire protocol, each command line is sent as a frame:
+# 0xa5, length, command text. Sensor values are sent as 0xa5, 'S' and
+# a packed sensor packet, and text replies as 0xa5, 'T', length, text.
+
+# the input/output pins
+pins = (pin0, pin1, pin2)
+
+# images that can be shown with the d command.
+# built once, so that a d command does not allocate anything.
+image_dict = {"HAPPY": Image.HAPPY,
+              "SAD": Image.SAD,
+              "ANGRY": Image.ANGRY,
+              "SMILE": Image.SMILE,
+              "CONFUSED": Image.CONFUSED,
+              "ASLEEP": Image.ASLEEP,
+              "SURPRISED": Image.SURPRISED,
+              "SILLY": Image.SILLY,
+              "FABULOUS": Image.FABULOUS,
+              "MEH": Image.MEH,
+              "YES": Image.YES,
+              "NO": Image.NO,
+              "RABBIT": Image.RABBIT,
+              "COW": Image.COW,
+              "ROLLERSKATE": Image.ROLLERSKATE,
+              "HOUSE": Image.HOUSE,
+              "SNAKE": Image.SNAKE,
+              "HEART": Image.HEART,
+              "DIAMOND": Image.DIAMOND,
+              "DIAMOND_SMALL": Image.DIAMOND_SMALL,
+              "SQUARE": Image.SQUARE,
+              "SQUARE_SMALL": Image.SQUARE_SMALL,
+              "TRIANGLE": Image.TRIANGLE,
+              "TARGET": Image.TARGET,
+              "STICKFIGURE": Image.STICKFIGURE,
+              "ARROW_N": Image.ARROW_N,
+              "ARROW_NE": Image.ARROW_NE,
+              "ARROW_E": Image.ARROW_E,
+              "ARROW_SE": Image.ARROW_SE,
+              "ARROW_S": Image.ARROW_S,
+              "ARROW_SW": Image.ARROW_SW,
+              "ARROW_W": Image.ARROW_W,
+              "ARROW_NW": Image.ARROW_NW}
+
+# sensor values are gathered into this list and formatted with
+# a single template: x, y, z, button a, button b,
+# digital inputs 0-2 and analog inputs 0-2
+sensor_values = [0] * 11
+sensor_format = ','.join(['{}'] * 11)
+
+# mask with every sensor field selected
+ALL_FIELDS = 0x7ff
+
+# the deadband of each sensor field, the values last sent to s2m
+# and the values sent when only the changes are sent
+deadbands = [0] * 11
+last_sent = [None] * 11
+report_values = [0] * 11
+
+# every field is sent at least this often in ms, even if it has not changed
+FULL_SAMPLE_INTERVAL = 1000
+last_full_time = 0
+
+# binary sensor frame, the sync byte and frame type never change
+packet = bytearray(15)
+packet[0] = 0xa5
+packet[1] = 83
+
+# the baud rate s2m connects at
+BAUD_RATE = 115200
+
+# ms to wait for the reply to a baud rate change to be sent
+# before switching, and ms to wait for s2m to confirm the change
+BAUD_SWITCH_DELAY = 20
+BAUD_CONFIRM_TIME = 500
+
+VERSION = 's2mb.py Version 1.18 18 October 2026'
+
+
+def read_sensors(digital_outputs, mask, unread):
+    """
+    Read the sensors selected by the mask into sensor_values.
+
+    :param digital_outputs: list of current digital pin modes
+    :param mask: sensor field mask
+    :param unread: value stored for the fields that are not read
+    """
+    # the three axes are read together
+    if mask & 7:
+        sensor_values[0] = accelerometer.get_x()
+        sensor_values[1] = accelerometer.get_y()
+        sensor_values[2] = accelerometer.get_z()
+    else:
+        sensor_values[0] = sensor_values[1] = sensor_values[2] = unread
+    sensor_values[3] = button_a.is_pressed() if mask & 8 else unread
+    sensor_values[4] = button_b.is_pressed() if mask & 16 else unread
+
+    # pins used as outputs report 0
+    for i in range(3):
+        if not mask & (32 << i):
+            sensor_values[i + 5] = unread
+        elif digital_outputs[i]:
+            sensor_values[i + 5] = 0
+        else:
+            sensor_values[i + 5] = pins[i].read_digital()
+        if not mask & (256 << i):
+            sensor_values[i + 8] = unread
+        elif digital_outputs[i]:
+            sensor_values[i + 8] = 0
+        else:
+            sensor_values[i + 8] = pins[i].read_analog()
+
+
+def get_packet():
+    """
+    Pack sensor_values for the binary wire protocol.
+
+    :return: sensor frame bytes (the fields that were not read are 0)
+    """
+    # bit 0 = button a, bit 1 = button b, bits 2-4 = digital inputs 0-2
+    flags = (sensor_values[3] | sensor_values[4] << 1 | sensor_values[5] << 2 |
+             sensor_values[6] << 3 | sensor_values[7] << 4)
+    struct.pack_into('<hhhBHHH', packet, 2, sensor_values[0], sensor_values[1],
+                     sensor_values[2], flags, sensor_values[8], sensor_values[9],
+                     sensor_values[10])
+    return packet
+
+
+def forget_last_sent():
+    """
+    Make the next sample be sent in full.
+    """
+    global last_full_time
+    for i in range(11):
+        last_sent[i] = None
+    last_full_time = running_time()
+
+
+def check_changes():
+    """
+    Compare sensor_values with the values last sent to s2m. A value that
+    has changed by more than its deadband is copied to report_values and
+    becomes the last sent value. The other values are empty in report_values.
+
+    :return: True if any value changed
+    """
+    if running_time() - last_full_time >= FULL_SAMPLE_INTERVAL:
+        forget_last_sent()
+    changed = False
+    for i in range(11):
+        value = sensor_values[i]
+        last = last_sent[i]
+        if value == '' or (last is not None and abs(value - last) <= deadbands[i]):
+            report_values[i] = ''
+        else:
+            report_values[i] = value
+            last_sent[i] = value
+            changed = True
+    return changed
+
+
+def send_sensors(digital_outputs, mask, binary, deltas=False, streaming=False):
+    """
+    Read the sensors and send their values to s2m.
+
+    :param digital_outputs: list of current digital pin modes
+    :param mask: sensor field mask
+    :param binary: True to use the binary wire protocol
+    :param deltas: True to only send the values that changed by more than
+                   their deadband. With the ASCII protocol, the other
+                   fields are sent empty.
+    :param streaming: True if the values are being streamed. When deltas
+                      is True and nothing has changed, nothing is sent.
+    """
+    # the fields that are not in the mask are empty, or 0 in a binary packet
+    read_sensors(digital_outputs, mask, 0 if binary else '')
+    values = sensor_values
+    if deltas:
+        if not check_changes() and streaming:
+            return
+        values = report_values
+    if binary:
+        uart.write(get_packet())
+    else:
+        print(sensor_format.format(*values))
+
+
+def send_text(text, binary):
+    """
+    Send a text reply to s2m.
+
+    :param text: reply string
+    :param binary: True to use the binary wire protocol
+    """
+    if binary:
+        uart.write(bytes([0xa5, 84, len(text)]) + bytes(text, 'utf-8'))
+    else:
+        print(text)
+
+
+def change_baud(rate):
+    """
+    Switch the uart to a new baud rate, keeping it only if s2m
+    confirms that it can talk at that rate.
+
+    :param rate: the new baud rate
+    """
+    reply = 'u,' + str(rate)
+    confirmation = reply + ',ok'
+    print(reply)
+    sleep(BAUD_SWITCH_DELAY)
+    try:
+        uart.init(baudrate=rate)
+    except ValueError:
+        # s2m will not get an answer and fall back too
+        uart.init(baudrate=BAUD_RATE)
+        return
+    received = b''
+    start = running_time()
+    while running_time() - start < BAUD_CONFIRM_TIME:
+        if uart.any():
+            data = uart.read()
+            if data:
+                received += data
+            if bytes(confirmation, 'utf-8') in received:
+                print(confirmation)
+                return
+    uart.init(baudrate=BAUD_RATE)
+
+
+def clamp(value, low, high):
+    """
+    Limit a value to a range.
+
+    :param value: value to limit
+    :param low: lowest allowed value
+    :param high: highest allowed value
+    :return: limited value
+    """
+    if value < low:
+        return low
+    if value > high:
+        return high
+    return value
 
 
-# a list of current digital pin modes
 def loop():
+    # a list of current digital pin modes
     digital_outputs = [False, False, False]
+    # sensor streaming interval in ms, 0 if not streaming
+    stream_interval = 0
+    last_stream_time = 0
+    # True when using the binary wire protocol
+    binary = False
+    # the sensor fields to read
+    mask = ALL_FIELDS
+    # True to only send the sensor values that changed
+    deltas = False
+    # received bytes that have not been processed yet
+    rx = b''
     while True:
-        data = uart.readline()
-        sleep(8)
-        if data:
-            cmd = str(data, 'utf-8').rstrip()
-            if not len(cmd):
-                continue
-            # noinspection PyUnresolvedReferences
-            cmd_list = cmd.split(",")
-            # get command id
-
-            try:
-                cmd_id = cmd_list[0]
-            except IndexError:
-                cmd_id = 'z'
+        if stream_interval:
+            now = running_time()
+            if now - last_stream_time >= stream_interval:
+                last_stream_time = now
+                send_sensors(digital_outputs, mask, binary, deltas, True)
+
+        # only read when something has arrived, so that an idle pass
+        # does not allocate anything
+        if uart.any():
+            data = uart.read()
+            if data:
+                rx += data
+        if not rx:
+            continue
+
+        # handle every complete line that has arrived
+        while rx:
+            line = None
+            if binary and rx[0] == 0xa5:
+                # binary frame: wait until all of the command text has arrived
+                if len(rx) > 1 and len(rx) >= rx[1] + 2:
+                    line = str(rx[2:rx[1] + 2], 'utf-8')
+                    rx = rx[rx[1] + 2:]
+            else:
+                # anything else is an ASCII line. Receiving one means that s2m
+                # has (re)started and is using the ASCII protocol.
+                end = rx.find(b'\n')
+                if end >= 0:
+                    try:
+                        line = str(rx[:end], 'utf-8').rstrip()
+                    except UnicodeError:
+                        # received at another baud rate, e.g. while s2m
+                        # looks for the rate that s2mb.py is using
+                        line = ''
+                    rx = rx[end + 1:]
+                    binary = False
+                elif len(rx) > 128:
+                    # discard data that will never form a command
+                    rx = b''
+            if line is None:
+                # the rest of the line has not arrived yet
+                break
+            if not line:
                 continue
 
-            # display image command
-            if cmd_id == 'd':
-                image_dict = {"HAPPY": Image.HAPPY,
-                              "SAD": Image.SAD,
-                              "ANGRY": Image.ANGRY,
-                              "SMILE": Image.SMILE,
-                              "CONFUSED": Image.CONFUSED,
-                              "ASLEEP": Image.ASLEEP,
-                              "SURPRISED": Image.SURPRISED,
-                              "SILLY": Image.SILLY,
-                              "FABULOUS": Image.FABULOUS,
-                              "MEH": Image.MEH,
-                              "YES": Image.YES,
-                              "NO": Image.NO,
-                              "RABBIT": Image.RABBIT,
-                              "COW": Image.COW,
-                              "ROLLERSKATE": Image.ROLLERSKATE,
-                              "HOUSE": Image.HOUSE,
-                              "SNAKE": Image.SNAKE,
-                              "HEART": Image.HEART,
-                              "DIAMOND": Image.DIAMOND,
-                              "DIAMOND_SMALL": Image.DIAMOND_SMALL,
-                              "SQUARE": Image.SQUARE,
-                              "SQUARE_SMALL": Image.SQUARE_SMALL,
-                              "TRIANGLE": Image.TRIANGLE,
-                              "TARGET": Image.TARGET,
-                              "STICKFIGURE": Image.STICKFIGURE,
-                              "ARROW_N": Image.ARROW_N,
-                              "ARROW_NE": Image.ARROW_NE,
-                              "ARROW_E": Image.ARROW_E,
-                              "ARROW_SE": Image.ARROW_SE,
-                              "ARROW_S": Image.ARROW_S,
-                              "ARROW_SW": Image.ARROW_SW,
-                              "ARROW_W": Image.ARROW_W,
-                              "ARROW_NW": Image.ARROW_NW}
-
-                # get image key
-                try:
-                    image_key = cmd_list[1]
-                except IndexError:
-                    continue
-                if image_key in image_dict:
-                    display.show(image_dict.get(image_key), wait=False)
-
-            # scroll text command
-            elif cmd_id == 's':
-                display.scroll(str(cmd_list[1]), wait=False)
-
-            # write pixel command
-            elif cmd_id == 'p':
-                # get row, column and intensity value
-                # make sure values are within valid range
-                # print(cmd)
-                try:
-                    x = int(cmd_list[1])
-                except ValueError:
-                    continue
-                except IndexError:
-                    continue
-
-                if x < 0:
-                    x = 0
-                if x > 4:
-                    x = 4
-
-                try:
-                    y = int(cmd_list[2])
-                except ValueError:
-                    continue
-                except IndexError:
-                    continue
-
-                if y < 0:
-                    y = 0
-                if y > 4:
-                    y = 4
-                try:
-                    value = int(cmd_list[3])
-                except ValueError:
-                    continue
-                except IndexError:
-                    continue
-
-                if value < 0:
-                    value = 0
-                if value > 9:
-                    value = 9
-                display.set_pixel(x, y, value)
-
-            # clear display command
-            elif cmd_id == 'c':
-                display.clear()
-
-            # analog write command
-            # if values are out of range, command is ignored
-            elif cmd_id == 'a':
-                # check pin and value ranges
-                try:
-                    pin = int(cmd_list[1])
-                    value = int(cmd_list[2])
-                    digital_outputs[pin] = True
-                except IndexError:
-                    continue
-                except ValueError:
+            # several commands may arrive on one line separated by ';'
+            # scroll text is always sent on a line of its own
+            if line[:2] == 's,':
+                cmds = (line,)
+            else:
+                cmds = line.split(';')
+            for cmd in cmds:
+                if not len(cmd):
                     continue
+                # noinspection PyUnresolvedReferences
+                cmd_list = cmd.split(",")
+                # get command id
+                cmd_id = cmd_list[0]
 
-                if 0 <= pin <= 2:
-                    if not 0 <= value <= 1023:
-                        value = 256
-                    if pin == 0:
-                        pin0.write_analog(value)
-                    elif pin == 1:
-                        pin1.write_analog(value)
-                    elif pin == 2:
-                        pin2.write_analog(value)
-
-            # digital write command
-            elif cmd_id == 't':
-                # check pin and value ranges
+                # display image command
+                if cmd_id == 'd':
+                    # get image key
+                    try:
+                        image = image_dict.get(cmd_list[1])
+                    except IndexError:
+                        continue
+                    if image is not None:
+                        display.show(image, wait=False)
+
+                # scroll text command
+                elif cmd_id == 's':
+                    # scroll text is always on a line of its own, so the
+                    # text is the rest of the line, commas included
+                    if len(cmd_list) < 2:
+                        continue
+                    display.scroll(cmd[2:], wait=False)
+
+                # write pixel command
+                elif cmd_id == 'p':
+                    # get row, column and intensity value
+                    # make sure values are within valid range
+                    try:
+                        x = clamp(int(cmd_list[1]), 0, 4)
+                        y = clamp(int(cmd_list[2]), 0, 4)
+                        value = clamp(int(cmd_list[3]), 0, 9)
+                    except ValueError:
+                        continue
+                    except IndexError:
+                        continue
+                    display.set_pixel(x, y, value)
+
+                # clear display command
+                elif cmd_id == 'c':
+                    display.clear()
+
+                # display frame command
+                # the whole display is drawn with a single Image
+                elif cmd_id == 'f':
+                    try:
+                        frame = cmd_list[1]
+                    except IndexError:
+                        continue
+                    if len(frame) != 25:
+                        continue
+                    try:
+                        display.show(Image(frame[0:5] + ':' + frame[5:10] + ':' + frame[10:15] + ':' +
+                                           frame[15:20] + ':' + frame[20:25]))
+                    except ValueError:
+                        continue
+
+                # analog write command
                 # if values are out of range, command is ignored
-                try:
-                    pin = int(cmd_list[1])
-                    value = int(cmd_list[2])
-                    digital_outputs[pin] = True
-                except IndexError:
-                    continue
-                except ValueError:
-                    continue
-
-                if 0 <= pin <= 2:
-                    if 0 <= value <= 1:
-                        if pin == 0:
-                            pin0.write_digital(value)
-                        elif pin == 1:
-                            pin1.write_digital(value)
-                        elif pin == 2:
-                            pin2.write_digital(value)
-                    else:
-                        pass
-
-            elif cmd == 'g':
-                # This string will contain the sensor values and will
-                # be "printed" to the serial port.
-                # Fields are comma delimited
-                sensor_string = ""
-
-                # accelerometer
-                sensor_string += str(accelerometer.get_x()) + ','
-                sensor_string += str(accelerometer.get_y()) + ','
-                sensor_string += str(accelerometer.get_z()) + ','
-
-                # buttons
-                sensor_string += str(button_a.is_pressed()) + ','
-
-                sensor_string += str(button_b.is_pressed()) + ','
-
-                # get digital input pin values
-                if not digital_outputs[0]:
-                    sensor_string += str(pin0.read_digital()) + ','
-                else:
-                    sensor_string += '0' + ','
-                #
-                if not digital_outputs[1]:
-                    sensor_string += str(pin1.read_digital()) + ','
-                else:
-                    sensor_string += '0' + ','
-                #
-                if not digital_outputs[2]:
-                    sensor_string += str(pin2.read_digital()) + ','
-                else:
-                    sensor_string += '0' + ','
-
-                # get analog input pin values
-                if not digital_outputs[0]:
-                    sensor_string += str(pin0.read_analog()) + ','
-                else:
-                    sensor_string += '0' + ','
-
-                if not digital_outputs[1]:
-                    sensor_string += str(pin1.read_analog()) + ','
-                else:
-                    sensor_string += '0' + ','
-
-                if not digital_outputs[2]:
-                    sensor_string += str(pin2.read_analog())
-                else:
-                    sensor_string += '0' + ','
-
-                print(sensor_string)
-                sleep(10)
-
-
-            elif cmd == 'v':
-                print('s2mb.py Version 1.10 14 April 2018')
-            else:
-                continue
-        sleep(8)
+                elif cmd_id == 'a':
+                    # check pin and value ranges
+                    try:
+                        pin = int(cmd_list[1])
+                        value = int(cmd_list[2])
+                        digital_outputs[pin] = True
+                    except IndexError:
+                        continue
+                    except ValueError:
+                        continue
+
+                    if 0 <= pin <= 2:
+                        if not 0 <= value <= 1023:
+                            value = 256
+                        pins[pin].write_analog(value)
+
+                # digital write command
+                elif cmd_id == 't':
+                    # check pin and value ranges
+                    # if values are out of range, command is ignored
+                    try:
+                        pin = int(cmd_list[1])
+                        value = int(cmd_list[2])
+                        digital_outputs[pin] = True
+                    except IndexError:
+                        continue
+                    except ValueError:
+                        continue
+
+                    if 0 <= pin <= 2 and 0 <= value <= 1:
+                        pins[pin].write_digital(value)
+
+                elif cmd == 'g':
+                    send_sensors(digital_outputs, mask, binary, deltas)
+
+                # set sensor streaming interval in ms, 0 stops streaming
+                elif cmd_id == 'r':
+                    try:
+                        stream_interval = int(cmd_list[1])
+                    except IndexError:
+                        continue
+                    except ValueError:
+                        continue
+                    if stream_interval < 0:
+                        stream_interval = 0
+                    last_stream_time = running_time()
+
+                # select the wire protocol
+                elif cmd_id == 'b':
+                    try:
+                        binary = cmd_list[1] == '1'
+                    except IndexError:
+                        continue
+
+                elif cmd == 'v':
+                    send_text(VERSION, binary)
+
+                # select the sensor fields to read
+                elif cmd_id == 'm':
+                    try:
+                        mask = int(cmd_list[1]) & ALL_FIELDS
+                    except IndexError:
+                        continue
+                    except ValueError:
+                        continue
+                    # fields that were not read before have no last sent value
+                    forget_last_sent()
+
+                # set the sensor field deadbands
+                elif cmd_id == 'e':
+                    try:
+                        for i in range(11):
+                            deadbands[i] = int(cmd_list[i + 1]) if i + 1 < len(cmd_list) else 0
+                    except ValueError:
+                        continue
+                    deltas = len(cmd_list) > 1
+                    # s2m may have just started, so the next sample is sent in full
+                    forget_last_sent()
+
+                # change the baud rate
+                # a late confirmation has an ok on the end and is ignored
+                elif cmd_id == 'u' and not binary and len(cmd_list) == 2:
+                    try:
+                        rate = int(cmd_list[1])
+                    except ValueError:
+                        continue
+                    change_baud(rate)
+                    # anything else received was sent at the old rate
+                    rx = b''
+                    break
 
 
 loop()
@@ -1,137 +1,259 @@
+import struct
 from microbit import*
+pins=(pin0,pin1,pin2)
+image_dict={"HAPPY":Image.HAPPY,"SAD":Image.SAD,"ANGRY":Image.ANGRY,"SMILE":Image.SMILE,"CONFUSED":Image.CONFUSED,"ASLEEP":Image.ASLEEP,"SURPRISED":Image.SURPRISED,"SILLY":Image.SILLY,"FABULOUS":Image.FABULOUS,"MEH":Image.MEH,"YES":Image.YES,"NO":Image.NO,"RABBIT":Image.RABBIT,"COW":Image.COW,"ROLLERSKATE":Image.ROLLERSKATE,"HOUSE":Image.HOUSE,"SNAKE":Image.SNAKE,"HEART":Image.HEART,"DIAMOND":Image.DIAMOND,"DIAMOND_SMALL":Image.DIAMOND_SMALL,"SQUARE":Image.SQUARE,"SQUARE_SMALL":Image.SQUARE_SMALL,"TRIANGLE":Image.TRIANGLE,"TARGET":Image.TARGET,"STICKFIGURE":Image.STICKFIGURE,"ARROW_N":Image.ARROW_N,"ARROW_NE":Image.ARROW_NE,"ARROW_E":Image.ARROW_E,"ARROW_SE":Image.ARROW_SE,"ARROW_S":Image.ARROW_S,"ARROW_SW":Image.ARROW_SW,"ARROW_W":Image.ARROW_W,"ARROW_NW":Image.ARROW_NW}
+sensor_values=[0]*11
+sensor_format=','.join(['{}']*11)
+ALL_FIELDS=0x7ff
+deadbands=[0]*11
+last_sent=[None]*11
+report_values=[0]*11
+FULL_SAMPLE_INTERVAL=1000
+last_full_time=0
+packet=bytearray(15)
+packet[0]=0xa5
+packet[1]=83
+BAUD_RATE=115200
+BAUD_SWITCH_DELAY=20
+BAUD_CONFIRM_TIME=500
+VERSION='s2mb.py Version 1.18 18 October 2026'
+def read_sensors(digital_outputs,mask,unread):
+ if mask&7:
+  sensor_values[0]=accelerometer.get_x()
+  sensor_values[1]=accelerometer.get_y()
+  sensor_values[2]=accelerometer.get_z()
+ else:
+  sensor_values[0]=sensor_values[1]=sensor_values[2]=unread
+ sensor_values[3]=button_a.is_pressed()if mask&8 else unread
+ sensor_values[4]=button_b.is_pressed()if mask&16 else unread
+ for i in range(3):
+  if not mask&(32<<i):
+   sensor_values[i+5]=unread
+  elif digital_outputs[i]:
+   sensor_values[i+5]=0
+  else:
+   sensor_values[i+5]=pins[i].read_digital()
+  if not mask&(256<<i):
+   sensor_values[i+8]=unread
+  elif digital_outputs[i]:
+   sensor_values[i+8]=0
+  else:
+   sensor_values[i+8]=pins[i].read_analog()
+def get_packet():
+ flags=(sensor_values[3]|sensor_values[4]<<1|sensor_values[5]<<2|sensor_values[6]<<3|sensor_values[7]<<4)
+ struct.pack_into('<hhhBHHH',packet,2,sensor_values[0],sensor_values[1],sensor_values[2],flags,sensor_values[8],sensor_values[9],sensor_values[10])
+ return packet
+def forget_last_sent():
+ global last_full_time
+ for i in range(11):
+  last_sent[i]=None
+ last_full_time=running_time()
+def check_changes():
+ if running_time()-last_full_time>=FULL_SAMPLE_INTERVAL:
+  forget_last_sent()
+ changed=False
+ for i in range(11):
+  value=sensor_values[i]
+  last=last_sent[i]
+  if value==''or(last is not None and abs(value-last)<=deadbands[i]):
+   report_values[i]=''
+  else:
+   report_values[i]=value
+   last_sent[i]=value
+   changed=True
+ return changed
+def send_sensors(digital_outputs,mask,binary,deltas=False,streaming=False):
+ read_sensors(digital_outputs,mask,0 if binary else'')
+ values=sensor_values
+ if deltas:
+  if not check_changes()and streaming:
+   return
+  values=report_values
+ if binary:
+  uart.write(get_packet())
+ else:
+  print(sensor_format.format(*values))
+def send_text(text,binary):
+ if binary:
+  uart.write(bytes([0xa5,84,len(text)])+bytes(text,'utf-8'))
+ else:
+  print(text)
+def change_baud(rate):
+ reply='u,'+str(rate)
+ confirmation=reply+',ok'
+ print(reply)
+ sleep(BAUD_SWITCH_DELAY)
+ try:
+  uart.init(baudrate=rate)
+ except ValueError:
+  uart.init(baudrate=BAUD_RATE)
+  return
+ received=b''
+ start=running_time()
+ while running_time()-start<BAUD_CONFIRM_TIME:
+  if uart.any():
+   data=uart.read()
+   if data:
+    received+=data
+   if bytes(confirmation,'utf-8')in received:
+    print(confirmation)
+    return
+ uart.init(baudrate=BAUD_RATE)
+def clamp(value,low,high):
+ if value<low:
+  return low
+ if value>high:
+  return high
+ return value
 def loop():
  digital_outputs=[False,False,False]
+ stream_interval=0
+ last_stream_time=0
+ binary=False
+ mask=ALL_FIELDS
+ deltas=False
+ rx=b''
  while True:
-  data=uart.readline()
-  sleep(8)
-  if data:
-   cmd=str(data,'utf-8').rstrip()
-   if not len(cmd):
-    continue
-   cmd_list=cmd.split(",")
-   try:
-    cmd_id=cmd_list[0]
-   except IndexError:
-    cmd_id='z'
-    continue
-   if cmd_id=='d':
-    image_dict={"HAPPY":Image.HAPPY,"SAD":Image.SAD,"ANGRY":Image.ANGRY,"SMILE":Image.SMILE,"CONFUSED":Image.CONFUSED,"ASLEEP":Image.ASLEEP,"SURPRISED":Image.SURPRISED,"SILLY":Image.SILLY,"FABULOUS":Image.FABULOUS,"MEH":Image.MEH,"YES":Image.YES,"NO":Image.NO,"RABBIT":Image.RABBIT,"COW":Image.COW,"ROLLERSKATE":Image.ROLLERSKATE,"HOUSE":Image.HOUSE,"SNAKE":Image.SNAKE,"HEART":Image.HEART,"DIAMOND":Image.DIAMOND,"DIAMOND_SMALL":Image.DIAMOND_SMALL,"SQUARE":Image.SQUARE,"SQUARE_SMALL":Image.SQUARE_SMALL,"TRIANGLE":Image.TRIANGLE,"TARGET":Image.TARGET,"STICKFIGURE":Image.STICKFIGURE,"ARROW_N":Image.ARROW_N,"ARROW_NE":Image.ARROW_NE,"ARROW_E":Image.ARROW_E,"ARROW_SE":Image.ARROW_SE,"ARROW_S":Image.ARROW_S,"ARROW_SW":Image.ARROW_SW,"ARROW_W":Image.ARROW_W,"ARROW_NW":Image.ARROW_NW}
-    try:
-     image_key=cmd_list[1]
-    except IndexError:
-     continue
-    if image_key in image_dict:
-     display.show(image_dict.get(image_key),wait=False)
-   elif cmd_id=='s':
-    display.scroll(str(cmd_list[1]),wait=False)
-   elif cmd_id=='p':
-    try:
-     x=int(cmd_list[1])
-    except ValueError:
-     continue
-    except IndexError:
-     continue
-    if x<0:
-     x=0
-    if x>4:
-     x=4
-    try:
-     y=int(cmd_list[2])
-    except ValueError:
-     continue
-    except IndexError:
-     continue
-    if y<0:
-     y=0
-    if y>4:
-     y=4
-    try:
-     value=int(cmd_list[3])
-    except ValueError:
-     continue
-    except IndexError:
-     continue
-    if value<0:
-     value=0
-    if value>9:
-     value=9
-    display.set_pixel(x,y,value)
-   elif cmd_id=='c':
-    display.clear()
-   elif cmd_id=='a':
-    try:
-     pin=int(cmd_list[1])
-     value=int(cmd_list[2])
-     digital_outputs[pin]=True
-    except IndexError:
-     continue
-    except ValueError:
-     continue
-    if 0<=pin<=2:
-     if not 0<=value<=1023:
-      value=256
-     if pin==0:
-      pin0.write_analog(value)
-     elif pin==1:
-      pin1.write_analog(value)
-     elif pin==2:
-      pin2.write_analog(value)
-   elif cmd_id=='t':
-    try:
-     pin=int(cmd_list[1])
-     value=int(cmd_list[2])
-     digital_outputs[pin]=True
-    except IndexError:
-     continue
-    except ValueError:
-     continue
-    if 0<=pin<=2:
-     if 0<=value<=1:
-      if pin==0:
-       pin0.write_digital(value)
-      elif pin==1:
-       pin1.write_digital(value)
-      elif pin==2:
-       pin2.write_digital(value)
-     else:
-      pass
-   elif cmd=='g':
-    sensor_string=""
-    sensor_string+=str(accelerometer.get_x())+','
-    sensor_string+=str(accelerometer.get_y())+','
-    sensor_string+=str(accelerometer.get_z())+','
-    sensor_string+=str(button_a.is_pressed())+','
-    sensor_string+=str(button_b.is_pressed())+','
-    if not digital_outputs[0]:
-     sensor_string+=str(pin0.read_digital())+','
-    else:
-     sensor_string+='0'+','
-    if not digital_outputs[1]:
-     sensor_string+=str(pin1.read_digital())+','
-    else:
-     sensor_string+='0'+','
-    if not digital_outputs[2]:
-     sensor_string+=str(pin2.read_digital())+','
-    else:
-     sensor_string+='0'+','
-    if not digital_outputs[0]:
-     sensor_string+=str(pin0.read_analog())+','
-    else:
-     sensor_string+='0'+','
-    if not digital_outputs[1]:
-     sensor_string+=str(pin1.read_analog())+','
-    else:
-     sensor_string+='0'+','
-    if not digital_outputs[2]:
-     sensor_string+=str(pin2.read_analog())
-    else:
-     sensor_string+='0'+','
-    print(sensor_string)
-    sleep(10)
-   elif cmd=='v':
-    print('s2mb.py Version 1.10 14 April 2018')
+  if stream_interval:
+   now=running_time()
+   if now-last_stream_time>=stream_interval:
+    last_stream_time=now
+    send_sensors(digital_outputs,mask,binary,deltas,True)
+  if uart.any():
+   data=uart.read()
+   if data:
+    rx+=data
+  if not rx:
+   continue
+  while rx:
+   line=None
+   if binary and rx[0]==0xa5:
+    if len(rx)>1 and len(rx)>=rx[1]+2:
+     line=str(rx[2:rx[1]+2],'utf-8')
+     rx=rx[rx[1]+2:]
    else:
+    end=rx.find(b'\n')
+    if end>=0:
+     try:
+      line=str(rx[:end],'utf-8').rstrip()
+     except UnicodeError:
+      line=''
+     rx=rx[end+1:]
+     binary=False
+    elif len(rx)>128:
+     rx=b''
+   if line is None:
+    break
+   if not line:
     continue
-  sleep(8)
+   if line[:2]=='s,':
+    cmds=(line,)
+   else:
+    cmds=line.split(';')
+   for cmd in cmds:
+    if not len(cmd):
+     continue
+    cmd_list=cmd.split(",")
+    cmd_id=cmd_list[0]
+    if cmd_id=='d':
+     try:
+      image=image_dict.get(cmd_list[1])
+     except IndexError:
+      continue
+     if image is not None:
+      display.show(image,wait=False)
+    elif cmd_id=='s':
+     if len(cmd_list)<2:
+      continue
+     display.scroll(cmd[2:],wait=False)
+    elif cmd_id=='p':
+     try:
+      x=clamp(int(cmd_list[1]),0,4)
+      y=clamp(int(cmd_list[2]),0,4)
+      value=clamp(int(cmd_list[3]),0,9)
+     except ValueError:
+      continue
+     except IndexError:
+      continue
+     display.set_pixel(x,y,value)
+    elif cmd_id=='c':
+     display.clear()
+    elif cmd_id=='f':
+     try:
+      frame=cmd_list[1]
+     except IndexError:
+      continue
+     if len(frame)!=25:
+      continue
+     try:
+      display.show(Image(frame[0:5]+':'+frame[5:10]+':'+frame[10:15]+':'+frame[15:20]+':'+frame[20:25]))
+     except ValueError:
+      continue
+    elif cmd_id=='a':
+     try:
+      pin=int(cmd_list[1])
+      value=int(cmd_list[2])
+      digital_outputs[pin]=True
+     except IndexError:
+      continue
+     except ValueError:
+      continue
+     if 0<=pin<=2:
+      if not 0<=value<=1023:
+       value=256
+      pins[pin].write_analog(value)
+    elif cmd_id=='t':
+     try:
+      pin=int(cmd_list[1])
+      value=int(cmd_list[2])
+      digital_outputs[pin]=True
+     except IndexError:
+      continue
+     except ValueError:
+      continue
+     if 0<=pin<=2 and 0<=value<=1:
+      pins[pin].write_digital(value)
+    elif cmd=='g':
+     send_sensors(digital_outputs,mask,binary,deltas)
+    elif cmd_id=='r':
+     try:
+      stream_interval=int(cmd_list[1])
+     except IndexError:
+      continue
+     except ValueError:
+      continue
+     if stream_interval<0:
+      stream_interval=0
+     last_stream_time=running_time()
+    elif cmd_id=='b':
+     try:
+      binary=cmd_list[1]=='1'
+     except IndexError:
+      continue
+    elif cmd=='v':
+     send_text(VERSION,binary)
+    elif cmd_id=='m':
+     try:
+      mask=int(cmd_list[1])&ALL_FIELDS
+     except IndexError:
+      continue
+     except ValueError:
+      continue
+     forget_last_sent()
+    elif cmd_id=='e':
+     try:
+      for i in range(11):
+       deadbands[i]=int(cmd_list[i+1])if i+1<len(cmd_list)else 0
+     except ValueError:
+      continue
+     deltas=len(cmd_list)>1
+     forget_last_sent()
+    elif cmd_id=='u'and not binary and len(cmd_list)==2:
+     try:
+      rate=int(cmd_list[1])
+     except ValueError:
+      continue
+     change_baud(rate)
+     rx=b''
+     break
 loop()
-
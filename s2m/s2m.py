@@ -16,27 +16,140 @@
 """
 import argparse
 import atexit
-import binascii
-import glob
+import json
 import os
+import re
 import subprocess
 import sys
-import time
+import threading
 from argparse import RawTextHelpFormatter
 from subprocess import Popen
 
 import psutil
-# noinspection PyPackageRequirements
-import serial
 
 try:
     # for python 3
+    from urllib.parse import unquote_to_bytes
+except ImportError:
+    # for python 2, unquote returns a byte string
+    # noinspection PyUnresolvedReferences
+    from urllib import unquote as unquote_to_bytes
+
+try:
+    # for python 3
+    from s2m.s2m_gestures import POLL_CONSUMER
     from s2m.s2m_http_server import start_server
+    from s2m.s2m_metrics import Metrics, MetricsReporter, timer
+    from s2m.s2m_recorder import Recorder, open_replay
+    from s2m.s2m_serial import DeviceManager, list_candidate_ports, BOOLEAN_TEXT, \
+        ALL_FIELDS, ACCELEROMETER_FIELDS, FIELD_COUNT
+    from s2m.s2m_text import transliterate
+    from s2m.s2m_websocket import SensorBroadcaster
 
 except ImportError:
     # for python 2
     # noinspection PyUnresolvedReferences
+    from s2m_gestures import POLL_CONSUMER
+    # noinspection PyUnresolvedReferences
     from s2m_http_server import start_server
+    # noinspection PyUnresolvedReferences
+    from s2m_metrics import Metrics, MetricsReporter, timer
+    # noinspection PyUnresolvedReferences
+    from s2m_recorder import Recorder, open_replay
+    # noinspection PyUnresolvedReferences
+    from s2m_serial import DeviceManager, list_candidate_ports, BOOLEAN_TEXT, \
+        ALL_FIELDS, ACCELEROMETER_FIELDS, FIELD_COUNT
+    # noinspection PyUnresolvedReferences
+    from s2m_text import transliterate
+    # noinspection PyUnresolvedReferences
+    from s2m_websocket import SensorBroadcaster
+
+# the lines of the poll response sent to Scratch: the reporter name,
+# its value and the mask of the sensor fields the value comes from
+POLL_LINES = [('shaken', '{shaken}', ACCELEROMETER_FIELDS),
+              ('freefall', '{freefall}', ACCELEROMETER_FIELDS),
+              ('tilted_right', '{right}', ACCELEROMETER_FIELDS),
+              ('tilted_left', '{left}', ACCELEROMETER_FIELDS),
+              ('tilted_up', '{up}', ACCELEROMETER_FIELDS),
+              ('tilted_down', '{down}', ACCELEROMETER_FIELDS),
+              ('button_a_pressed', '{fields[3]}', 1 << 3),
+              ('button_b_pressed', '{fields[4]}', 1 << 4),
+              ('digital_read/0', '{fields[5]}', 1 << 5),
+              ('digital_read/1', '{fields[6]}', 1 << 6),
+              ('digital_read/2', '{fields[7]}', 1 << 7),
+              ('analog_read/0', '{fields[8]}', 1 << 8),
+              ('analog_read/1', '{fields[9]}', 1 << 9),
+              ('analog_read/2', '{fields[10]}', 1 << 10)]
+
+# the sensor fields needed by each reporter
+REPORTER_FIELDS = dict((name, fields) for name, value, fields in POLL_LINES)
+
+# maximum number of cached poll responses
+POLL_CACHE_SIZE = 64
+
+
+def build_poll_template(index=0, mask=ALL_FIELDS):
+    """
+    Build the poll response template for a micro:bit.
+
+    :param index: micro:bit number. The first micro:bit's sensors are reported
+                  under the usual names, the others have their number
+                  appended, e.g. shaken/1
+    :param mask: sensor field mask. Only the reporters that use the
+                 selected fields are included.
+    :return: template for str.format
+    """
+    suffix = '/' + str(index) if index else ''
+    return ''.join('{}{} {}\n'.format(name, suffix, value)
+                   for name, value, fields in POLL_LINES if fields & mask)
+
+
+def get_sensor_mask(names):
+    """
+    Build a sensor field mask from a list of reporter names.
+
+    :param names: reporter names separated by commas or spaces,
+                  e.g. "button_a_pressed, analog_read/1". A pin number
+                  may follow digital_read or analog_read with a '/',
+                  a '_' or a comma. "all" selects every field.
+    :return: sensor field mask, or None if no reporter was recognized
+    """
+    names = re.sub(r'(digital_read|analog_read)[/_, ]*(\d)', r'\1/\2', names.lower())
+    mask = 0
+    for name in re.split(r'[\s,;]+', names):
+        if not name:
+            continue
+        if name == 'all':
+            mask |= ALL_FIELDS
+        elif name in REPORTER_FIELDS:
+            mask |= REPORTER_FIELDS[name]
+        else:
+            print('Unknown sensor reporter: ' + name)
+    return mask or None
+
+
+def get_deadbands(text):
+    """
+    Build the list of sensor field deadbands.
+
+    :param text: deadbands separated by commas. Either two values, the
+                 accelerometer deadband in milli-g and the analog input
+                 deadband, e.g. "40,8", or one value for each sensor field.
+                 Buttons and digital inputs are always sent when they change.
+    :return: list of FIELD_COUNT deadbands, or None if text is not valid
+    """
+    try:
+        values = [int(value) for value in text.split(',')]
+    except ValueError:
+        values = []
+    if any(value < 0 for value in values):
+        values = []
+    if len(values) == 2:
+        return [values[0]] * 3 + [0] * 5 + [values[1]] * 3
+    if len(values) == FIELD_COUNT:
+        return values
+    print('Deadbands must be "accelerometer,analog" or ' + str(FIELD_COUNT) + ' values: ' + text)
+    return None
 
 
 # noinspection PyMethodMayBeStatic,PyProtectedMember
@@ -51,18 +164,47 @@ class S2M:
     # noinspection PyArgumentList
     def __init__(self, client=None, com_port=None,
                  scratch_executable=None, base_path=None,
-                 display_base_path=False, language='0'):
+                 display_base_path=False, language='0', stream_interval=0,
+                 engine='threaded', wire_protocol='ascii', device_count=1,
+                 metrics_interval=0, record_file=None, replay_file=None, replay_speed=1,
+                 transliterate_text=True, poll_max_age=0, sensor_mask=ALL_FIELDS,
+                 deadbands=None, max_baud_rate=None, websocket=False):
         """
         This method initializes the class. All parameters are normally filled in
         by using the command line options listed at the bottom of this file
 
         :param client: scratch or no_client. The no_client option if to manually
                        launch scratch.
-        :param com_port: com port the micro:bit is connected to
+        :param com_port: com port the micro:bit is connected to. Several
+                         ports may be given, separated by commas.
         :param scratch_executable: path to scratch executable
         :param base_path: python path to s2m installation
         :param display_base_path: show the base path and exit.
         :param language: language for block display
+        :param stream_interval: if non-zero, have the micro:bit push sensor
+                                data every stream_interval milliseconds
+                                instead of waiting for a poll request
+        :param engine: HTTP server engine - threaded or single
+        :param wire_protocol: ascii or binary framing for the micro:bit serial link
+        :param device_count: number of micro:bits to autodetect
+        :param metrics_interval: if non-zero, print a metrics summary
+                                 every metrics_interval seconds
+        :param record_file: if specified, record the sensor samples and
+                            commands to this session log
+        :param replay_file: if specified, replay this session log
+                            instead of using a micro:bit
+        :param replay_speed: replay speed, e.g. 2 for twice as fast as recorded
+        :param transliterate_text: replace scroll text characters that the
+                                   micro:bit cannot display with ASCII text
+        :param poll_max_age: polls are answered with the last sensor data
+                             fetched if it is no older than this many seconds
+        :param sensor_mask: sensor fields reported to Scratch, see get_sensor_mask
+        :param deadbands: if specified, the micro:bit only sends the sensor
+                          fields that change by more than these, see get_deadbands
+        :param max_baud_rate: fastest baud rate to switch the serial link to,
+                              or None for the fastest one that works
+        :param websocket: accept WebSocket connections at /ws, pushing the
+                          sensor data to them (threaded engine only)
         """
 
         self.daemon = True
@@ -74,6 +216,20 @@ class S2M:
         self.base_path = base_path
         self.display_base_path = display_base_path
         self.language = language
+        self.stream_interval = stream_interval
+        self.engine = engine
+        self.wire_protocol = wire_protocol
+        self.device_count = device_count
+        self.metrics_interval = metrics_interval
+        self.record_file = record_file
+        self.replay_file = replay_file
+        self.replay_speed = replay_speed
+        self.transliterate_text = transliterate_text
+        self.poll_max_age = poll_max_age
+        self.sensor_mask = sensor_mask
+        self.deadbands = deadbands
+        self.max_baud_rate = max_baud_rate
+        self.websocket = websocket
 
         # the scratch process id
         self.scratch_pid = None
@@ -84,17 +240,40 @@ class S2M:
         # instance of pyserial used to communicate with the micro:bit
         self.ser = None
 
-        # remember the last accelerometer z value to determine if shaken
-        self.last_z = 0
-
-        # if this is True and a poll is received, the poll is ignored
-        self.ignore_poll = True
+        # Polls are single flight: while the sensor data is being fetched
+        # for one poll, any other polls wait for that fetch and share its
+        # samples. poll_generation counts the completed fetches.
+        self.poll_in_flight = False
+        self.poll_generation = 0
+        self.poll_result = None
+        self.poll_time = 0
+        self.poll_done = threading.Condition()
 
         # place to store the last received poll data
         self.last_poll_result = None
 
-        # serial port
-        self.micro_bit_serial = None
+        # request counters and timings, served at /metrics
+        self.metrics = Metrics()
+
+        # session recorder, if recording was requested
+        self.recorder = None
+        if self.record_file:
+            try:
+                self.recorder = Recorder(self.record_file)
+            except (IOError, OSError) as e:
+                print('Unable to record to ' + self.record_file + ': ' + str(e))
+                sys.exit(0)
+            self.recorder.start()
+            print('Recording to ' + self.record_file)
+
+        # the micro:bits being served
+        self.devices = DeviceManager(self.metrics, self.recorder)
+
+        # pushes the sensor data to the WebSocket clients, if enabled
+        self.broadcaster = None
+
+        # poll response templates, one per micro:bit
+        self.poll_templates = []
 
         # map of image names used for translations
         self.image_map = {"01": "HAPPY",
@@ -137,97 +316,46 @@ class S2M:
         # When control C is entered, Scratch will close if auto-launched
         atexit.register(self.all_done)
 
-        # if no com port was specified, try doing auto discover.
-        if com_port is None:
-            print('Autodetecting serial port. Please wait...')
-            if sys.platform.startswith('darwin'):
-                locations = glob.glob('/dev/tty.[usb*]*')
-                locations = glob.glob('/dev/tty.[wchusb*]*') + locations
-                locations.append('end')
-                # for everyone else, here is a list of possible ports
-            else:
-                locations = ['dev/ttyACM0', '/dev/ttyACM0', '/dev/ttyACM1',
-                             '/dev/ttyACM2', '/dev/ttyACM3', '/dev/ttyACM4',
-                             '/dev/ttyACM5', '/dev/ttyUSB0', '/dev/ttyUSB1',
-                             '/dev/ttyUSB2', '/dev/ttyUSB3', '/dev/ttyUSB4',
-                             '/dev/ttyUSB5', '/dev/ttyUSB6', '/dev/ttyUSB7',
-                             '/dev/ttyUSB8', '/dev/ttyUSB9',
-                             '/dev/ttyUSB10',
-                             '/dev/ttyS0', '/dev/ttyS1', '/dev/ttyS2',
-                             '/dev/tty.usbserial', '/dev/tty.usbmodem', 'com2',
-                             'com3', 'com4', 'com5', 'com6', 'com7', 'com8',
-                             'com9', 'com10', 'com11', 'com12', 'com13',
-                             'com14', 'com15', 'com16', 'com17', 'com18',
-                             'com19', 'com20', 'com21', 'com22', 'com23', 'com24',
-                             'com25', 'com26', 'com27', 'com28', 'com29', 'com30',
-                             'com31', 'com32', 'com33', 'com34', 'com35', 'com36',
-                             'com1', 'end'
-                             ]
-
-            detected = None
-            for device in locations:
-                try:
-                    self.micro_bit_serial = serial.Serial(port=device, baudrate=115200,
-                                                          timeout=.1)
-                    detected = device
-                    break
-                except serial.SerialException:
-                    if device == 'end':
-                        print('Unable to find Serial Port, Please plug in '
-                              'cable or check cable connections.')
-                        detected = None
-                        exit()
-                except OSError:
-                    pass
-            self.com_port = detected
-
-            # open and close the port to flush the serial buffers
-            self.micro_bit_serial.close()
-            self.micro_bit_serial.open()
-            time.sleep(.05)
-        else:
+        if self.replay_file:
+            # the recorded micro:bits stand in for real ones
+            print('Replaying ' + self.replay_file)
             try:
-                self.micro_bit_serial = serial.Serial(port=self.com_port, baudrate=115200,
-                                                      timeout=.1)
-            except serial.SerialException:
-                print('Unable to find Serial Port, Please plug in '
-                      'cable or check cable connections.')
-                exit()
-            except OSError:
-                pass
-            time.sleep(.05)
-
-        # send out a "poll" command to see if port is there
-        cmd = 'g\n'
-        cmd = bytes(cmd.encode())
-        self.micro_bit_serial.write(cmd)
-        time.sleep(2)
-        sent_time = time.time()
-        while not self.micro_bit_serial.inWaiting():
-            if time.time() - sent_time > 2:
-                print('Unable to detect Serial Port, Please plug in '
-                      'cable or check cable connections.')
+                for device in open_replay(self.replay_file, self.replay_speed, self.metrics):
+                    self.devices.add(device)
+            except (IOError, OSError, ValueError) as e:
+                print('Unable to replay ' + self.replay_file + ': ' + str(e))
                 sys.exit(0)
-        # read and decode a line and strip it of trailing \r\n
-        # save the data for the first poll received
-        self.last_poll_result = self.micro_bit_serial.readline().decode().strip()
-
-        print('{}{}\n'.format('Using COM Port:', self.com_port))
-
-        # get version of s2mb.py
-        cmd = 'v\n'
-        cmd = bytes(cmd.encode())
-        self.micro_bit_serial.write(cmd)
-        time.sleep(2)
-        sent_time = time.time()
-        while not self.micro_bit_serial.inWaiting():
-            if time.time() - sent_time > 2:
-                print('Unable to retrieve version s2mb.py on the micro:bit.')
-                print('Have you flashed the latest version?')
+            if not len(self.devices):
+                print('There are no sensor samples in ' + self.replay_file)
                 sys.exit(0)
 
-        v_string = self.micro_bit_serial.readline().decode().strip()
-        print('{}{}\n'.format('s2mb Version: ', v_string))
+        # if no com port was specified, try doing auto discover.
+        elif com_port is None:
+            print('Autodetecting serial port. Please wait...')
+            candidates = list_candidate_ports()
+        else:
+            candidates = com_port.split(',')
+            self.device_count = len(candidates)
+
+        # perform the s2mb.py handshake on all candidates at the same time
+        # and save the data for the first poll received
+        if not self.replay_file:
+            self.last_poll_result = self.devices.open(candidates, self.device_count,
+                                                      self.wire_protocol, self.stream_interval,
+                                                      self.max_baud_rate, com_port is not None)
+        if not len(self.devices):
+            print('Unable to detect the micro:bit, Please plug in '
+                  'cable or check cable connections.')
+            print('Have you flashed the latest version of s2mb.py?')
+            sys.exit(0)
+        self.com_port = self.devices[0].com_port
+
+        for device in self.devices:
+            self.poll_templates.append(build_poll_template(device.index))
+            if self.sensor_mask != ALL_FIELDS:
+                self.set_sensor_mask(device, self.sensor_mask)
+            if self.deadbands:
+                device.set_deadbands(self.deadbands)
 
         if self.client == 'scratch':
             self.find_base_path()
@@ -236,12 +364,22 @@ class S2M:
         else:
             print('Please start Scratch.')
 
+        if self.metrics_interval:
+            MetricsReporter(self.get_metrics, self.metrics_interval).start()
+
+        if self.websocket:
+            if self.engine == 'threaded':
+                self.broadcaster = SensorBroadcaster(self)
+                self.broadcaster.start()
+                print('Accepting WebSocket connections at ws://localhost:50209/ws')
+            else:
+                print('WebSocket connections require the threaded HTTP server engine.')
+
         # start the polling/command processing thread
         # self.start()
-        self.ignore_poll = False
         # start the http server
         try:
-            start_server(self)
+            start_server(self, self.engine)
         except KeyboardInterrupt:
             sys.exit(0)
 
@@ -349,29 +487,113 @@ class S2M:
         else:
             print('You must provide scratch executable information')
 
-    # noinspection PyArgumentList
-    def handle_poll(self):
+    def handle_poll(self, consumer=POLL_CONSUMER):
         """
-        This method sends a poll request to the micro:bit
-        :return: sensor data
+        This method is called when Scratch polls for sensor data.
+
+        Only one fetch of the sensor data is done at a time. A poll that
+        arrives while a fetch is in progress waits for it and is answered
+        with its samples. A poll that arrives within poll_max_age seconds
+        of the last fetch is answered with that fetch's samples.
+        :param consumer: the gesture consumer the response is built for,
+                         see GestureDetector.poll
+        :return: sensor data for all of the micro:bits
         """
-        self.ignore_poll = True
-        resp = self.send_command('g')
-        resp = resp.lower()
-        reply = resp.split(',')
-
-        # if this reply is not the correct length, just toss it.
-        if len(reply) > 12:
-            return ''
+        with self.poll_done:
+            if self.poll_in_flight:
+                generation = self.poll_generation
+                while self.poll_generation == generation:
+                    self.poll_done.wait()
+                self.metrics.count('shared_polls')
+                return self.build_poll_responses(self.poll_result, consumer)
+            if self.poll_max_age and self.poll_result is not None and \
+                    timer() - self.poll_time <= self.poll_max_age:
+                self.metrics.count('shared_polls')
+                return self.build_poll_responses(self.poll_result, consumer)
+            self.poll_in_flight = True
+
+        samples = None
+        try:
+            samples = self.fetch_sensor_data()
+        finally:
+            with self.poll_done:
+                self.poll_result = samples
+                self.poll_time = timer()
+                self.poll_generation += 1
+                self.poll_in_flight = False
+                self.poll_done.notify_all()
+        return self.build_poll_responses(samples, consumer)
+
+    def build_poll_responses(self, samples, consumer=POLL_CONSUMER):
+        """
+        :param samples: list of (device, raw, fields) tuples from fetch_sensor_data
+        :param consumer: the gesture consumer the response is built for
+        :return: sensor data for all of the micro:bits, or None if there are no samples
+        """
+        if samples is None:
+            return None
+        return b''.join([self.build_poll_response(fields, raw, device, consumer)
+                         for device, raw, fields in samples])
 
-        resp = self.build_poll_response(reply)
-        return resp
+    # noinspection PyArgumentList
+    def fetch_sensor_data(self):
+        """
+        This method sends a poll request to each micro:bit, or if
+        streaming, uses the latest sample pushed by the micro:bit.
+        A micro:bit that is disconnected is reported with its last sample.
+        :return: list of (device, raw, fields) tuples, one per micro:bit
+        """
+        start = timer()
+        # time spent waiting for the micro:bits to reply
+        waited = 0
+
+        # send all of the poll requests first so that
+        # the micro:bits can answer at the same time
+        requests = []
+        for device in self.devices:
+            if not device.connected:
+                # answer with the last sample until the micro:bit is back
+                self.metrics.count('degraded_polls')
+                requests.append((device, None))
+            elif device.streaming:
+                requests.append((device, None))
+            else:
+                requests.append((device, device.request_sample()))
 
-    def handle_display_image(self, data):
+        samples = []
+        for device, sample_count in requests:
+            if sample_count is None:
+                sample = device.sensor_reader.get_latest()
+            else:
+                wait_start = timer()
+                sample = device.sensor_reader.wait_for_sample(sample_count)
+                wait_time = timer() - wait_start
+                waited += wait_time
+                self.metrics.record('serial_wait', wait_time)
+                # the micro:bit missed the deadline, use the last sample received
+                if sample is None:
+                    self.metrics.count('serial_timeouts')
+                    sample = device.sensor_reader.get_latest()
+            # nothing has been received yet
+            if sample is None:
+                continue
+            raw, reply = sample
+
+            # if this reply is not the correct length, just toss it.
+            if len(reply) > 12:
+                self.metrics.count('malformed_replies')
+                continue
+
+            samples.append((device, raw, reply))
+        self.metrics.record('dispatch', timer() - start - waited)
+        return samples
+
+    def handle_display_image(self, data, device=0):
         """
         This method is called when scratch issues a display_image
 
         :param data: image to display
+        :param device: micro:bit number
         """
         # check if this is a translated string
         key = data
@@ -380,54 +602,89 @@ class S2M:
                 key = data[:2]
         if key in self.image_map:
             data = self.image_map[key]
-        self.send_command('d,' + data)
+        self.send_command('d,' + data, device)
 
-    def handle_scroll(self, data):
+    def handle_scroll(self, data, device=0):
         """
         This method is called when scratch issues a scroll command
 
         :param data: text to scroll
+        :param device: micro:bit number
         """
 
         data = self.scratch_fix(data)
-        self.send_command('s,' + data)
+        if self.transliterate_text:
+            # the micro:bit font only has the printable ASCII characters
+            data = transliterate(data)
+        else:
+            # a line break would end the command early
+            data = data.replace('\r', ' ').replace('\n', ' ')
+        self.send_command('s,' + data, device)
 
-    def handle_write_pixel(self, data):
+    def handle_write_pixel(self, data, device=0):
         """
         This method is called when scratch issues a scroll command
         :param data: pixel x coord, pixel y coord, and intensity
+        :param device: micro:bit number
+        """
+        self.send_command('p,' + data, device)
+
+    def handle_display_frame(self, data, device=0):
         """
-        self.send_command('p,' + data)
+        This method is called when scratch issues a display_frame command
+
+        :param data: 25 brightness values (0-9), one row after another.
+                     Rows may be separated by ':'
+        :param device: micro:bit number
+        """
+        frame = self.scratch_fix(data).replace(':', '').replace(',', '').replace(' ', '')
+        if len(frame) != 25 or not frame.isdigit():
+            return
+        try:
+            micro_bit = self.devices[device]
+        except IndexError:
+            # there is no such micro:bit
+            return
+        micro_bit.send_frame(frame)
 
-    def handle_display_clear(self):
+    def handle_display_clear(self, device=0):
         """
         This method is called when scratch issues a clear display command
+        :param device: micro:bit number
         """
 
-        self.send_command('c')
+        self.send_command('c', device)
 
-    def handle_digital_write(self, data):
+    def handle_digital_write(self, data, device=0):
         """
         This method is called when scratch issues a digital write command
         :param data: pin and value
+        :param device: micro:bit number
         """
 
-        self.send_command('t,' + data)
+        self.send_command('t,' + data, device)
 
-    def handle_analog_write(self, data):
+    def handle_analog_write(self, data, device=0):
         """
         This method is called when scratch issues an analog write command
 
         :param data: pin and value
+        :param device: micro:bit number
         """
-        self.send_command('a,' + data)
+        self.send_command('a,' + data, device)
 
-    def handle_reset_all(self):
+    def handle_reset_all(self, device=0):
         """
         This method is called when scratch issues a reset_all command.
-        For now we are just going to ignore this command, but if we
-        decide to process it, uncomment out the code below
+        The micro:bit outputs are left as they are, but the output shadows
+        are cleared so that the next commands are all sent. To reset the
+        outputs as well, uncomment out the code below.
+        :param device: micro:bit number
         """
+        # reset_all is sent when the Scratch stop button is pressed,
+        # so it applies to all of the micro:bits
+        for micro_bit in self.devices:
+            micro_bit.invalidate_shadow()
 
         # set all digital and analog outputs to zero
         # self.send_command('t,0,0')
@@ -442,95 +699,139 @@ class S2M:
 
         # self.send_command('c')
 
-    def build_poll_response(self, data_list):
+    def handle_sensor_mask(self, data, device=0):
         """
-        Build an HTTP response from the raw micro:bit sensor data.
+        This method is called when scratch issues a sensor_mask command.
+        Only the listed reporters are included in the poll response,
+        and the micro:bit only reads the sensors they need.
 
-        :param data_list: raw data received from s2mb.py
-        :return: response string
+        :param data: reporter names, see get_sensor_mask
+        :param device: micro:bit number
+        """
+        mask = get_sensor_mask(self.scratch_fix(data))
+        if mask is None:
+            return
+        try:
+            micro_bit = self.devices[device]
+        except IndexError:
+            # there is no such micro:bit
+            return
+        self.set_sensor_mask(micro_bit, mask)
+
+    def set_sensor_mask(self, device, mask):
         """
+        Select the sensor fields of a micro:bit that are reported to Scratch.
 
-        # reply string
-        reply = ''
+        :param device: MicroBitDevice
+        :param mask: sensor field mask
+        """
+        if mask == device.sensor_mask:
+            return
+        device.set_sensor_mask(mask)
+        # the template is replaced before the cache, see build_poll_response
+        self.poll_templates[device.index] = build_poll_template(device.index, mask)
+        device.poll_cache = {}
+
+    def handle_metrics(self, device=0):
+        """
+        This method is called when a /metrics request is received.
 
-        # build gestures
-        x = int(data_list[0])
-        y = int(data_list[1])
-        z = int(data_list[2])
+        :param device: not used, metrics cover all of the micro:bits
+        :return: metrics as a JSON string
+        """
+        return json.dumps(self.get_metrics(), sort_keys=True)
 
-        # left right
-        if x > 0:
-            right = 'true'
-            left = 'false'
-        else:
-            right = 'false'
-            left = 'true'
+    def get_metrics(self):
+        """
+        :return: snapshot of the request metrics along with
+                 the statistics of each micro:bit's serial link
+        """
+        snapshot = self.metrics.snapshot()
+        snapshot['devices'] = [device.get_stats() for device in self.devices]
+        return snapshot
 
-        # up down
-        if y > 0:
-            up = 'true'
-            down = 'false'
-        else:
-            up = 'false'
-            down = 'true'
+    def build_poll_response(self, data_list, raw=None, device=None, consumer=POLL_CONSUMER):
+        """
+        Build an HTTP response from the raw micro:bit sensor data.
 
-        # Determine difference in z from
-        # from last read to this one.
+        The gestures are reported by the micro:bit's GestureDetector, which
+        has already seen every sample, including this one.
 
-        # if difference is > 2000, define that
-        # as shaken
-        z_diff = abs(z - self.last_z)
-        if z_diff > 2000:
-            reply += 'shaken true\n'
-        else:
-            reply += 'shaken false\n'
-        self.last_z = z
-
-        reply += 'tilted_right ' + right + '\n'
-        reply += 'tilted_left ' + left + '\n'
-        reply += 'tilted_up ' + up + '\n'
-        reply += 'tilted_down ' + down + '\n'
-
-        reply += 'button_a_pressed ' + data_list[3] + '\n'
-        reply += 'button_b_pressed ' + data_list[4] + '\n'
-        reply += 'digital_read/0 ' + data_list[5] + '\n'
-        reply += 'digital_read/1 ' + data_list[6] + '\n'
-        reply += 'digital_read/2 ' + data_list[7] + '\n'
-        reply += 'analog_read/0 ' + data_list[8] + '\n'
-        reply += 'analog_read/1 ' + data_list[9] + '\n'
-        reply += 'analog_read/2 ' + data_list[10] + '\n'
+        When the micro:bit is idle, it keeps sending the same sample, so
+        the encoded responses are cached by raw sample and gesture state.
 
+        :param data_list: raw data received from s2mb.py
+        :param raw: the unsplit sample, used as the cache key.
+                    None to bypass the cache.
+        :param device: the MicroBitDevice that sent the data,
+                       None for the first micro:bit
+        :param consumer: the gesture consumer the response is built for
+        :return: encoded response
+        """
+        if device is None:
+            device = self.devices[0]
+
+        # read the cache before the template, so that a response built with
+        # a template that has just been replaced goes into the old cache
+        poll_cache = device.poll_cache
+        template = self.poll_templates[device.index]
+
+        # shaken and freefall are latched, reading them clears them for this consumer
+        shaken, right, up, freefall = device.gestures.poll(consumer)
+        if right is None:
+            # no samples have been processed, use the tilt of this one
+            try:
+                right = int(data_list[0]) > 0
+                up = int(data_list[1]) > 0
+            except ValueError:
+                # the accelerometer is not being read
+                right = up = False
+
+        cache_key = (raw, shaken, right, up, freefall)
+        if raw is not None:
+            reply = poll_cache.get(cache_key)
+            if reply is not None:
+                return reply
+
+        reply = template.format(shaken=BOOLEAN_TEXT[shaken],
+                                freefall=BOOLEAN_TEXT[freefall],
+                                right=BOOLEAN_TEXT[right],
+                                left=BOOLEAN_TEXT[not right],
+                                up=BOOLEAN_TEXT[up],
+                                down=BOOLEAN_TEXT[not up],
+                                fields=data_list).encode()
+
+        if raw is not None:
+            # noisy analog inputs produce a stream of unique samples,
+            # so start over rather than letting the cache grow
+            if len(poll_cache) >= POLL_CACHE_SIZE:
+                poll_cache.clear()
+            poll_cache[cache_key] = reply
         return reply
 
-    def send_command(self, command):
+    def send_command(self, command, device=0):
         """
-        Send a command to the micro:bit over the serial interface
+        Send a command to a micro:bit over the serial interface
         :param command: command sent to micro:bit
-        :return: If the command is a poll request, return the poll response
+        :param device: micro:bit number
+        :return: If the command is a poll request, return the poll response,
+                 or None if the micro:bit did not reply in time
         """
-
         try:
-            cmd = command + '\n'
-            self.micro_bit_serial.write(cmd.encode())
-        except serial.SerialTimeoutException:
-            return command
-
-        # wait for reply
-
-        # read and decode a line and strip it of trailing \r\n
-
-        if command == 'g':
-            while not self.micro_bit_serial.inWaiting():
-                pass
-            # noinspection PyArgumentList
-            data = self.micro_bit_serial.readline().decode().strip()
-            return data
+            micro_bit = self.devices[device]
+        except IndexError:
+            # there is no such micro:bit
+            return None
+        return micro_bit.send_command(command)
 
     def all_done(self):
         """
-        Kill the scratch process
+        Stop the micro:bits and kill the scratch process
         :return:
         """
+        self.devices.stop()
+        if self.recorder:
+            self.recorder.stop()
         if self.scratch_pid:
             proc = psutil.Process(self.scratch_pid)
             proc.kill()
@@ -538,36 +839,40 @@ class S2M:
     def scratch_fix(self, sst):
         """
         Scratch has a bug when presenting string. This method
-        compensates for that bug
+        compensates for that bug. The whole string is percent decoded
+        to bytes in one pass and then decoded as UTF-8, so characters
+        that take several bytes are kept whole.
         :param sst: String to be scanned and fixed
-        :return:
+        :return: the decoded text
         """
-
-        result = ''
-        x = 0
-        while x < len(sst):
-            if sst[x] == '%':
-                sx = sst[x + 1] + sst[x + 2]
-                z = binascii.unhexlify(sx)
-                try:
-                    result += z.decode("utf-8")
-                except UnicodeDecodeError:
-                    print('Warning: Scroll text must be in Roman characters')
-                    return 'Scroll text must be in Roman characters'
-                x += 3
-            else:
-                result += sst[x]
-                x += 1
-        return result
+        data = unquote_to_bytes(sst)
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            print('Warning: Scroll text is not valid UTF-8')
+            return data.decode('utf-8', 'replace')
 
 
 def main():
     # parser = argparse.ArgumentParser()
     parser = argparse.ArgumentParser(description='s2m', formatter_class=RawTextHelpFormatter)
+    parser.add_argument("-a", dest="poll_max_age", default="0",
+                        help="Answer polls with sensor data up to this many milliseconds old\n"
+                             "- e.g. 20. 0 = only share a fetch that is in progress (default)")
     parser.add_argument("-b", dest="base_path", default="None",
                         help="Python File Path - e.g. /usr/local/lib/python3.5/dist-packages/s2m")
     parser.add_argument("-c", dest="client", default="scratch", help="default = scratch [scratch | no_client]")
     parser.add_argument("-d", dest="display", default="None", help='Show base path - set to "true"')
+    parser.add_argument("-e", dest="engine", default="threaded",
+                        help="HTTP server engine - default = threaded [threaded | single]")
+    parser.add_argument("-f", dest="record_file", default="None",
+                        help="Record the sensor samples and commands to this file - e.g. session.s2ml")
+    parser.add_argument("-g", dest="deadbands", default="None",
+                        help="Only send the sensor values that change by more than this\n"
+                             "- accelerometer milli-g,analog - e.g. 40,8 - default = send every value")
+    parser.add_argument("-k", dest="keep_text", default="None",
+                        help='Scroll text as sent, without replacing the characters\n'
+                             'the micro:bit cannot display - set to "true"')
     parser.add_argument("-l", dest="language", default="0",
                         help="Select Language: \n0 = English(default)\n1 or ja = Japanese\n" \
                              "2 or ko = Korean\n3 or tw = Traditional Chinese" \
@@ -577,9 +882,32 @@ def main():
                              "\n7 or es = Spanish" \
                              "\n8 or ess = Spanish Sample Project" \
                              "\n9 or heb = Hebrew")
-    parser.add_argument("-p", dest="comport", default="None", help="micro:bit COM port - e.g. /dev/ttyACMO or COM3")
+    parser.add_argument("-m", dest="metrics_interval", default="0",
+                        help="Print a metrics summary every n seconds - e.g. 60\n0 = never (default)")
+    parser.add_argument("-n", dest="device_count", default="1",
+                        help="Number of micro:bits to autodetect - default = 1")
+    parser.add_argument("-o", dest="websocket", default="None",
+                        help='Push sensor data to WebSocket clients at ws://localhost:50209/ws\n'
+                             '- set to "true"')
+    parser.add_argument("-p", dest="comport", default="None",
+                        help="micro:bit COM port - e.g. /dev/ttyACMO or COM3\n"
+                             "Separate several ports with commas - e.g. /dev/ttyACM0,/dev/ttyACM1")
+    parser.add_argument("-q", dest="sensors", default="all",
+                        help="Sensor reporters used by the project, the others are not read\n"
+                             "- e.g. button_a_pressed,analog_read/0 - default = all")
     parser.add_argument("-r", dest="rpi", default="None", help="Set to TRUE to run on a Raspberry Pi")
     parser.add_argument("-s", dest="scratch_exec", default="default", help="Full path to Scratch executable")
+    parser.add_argument("-t", dest="stream_interval", default="0",
+                        help="Sensor streaming interval in milliseconds - e.g. 30\n0 = poll the micro:bit (default)")
+    parser.add_argument("-u", dest="baud_rate", default="auto",
+                        help="Fastest serial baud rate to switch to - e.g. 460800\n"
+                             "115200 = do not switch - default = auto (fastest that works)")
+    parser.add_argument("-w", dest="wire_protocol", default="ascii",
+                        help="micro:bit serial wire protocol - default = ascii [ascii | binary]")
+    parser.add_argument("-x", dest="replay_speed", default="1",
+                        help="Replay speed - e.g. 2 replays twice as fast as recorded - default = 1")
+    parser.add_argument("-y", dest="replay_file", default="None",
+                        help="Replay a recorded session instead of using a micro:bit")
 
     args = parser.parse_args()
 
@@ -608,13 +936,80 @@ def main():
 
     scratch_exec = args.scratch_exec
 
+    engine = args.engine
+    if engine not in ['threaded', 'single']:
+        engine = 'threaded'
+
+    try:
+        device_count = int(args.device_count)
+    except ValueError:
+        device_count = 1
+    if device_count < 1:
+        device_count = 1
+
+    wire_protocol = args.wire_protocol
+    if wire_protocol not in ['ascii', 'binary']:
+        wire_protocol = 'ascii'
+
+    try:
+        stream_interval = int(args.stream_interval)
+    except ValueError:
+        stream_interval = 0
+    if stream_interval < 0:
+        stream_interval = 0
+
+    try:
+        metrics_interval = float(args.metrics_interval)
+    except ValueError:
+        metrics_interval = 0
+    if metrics_interval < 0:
+        metrics_interval = 0
+
+    transliterate_text = args.keep_text == 'None'
+
+    websocket = args.websocket != 'None'
+
+    sensor_mask = get_sensor_mask(args.sensors)
+    if sensor_mask is None:
+        sensor_mask = ALL_FIELDS
+
+    deadbands = None if args.deadbands == 'None' else get_deadbands(args.deadbands)
+
+    try:
+        max_baud_rate = None if args.baud_rate == 'auto' else int(args.baud_rate)
+    except ValueError:
+        max_baud_rate = None
+
+    record_file = None if args.record_file == 'None' else args.record_file
+    replay_file = None if args.replay_file == 'None' else args.replay_file
+
+    try:
+        poll_max_age = float(args.poll_max_age) / 1000
+    except ValueError:
+        poll_max_age = 0
+    if poll_max_age < 0:
+        poll_max_age = 0
+
+    try:
+        replay_speed = float(args.replay_speed)
+    except ValueError:
+        replay_speed = 1
+    if replay_speed <= 0:
+        replay_speed = 1
+
     if args.rpi != 'None':
         # wait_time = 15
         scratch_exec = '/usr/bin/scratch2'
 
     # start s2m
     S2M(client=client_type, com_port=comport, scratch_executable=scratch_exec,
-        base_path=user_base_path, display_base_path=display, language=lang)
+        base_path=user_base_path, display_base_path=display, language=lang,
+        stream_interval=stream_interval, engine=engine, wire_protocol=wire_protocol,
+        device_count=device_count, metrics_interval=metrics_interval,
+        record_file=record_file, replay_file=replay_file, replay_speed=replay_speed,
+        transliterate_text=transliterate_text, poll_max_age=poll_max_age,
+        sensor_mask=sensor_mask, deadbands=deadbands, max_baud_rate=max_baud_rate,
+        websocket=websocket)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,196 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import threading
+from array import array
+
+# number of accelerometer samples kept
+HISTORY_SIZE = 32
+
+# the board is shaken when the acceleration changes by more than this
+# many milli-g over SHAKE_WINDOW samples, summed over all three axes
+SHAKE_THRESHOLD = 2000
+SHAKE_WINDOW = 4
+
+# a tilt flag only flips once the acceleration has passed zero by
+# this many milli-g, so a board lying flat does not flicker
+TILT_HYSTERESIS = 100
+
+# the board is falling when the total acceleration stays below
+# this many milli-g for FREEFALL_SAMPLES samples in a row
+FREEFALL_THRESHOLD = 400
+FREEFALL_SAMPLES = 3
+
+# the consumer that Scratch's polls report the gestures to
+POLL_CONSUMER = 'poll'
+
+
+class AccelerometerHistory:
+    """
+    A fixed size ring buffer of the most recent accelerometer samples.
+    Each axis is kept in its own array of shorts.
+    """
+
+    def __init__(self, size=HISTORY_SIZE):
+        """
+        :param size: number of samples kept
+        """
+        self.size = size
+        self.x = array('h', [0] * size)
+        self.y = array('h', [0] * size)
+        self.z = array('h', [0] * size)
+
+        # index of the newest sample and number of samples kept
+        self.newest = -1
+        self.count = 0
+
+    def append(self, x, y, z):
+        """
+        Add a sample, replacing the oldest one if the buffer is full.
+        """
+        self.newest = (self.newest + 1) % self.size
+        self.x[self.newest] = x
+        self.y[self.newest] = y
+        self.z[self.newest] = z
+        if self.count < self.size:
+            self.count += 1
+
+    def get(self, age):
+        """
+        :param age: 0 for the newest sample, 1 for the one before it, and so on
+        :return: the sample as an (x, y, z) tuple
+        """
+        index = (self.newest - age) % self.size
+        return self.x[index], self.y[index], self.z[index]
+
+    def get_change(self, age):
+        """
+        :param age: age of a sample, see get
+        :return: sum over the axes of the change from the sample before it
+        """
+        index = (self.newest - age) % self.size
+        previous = index - 1
+        return (abs(self.x[index] - self.x[previous]) +
+                abs(self.y[index] - self.y[previous]) +
+                abs(self.z[index] - self.z[previous]))
+
+    def __len__(self):
+        return self.count
+
+
+class GestureDetector:
+    """
+    Detects shakes, tilts and free falls from every accelerometer sample
+    received, whether it was polled for or streamed by the micro:bit.
+
+    Shakes and free falls are latched: once detected, they are reported by
+    the next call to poll, so a gesture that happens between two Scratch
+    polls is not lost. Each consumer of the gestures, e.g. Scratch's polls
+    and the WebSocket pushes, has its own latch, so one consumer reading
+    an event does not hide it from the others. Each sample is processed
+    in constant time.
+    """
+
+    def __init__(self):
+        self.history = AccelerometerHistory()
+
+        # sum of the changes over the last SHAKE_WINDOW samples
+        self.window_change = 0
+
+        # True while the window is over the shake threshold, so that
+        # one shake is only reported once
+        self.shaking = False
+
+        # tilt flags, None until the first sample arrives
+        self.right = None
+        self.up = None
+
+        # number of samples in a row that were in free fall
+        self.falling_samples = 0
+
+        # number of shakes and free falls detected, and for each consumer,
+        # the numbers that had been detected when it last polled
+        self.shakes = 0
+        self.freefalls = 0
+        self.reported = {}
+
+        self.lock = threading.Lock()
+
+    def add_sample(self, fields):
+        """
+        Process a sensor sample. Called by the sensor reader thread.
+
+        :param fields: sensor fields as received from s2mb.py,
+                       starting with the x, y and z acceleration
+        """
+        try:
+            x = int(fields[0])
+            y = int(fields[1])
+            z = int(fields[2])
+        except (IndexError, ValueError):
+            return
+
+        with self.lock:
+            history = self.history
+            history.append(x, y, z)
+
+            # keep a running sum of the changes in the window: add the
+            # newest change and remove the one that has left the window
+            if len(history) > 1:
+                self.window_change += history.get_change(0)
+                if len(history) > SHAKE_WINDOW + 1:
+                    self.window_change -= history.get_change(SHAKE_WINDOW)
+                shaking = self.window_change > SHAKE_THRESHOLD
+                if shaking and not self.shaking:
+                    self.shakes += 1
+                self.shaking = shaking
+
+            if self.right is None:
+                self.right = x > 0
+                self.up = y > 0
+            else:
+                if self.right and x < -TILT_HYSTERESIS:
+                    self.right = False
+                elif not self.right and x > TILT_HYSTERESIS:
+                    self.right = True
+                if self.up and y < -TILT_HYSTERESIS:
+                    self.up = False
+                elif not self.up and y > TILT_HYSTERESIS:
+                    self.up = True
+
+            if x * x + y * y + z * z < FREEFALL_THRESHOLD * FREEFALL_THRESHOLD:
+                self.falling_samples += 1
+                if self.falling_samples >= FREEFALL_SAMPLES:
+                    self.freefalls += 1
+            else:
+                self.falling_samples = 0
+
+    def poll(self, consumer=POLL_CONSUMER):
+        """
+        Report the gesture state and clear the consumer's latched events.
+
+        :param consumer: name of the consumer, e.g. POLL_CONSUMER
+        :return: (shaken, tilted right, tilted up, free fall) tuple.
+                 shaken and free fall are True if the event has happened
+                 since the consumer last polled. The tilt flags are None
+                 if no sample has been received.
+        """
+        with self.lock:
+            shakes, freefalls = self.reported.get(consumer, (0, 0))
+            state = (self.shakes != shakes, self.right, self.up, self.freefalls != freefalls)
+            self.reported[consumer] = (self.shakes, self.freefalls)
+        return state
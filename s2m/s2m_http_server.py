@@ -15,14 +15,28 @@
  Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
 
+import socket
 import sys
 
+try:
+    # for python 3
+    from s2m.s2m_metrics import timer
+    from s2m.s2m_websocket import WebSocketSession, accept_key
+except ImportError:
+    # for python 2
+    # noinspection PyUnresolvedReferences
+    from s2m_metrics import timer
+    # noinspection PyUnresolvedReferences
+    from s2m_websocket import WebSocketSession, accept_key
+
 try:
     # for python2
     # noinspection PyCompatibility,PyUnresolvedReferences
     from BaseHTTPServer import BaseHTTPRequestHandler
     # noinspection PyCompatibility
     from BaseHTTPServer import HTTPServer
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from SocketServer import ThreadingMixIn
 
 except ImportError:
     # for python3
@@ -30,6 +44,58 @@ except ImportError:
     from http.server import BaseHTTPRequestHandler
     # noinspection PyCompatibility,PyUnresolvedReferences
     from http.server import HTTPServer
+    # noinspection PyCompatibility,PyUnresolvedReferences
+    from socketserver import ThreadingMixIn
+
+
+# the characters of a micro:bit number at the start of a request path
+DIGITS = '0123456789'
+
+
+# Argument adapters. Each one wraps a command handler in a function that
+# takes the command list built from the URL (the command name followed
+# by its parameters) and the micro:bit number. They are applied once,
+# when a command is registered. The micro:bit number is passed to the
+# handler as its device keyword argument.
+
+def no_params(handler):
+    """
+    Adapter for commands that take no parameters.
+
+    :param handler: command handler
+    :return: function that calls the handler with no arguments
+    """
+    return lambda cmd_list, device: handler(device=device)
+
+
+def single_param(handler):
+    """
+    Adapter for commands that take one parameter.
+
+    :param handler: command handler
+    :return: function that calls the handler with the first parameter
+    """
+    return lambda cmd_list, device: handler(cmd_list[1], device=device)
+
+
+def joined_params(handler):
+    """
+    Adapter for commands whose parameters are passed to
+    s2mb.py as a comma delimited string.
+
+    :param handler: command handler
+    :return: function that calls the handler with the joined parameters
+    """
+    return lambda cmd_list, device: handler(",".join(cmd_list[1:]), device=device)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server that handles each Scratch request in its own thread,
+    so that a slow poll does not hold up the commands queued behind it.
+    Serial port access is serialized by the s2m reader and writer threads.
+    """
+    daemon_threads = True
 
 
 # noinspection PyMethodMayBeStatic,PyUnresolvedReferences
@@ -44,15 +110,158 @@ class GetHandler(BaseHTTPRequestHandler):
     # noinspection PyMethodParameters
     s2m = None
 
+    # use HTTP/1.1 so that Scratch can reuse its connection between requests
+    protocol_version = 'HTTP/1.1'
+
+    # close idle persistent connections after this many seconds
+    timeout = 60
+
+    # True to keep connections open between requests
+    keep_alive = True
+
+    # the response headers are the same for every request except for the
+    # content length, so they are built once and the length is appended
+    keep_alive_header = ('HTTP/1.1 200 OK\r\n'
+                         'Content-Type: text/html; charset=utf-8\r\n'
+                         'Access-Control-Allow-Origin: *\r\n'
+                         'Connection: keep-alive\r\n'
+                         'Content-Length: ').encode()
+
+    close_header = ('HTTP/1.1 200 OK\r\n'
+                    'Content-Type: text/html; charset=utf-8\r\n'
+                    'Access-Control-Allow-Origin: *\r\n'
+                    'Connection: close\r\n'
+                    'Content-Length: ').encode()
+
+    # the same headers for the commands that return JSON
+    json_keep_alive_header = ('HTTP/1.1 200 OK\r\n'
+                              'Content-Type: application/json; charset=utf-8\r\n'
+                              'Access-Control-Allow-Origin: *\r\n'
+                              'Connection: keep-alive\r\n'
+                              'Content-Length: ').encode()
+
+    json_close_header = ('HTTP/1.1 200 OK\r\n'
+                         'Content-Type: application/json; charset=utf-8\r\n'
+                         'Access-Control-Allow-Origin: *\r\n'
+                         'Connection: close\r\n'
+                         'Content-Length: ').encode()
+
+    # maps each Scratch command name to its adapted handler
+    commands = {}
+
+    # the names of the commands whose responses are JSON
+    json_commands = set()
+
     @classmethod
-    def set_items(cls, s2m):
+    def set_items(cls, s2m, keep_alive=True):
         """
         This class method allows setting of some class variables
         :param s2m:
+        :param keep_alive: keep connections open between requests
         :return:
         """
         # create a reference to the s2m class
         cls.s2m = s2m
+        cls.keep_alive = keep_alive
+
+        # build the command dispatch table. Commands that were registered
+        # before the server started take precedence over these.
+        default_commands = [('display_image', s2m.handle_display_image, single_param),
+                            ('scroll', s2m.handle_scroll, single_param),
+                            ('write_pixel', s2m.handle_write_pixel, joined_params),
+                            ('display_frame', s2m.handle_display_frame, joined_params),
+                            ('display_clear', s2m.handle_display_clear, no_params),
+                            ('digital_write', s2m.handle_digital_write, joined_params),
+                            ('analog_write', s2m.handle_analog_write, joined_params),
+                            ('reset_all', s2m.handle_reset_all, no_params),
+                            ('sensor_mask', s2m.handle_sensor_mask, joined_params)]
+        for name, handler, adapter in default_commands:
+            if name not in cls.commands:
+                cls.register_command(name, handler, adapter)
+        if 'metrics' not in cls.commands:
+            cls.register_command('metrics', s2m.handle_metrics, no_params, json_response=True)
+
+    @classmethod
+    def register_command(cls, name, handler, adapter=joined_params, json_response=False):
+        """
+        Add a command to the dispatch table, or replace an existing one.
+
+        :param name: command name as it appears in the URL, e.g. display_image
+        :param handler: command handler. It is called with a device keyword
+                        argument holding the micro:bit number. Its return
+                        value is sent to Scratch, None is sent as ok.
+        :param adapter: converts the command list into the handler's
+                        arguments - no_params, single_param, joined_params
+                        or a function of the same form
+        :param json_response: True if the handler returns JSON, so that
+                              it is sent as application/json
+        """
+        cls.commands[name] = adapter(handler)
+        if json_response:
+            cls.json_commands.add(name)
+        else:
+            cls.json_commands.discard(name)
+
+    @staticmethod
+    def parse_command(path):
+        """
+        Split a request path into the command list and the micro:bit number.
+
+        :param path: e.g. /display_image/HAPPY. A leading number selects the
+                     micro:bit a command is sent to, e.g. /1/display_image/HAPPY.
+        :return: (command list, micro:bit number) tuple
+        """
+        # skip over the / in the command
+        if path[:1] == '/':
+            path = path[1:]
+
+        # create a list containing the command and all of its parameters
+        cmd_list = str.split(path, '/')
+
+        # only ASCII digits select a micro:bit. str.isdigit also accepts
+        # characters such as superscripts, which int() rejects.
+        device = 0
+        if cmd_list[0] and not cmd_list[0].strip(DIGITS):
+            device = int(cmd_list.pop(0))
+            if not cmd_list:
+                cmd_list = ['']
+        return cmd_list, device
+
+    @classmethod
+    def dispatch(cls, cmd_list, device=0):
+        """
+        Look up the handler for a command in the dispatch table and run it.
+
+        :param cmd_list: the command name followed by its parameters
+        :param device: micro:bit number
+        :return: the handler's response, None for ok
+        """
+        command = cls.commands.get(cmd_list[0])
+
+        # received an unknown command
+        if command is None:
+            cls.s2m.metrics.count('unknown_commands')
+            return 'OK'
+
+        cls.s2m.metrics.count('commands')
+        start = timer()
+        try:
+            resp = command(cmd_list, device)
+        except IndexError:
+            # a required parameter is missing
+            resp = 'OK'
+        cls.s2m.metrics.record('dispatch', timer() - start)
+        return resp
+
+    def parse_request(self):
+        """
+        Parse the request line and headers, timing how long it takes.
+        :return: True if the request is valid
+        """
+        start = timer()
+        valid = BaseHTTPRequestHandler.parse_request(self)
+        self.s2m.metrics.record('http_parse', timer() - start)
+        return valid
 
     # noinspection PyPep8Naming
     def do_GET(self):
@@ -61,128 +270,124 @@ class GetHandler(BaseHTTPRequestHandler):
         :return: None
         """
 
-        # skip over the / in the command
-        cmd = self.path[1:]
+        # polls always report all micro:bits
+        cmd_list, device = self.parse_command(self.path)
 
-        # create a list containing the command and all of its parameters
-        cmd_list = str.split(cmd, '/')
+        self.s2m.metrics.count('requests')
 
         # add the poll or command to the appropriate deque
         # and send an HTTP response to Scratch
-        if cmd_list[0] == 'poll':
-            if self.s2m.ignore_poll:
-                self.send_resp('ok')
-            else:
-                self.send_resp(self.s2m.handle_poll())
-                self.s2m.ignore_poll = False
+        if cmd_list[0] == 'ws' and self.headers.get('Upgrade', '').lower() == 'websocket':
+            self.handle_websocket()
+        elif cmd_list[0] == 'poll':
+            self.s2m.metrics.count('polls')
+            self.send_resp(self.s2m.handle_poll())
         else:
             # self.s2m.command_deque.append(cmd_list)
-            self.process_command(cmd_list)
+            self.process_command(cmd_list, device)
 
     # we can't use the standard send_response since we don't conform to its
     # standards, so we craft our own response handler here
-    def send_resp(self, response):
+    def send_resp(self, response, json_response=False):
         """
         This method sends Scratch an HTTP response to an HTTP GET command.
-        :param response: Response string sent to Scratch
+        The headers and body are sent with a single write.
+        :param response: Response string or bytes sent to Scratch
+        :param json_response: True to send the response as application/json
         :return: None
         """
 
+        if response is None:
+            # commands do not return any data, so just reply with ok
+            response = 'ok'
         try:
-            slen = str(len(response))
-        except TypeError:
+            # poll responses arrive already encoded
+            if not isinstance(response, bytes):
+                response = response.encode('utf-8')
+            body = response + b'\r\n'
+        except (TypeError, AttributeError):
             # in case of any error, just reply with ok and continue on
-            response = 'ok'
-            slen = str(len(response))
-        crlf = "\r\n"
-        http_response = "HTTP/1.1 200 OK" + crlf
-        http_response += "Content-Type: text/html; charset=ISO-8859-1" + crlf
-        http_response += "Content-Length" + slen + crlf
-        http_response += "Access-Control-Allow-Origin: *" + crlf
-        http_response += crlf
-        # add the response to the nonsense above
-        http_response += str(response + crlf)
+            body = b'ok\r\n'
+
+        if self.keep_alive and not self.close_connection:
+            header = self.json_keep_alive_header if json_response else self.keep_alive_header
+        else:
+            header = self.json_close_header if json_response else self.close_header
+            self.close_connection = True
+
         # send it out the door to Scratch
+        start = timer()
         try:
-            self.wfile.write(http_response.encode())
-        except ConnectionResetError:
-            pass
+            self.wfile.write(header + str(len(body)).encode() + b'\r\n\r\n' + body)
+        except socket.error:
+            self.close_connection = True
+        self.s2m.metrics.record('response_write', timer() - start)
         # end of GetHandler class
 
-    def process_command(self, cmd_list):
+    def process_command(self, cmd_list, device=0):
         """
-        This method provides processing for each command. It translates the
-        Scratch command into a command that matches the s2mb.py file
-        loaded onto the micro:bit.
+        This method provides processing for each command. The handler from
+        the dispatch table translates the Scratch command into a command that
+        matches the s2mb.py file loaded onto the micro:bit, and then an HTTP
+        reply is sent to Scratch.
         :param cmd_list:
+        :param device: micro:bit number
         :return:
         """
-        cmd = cmd_list[0]
-
-        # process commands
-
-        # create a display image command, send it to
-        # the micro:bit and send an HTTP reply to Scratch
-        if cmd == 'display_image':
-            resp = self.s2m.handle_display_image(cmd_list[1])
-            self.send_resp(resp)
-
-        # create a scroll command, send it to
-        # the micro:bit and send an HTTP reply to Scratch
-        elif cmd == 'scroll':
-            resp = self.s2m.handle_scroll(cmd_list[1])
-            self.send_resp(resp)
-
-        # create a write pixel command, send it to
-        # the micro:bit and send an HTTP reply to Scratch
-        elif cmd == 'write_pixel':
-            params = cmd_list[1:]
-            cmd_params = ",".join(params)
-            resp = self.s2m.handle_write_pixel(cmd_params)
-            self.send_resp(resp)
-
-        # create a clear display command, send it to
-        # the micro:bit and send an HTTP reply to Scratch
-        elif cmd == 'display_clear':
-            resp = self.s2m.handle_display_clear()
-            self.send_resp(resp)
-
-        # create a digital write command, send it to
-        # the micro:bit and send an HTTP reply to Scratch
-        elif cmd == 'digital_write':
-            params = cmd_list[1:]
-            cmd_params = ",".join(params)
-            resp = self.s2m.handle_digital_write(cmd_params)
-            self.send_resp(resp)
-
-        # create a analog write command, send it to
-        # the micro:bit and send an HTTP reply to Scratch
-        elif cmd == 'analog_write':
-            params = cmd_list[1:]
-            cmd_params = ",".join(params)
-            resp = self.s2m.handle_analog_write(cmd_params)
-            self.send_resp(resp)
-
-        elif cmd == 'reset_all':
-            resp = self.s2m.handle_reset_all()
-            self.send_resp(resp)
-
-        # received an unknown command, just send a response to Scratch
-        else:
-            self.send_resp('OK')
+        self.send_resp(self.dispatch(cmd_list, device), cmd_list[0] in self.json_commands)
+
+    def handle_websocket(self):
+        """
+        Switch the connection over to the WebSocket protocol and serve
+        it until the client disconnects.
+        :return: None
+        """
+        broadcaster = self.s2m.broadcaster
+        key = self.headers.get('Sec-WebSocket-Key')
+        if broadcaster is None:
+            self.send_error(404, 'WebSocket connections are not enabled')
+            return
+        if not key or self.headers.get('Sec-WebSocket-Version') != '13':
+            self.send_error(400, 'Unsupported WebSocket handshake')
+            return
+
+        self.s2m.metrics.count('websockets')
+        self.wfile.write(('HTTP/1.1 101 Switching Protocols\r\n'
+                          'Upgrade: websocket\r\n'
+                          'Connection: Upgrade\r\n'
+                          'Sec-WebSocket-Accept: ' + accept_key(key) + '\r\n\r\n').encode())
+
+        # the client may be quiet for a long time, only pushes go out
+        self.connection.settimeout(None)
+        session = WebSocketSession(self)
+        broadcaster.add(session)
+        try:
+            session.serve()
+        finally:
+            broadcaster.remove(session)
+            self.close_connection = True
 
 
-def start_server(handler):
+def start_server(handler, engine='threaded'):
     """
     This function populates class variables with essential data and
     instantiates the HTTP Server
     :param handler:
+    :param engine: threaded to handle requests concurrently,
+                   single to handle them one at a time
     :return: none.
     """
 
-    GetHandler.set_items(handler)
+    # a single threaded server can only serve one connection at a time,
+    # so it must not let a persistent connection block the others
+    if engine == 'single':
+        server_class = HTTPServer
+        GetHandler.set_items(handler, keep_alive=False)
+    else:
+        server_class = ThreadedHTTPServer
+        GetHandler.set_items(handler)
     try:
-        server = HTTPServer(('localhost', 50209), GetHandler)
+        server = server_class(('localhost', 50209), GetHandler)
         print('Starting HTTP Server!')
         print('Use <Ctrl-C> to exit the extension.')
         print('Please make sure you save your Scratch project BEFORE pressing Ctrl-C.\n')
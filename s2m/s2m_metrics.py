@@ -0,0 +1,164 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import threading
+import time
+
+try:
+    # for python3, a high resolution clock
+    from time import perf_counter as timer
+except ImportError:
+    # for python2
+    from time import time as timer
+
+# the phases of a request that are timed
+#   http_parse     - parsing the request line and headers
+#   dispatch       - running the command or building the poll response
+#   serial_write   - writing to the micro:bit serial port
+#   serial_wait    - waiting for the micro:bit to reply to a poll
+#   response_write - sending the HTTP response to Scratch
+PHASES = ('http_parse', 'dispatch', 'serial_write', 'serial_wait', 'response_write')
+
+# the events that are counted
+#   requests          - HTTP requests and WebSocket messages received
+#   polls             - polls received
+#   shared_polls      - polls answered with sensor data fetched for another poll
+#   commands          - commands dispatched
+#   unknown_commands  - requests for commands that are not in the dispatch table
+#   serial_timeouts   - polls the micro:bit did not reply to in time
+#   malformed_replies - sensor replies with too many fields
+#   degraded_polls    - polls answered with the last sample of a disconnected micro:bit
+#   disconnects       - serial links that failed
+#   reconnects        - micro:bits found again after a failure
+#   websockets        - WebSocket connections accepted
+#   pushes            - sensor changes pushed to the WebSocket clients
+COUNTERS = ('requests', 'polls', 'shared_polls', 'commands', 'unknown_commands',
+            'serial_timeouts', 'malformed_replies', 'degraded_polls',
+            'disconnects', 'reconnects', 'websockets', 'pushes')
+
+
+class Metrics:
+    """
+    Counters and phase timings for the request path. Recording a value
+    only takes a lock and a few additions, so it is always enabled.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+        # for each phase: number of samples, total seconds and maximum seconds
+        self.timings = dict((phase, [0, 0.0, 0.0]) for phase in PHASES)
+
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        """
+        Add to a counter.
+
+        :param name: one of COUNTERS
+        :param amount: amount to add
+        """
+        with self.lock:
+            self.counters[name] += amount
+
+    def record(self, phase, seconds):
+        """
+        Add a timing sample.
+
+        :param phase: one of PHASES
+        :param seconds: time spent in the phase, measured with timer()
+        """
+        with self.lock:
+            timing = self.timings[phase]
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+
+    def snapshot(self):
+        """
+        :return: dictionary of the counters and, for each phase, the sample
+                 count and the total, mean and maximum time in milliseconds
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            timings = dict((phase, list(timing)) for phase, timing in self.timings.items())
+
+        phases = {}
+        for phase, (samples, total, maximum) in timings.items():
+            phases[phase] = {'count': samples,
+                             'total_ms': round(total * 1000, 3),
+                             'mean_ms': round(total * 1000 / samples, 3) if samples else 0,
+                             'max_ms': round(maximum * 1000, 3)}
+        return {'uptime': round(time.time() - self.start_time, 1),
+                'counters': counters,
+                'phases': phases}
+
+
+def format_summary(previous, current):
+    """
+    Build a one line summary of what happened between two snapshots.
+
+    :param previous: earlier snapshot, or None to summarize from the start
+    :param current: later snapshot
+    :return: summary string
+    """
+    def delta(section, name, field=None):
+        now = current[section][name]
+        then = previous[section][name] if previous else 0
+        if field:
+            now = now[field]
+            then = then[field] if previous else 0
+        return now - then
+
+    counters = ', '.join('{} {}'.format(name.replace('_', ' '), delta('counters', name))
+                         for name in COUNTERS)
+
+    phases = []
+    for phase in PHASES:
+        samples = delta('phases', phase, 'count')
+        if samples:
+            mean = delta('phases', phase, 'total_ms') / samples
+            phases.append('{} {:.3f}'.format(phase.replace('_', ' '), mean))
+    if phases:
+        return '{} | mean ms: {}'.format(counters, ', '.join(phases))
+    return counters
+
+
+class MetricsReporter(threading.Thread):
+    """
+    Prints a summary of the metrics to the console at a regular interval.
+    """
+
+    def __init__(self, source, interval):
+        """
+        :param source: function that returns a metrics snapshot
+        :param interval: seconds between summaries
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.source = source
+        self.interval = interval
+
+    def run(self):
+        previous = None
+        while True:
+            time.sleep(self.interval)
+            current = self.source()
+            print('metrics: ' + format_summary(previous, current))
+            previous = current
@@ -0,0 +1,317 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# Recording and replay of s2m sessions.
+#
+# A session log starts with LOG_MAGIC and is followed by records. Each
+# record is a RECORD_HEADER - milliseconds since the recording started,
+# record type, micro:bit number and payload length - and the payload:
+#
+#   VERSION_RECORD        s2mb.py version string, when a micro:bit is started
+#   ASCII_SAMPLE_RECORD   sensor line received with the ASCII wire protocol
+#   BINARY_SAMPLE_RECORD  sensor packet received with the binary wire protocol
+#   COMMAND_RECORD        command sent to the micro:bit
+#
+# To print a log:  python -m s2m.s2m_recorder session.s2ml
+
+import struct
+import sys
+import threading
+import time
+
+try:
+    # for python 3
+    from s2m.s2m_metrics import timer
+    from s2m.s2m_serial import MicroBitDevice, SensorReader, unpack_sensor_packet
+except ImportError:
+    # for python 2
+    # noinspection PyUnresolvedReferences
+    from s2m_metrics import timer
+    # noinspection PyUnresolvedReferences
+    from s2m_serial import MicroBitDevice, SensorReader, unpack_sensor_packet
+
+LOG_MAGIC = b'S2ML\x01'
+RECORD_HEADER = struct.Struct('<IBBH')
+
+VERSION_RECORD = ord('V')
+ASCII_SAMPLE_RECORD = ord('A')
+BINARY_SAMPLE_RECORD = ord('B')
+COMMAND_RECORD = ord('C')
+
+# seconds between writes of the buffered records to the log
+FLUSH_INTERVAL = .5
+
+# write early if this many bytes are buffered
+FLUSH_SIZE = 65536
+
+
+class Recorder(threading.Thread):
+    """
+    Logs sensor samples and commands to a session log.
+
+    Records are packed into a memory buffer, and this thread writes the
+    buffer to the file every FLUSH_INTERVAL seconds, so the threads that
+    record never wait for the disk.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: log file name. An existing file is replaced.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.path = path
+        self.log_file = open(path, 'wb')
+        self.log_file.write(LOG_MAGIC)
+
+        self.start_time = timer()
+        self.buffer = bytearray()
+
+        # number of records logged
+        self.records = 0
+
+        self.lock = threading.Lock()
+        self.buffer_ready = threading.Condition(self.lock)
+        self.running = True
+
+    def record(self, record_type, device, payload):
+        """
+        Add a record to the buffer.
+
+        :param record_type: one of the record types above
+        :param device: micro:bit number
+        :param payload: record data as bytes
+        """
+        milliseconds = int((timer() - self.start_time) * 1000)
+        header = RECORD_HEADER.pack(milliseconds, record_type, device, len(payload))
+        with self.buffer_ready:
+            if not self.running:
+                return
+            self.buffer += header
+            self.buffer += payload
+            self.records += 1
+            if len(self.buffer) >= FLUSH_SIZE:
+                self.buffer_ready.notify()
+
+    def record_sample(self, device, raw, binary):
+        """
+        :param device: micro:bit number
+        :param raw: the raw sample kept by the SensorReader
+        :param binary: True if raw is a binary sensor packet
+        """
+        if binary:
+            self.record(BINARY_SAMPLE_RECORD, device, bytes(raw))
+        else:
+            self.record(ASCII_SAMPLE_RECORD, device, raw.encode())
+
+    def record_command(self, device, command):
+        """
+        :param device: micro:bit number
+        :param command: s2mb.py command string
+        """
+        self.record(COMMAND_RECORD, device, command.encode('utf-8'))
+
+    def record_version(self, device, v_string):
+        """
+        :param device: micro:bit number
+        :param v_string: s2mb.py version string
+        """
+        self.record(VERSION_RECORD, device, v_string.encode('utf-8'))
+
+    def run(self):
+        """
+        Write the buffer to the log until stopped.
+        """
+        while True:
+            with self.buffer_ready:
+                if self.running:
+                    self.buffer_ready.wait(FLUSH_INTERVAL)
+                data = self.buffer
+                self.buffer = bytearray()
+                running = self.running
+            try:
+                if data:
+                    self.log_file.write(data)
+                    self.log_file.flush()
+            except (IOError, OSError) as e:
+                print('Recording to ' + self.path + ' stopped: ' + str(e))
+                with self.buffer_ready:
+                    self.running = False
+                running = False
+            if not running:
+                break
+        self.log_file.close()
+
+    def stop(self):
+        """
+        Write what is buffered and close the log.
+        """
+        with self.buffer_ready:
+            self.running = False
+            self.buffer_ready.notify()
+        self.join(2)
+
+
+def read_log(path):
+    """
+    Read a session log. A record cut short at the end of the
+    file, e.g. because s2m was killed, is ignored.
+
+    :param path: log file name
+    :return: generator of (seconds, record type, micro:bit number, payload) tuples
+    """
+    with open(path, 'rb') as log_file:
+        if log_file.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise ValueError(path + ' is not an s2m session log')
+        while True:
+            header = log_file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            milliseconds, record_type, device, length = RECORD_HEADER.unpack(header)
+            payload = log_file.read(length)
+            if len(payload) < length:
+                return
+            yield milliseconds / 1000.0, record_type, device, payload
+
+
+class ReplayReader(SensorReader):
+    """
+    Stands in for the SensorReader of a micro:bit, providing
+    the samples of a recorded session at the times they were received.
+    """
+
+    def __init__(self, samples, start_time, speed=1, on_sample=None, index=0):
+        """
+        :param samples: list of (seconds, (raw, fields)) tuples
+        :param start_time: time.time() value that the sample times are relative to
+        :param speed: replay speed, e.g. 2 replays twice as fast as recorded
+        :param on_sample: optional function called with every sample
+        :param index: micro:bit number
+        """
+        SensorReader.__init__(self, None, on_sample=on_sample)
+        self.samples = samples
+        self.start_time = start_time
+        self.speed = speed
+        self.index = index
+
+    def run(self):
+        for seconds, sample in self.samples:
+            while self.running:
+                delay = self.start_time + seconds / self.speed - time.time()
+                if delay <= 0:
+                    break
+                # wake up regularly to check the stop flag
+                time.sleep(min(delay, .1))
+            if not self.running:
+                return
+            self.store_sample(sample)
+        print('{}{}{}'.format('micro:bit ', self.index, ' replay finished'))
+
+
+class ReplayDevice(MicroBitDevice):
+    """
+    A micro:bit from a recorded session. Polls are answered with the
+    recorded samples, as if the micro:bit were streaming them. Commands
+    are not sent anywhere.
+    """
+
+    def __init__(self, index, path, v_string, samples, metrics=None):
+        """
+        :param index: device number used to address this micro:bit
+        :param path: session log file name
+        :param v_string: recorded s2mb.py version string
+        :param samples: list of (seconds, (raw, fields)) tuples
+        :param metrics: optional Metrics instance
+        """
+        MicroBitDevice.__init__(self, index, None, path, v_string, metrics)
+        self.samples = samples
+
+    def start(self, start_time=None, speed=1):
+        """
+        Start replaying the samples.
+
+        :param start_time: time.time() value that the sample times are relative to
+        :param speed: replay speed
+        """
+        self.streaming = True
+        self.sensor_reader = ReplayReader(self.samples, start_time or time.time(), speed,
+                                          self.handle_sample, self.index)
+        self.sensor_reader.start()
+        self.connected = True
+
+    def send_command(self, command):
+        if command == 'g':
+            return self.sensor_reader.get_latest()
+        return None
+
+    def stop(self):
+        self.closing = True
+        if self.sensor_reader:
+            self.sensor_reader.stop()
+
+
+def open_replay(path, speed=1, metrics=None):
+    """
+    Load a session log and start replaying it.
+
+    :param path: session log file name
+    :param speed: replay speed, e.g. 2 replays twice as fast as recorded
+    :param metrics: optional Metrics instance
+    :return: list of started ReplayDevices, one per recorded micro:bit
+    """
+    versions = {}
+    samples = {}
+    for seconds, record_type, device, payload in read_log(path):
+        if record_type == VERSION_RECORD:
+            versions.setdefault(device, payload.decode('utf-8', 'ignore'))
+        elif record_type == ASCII_SAMPLE_RECORD:
+            line = payload.decode('utf-8', 'ignore')
+            samples.setdefault(device, []).append((seconds, (line, line.split(','))))
+        elif record_type == BINARY_SAMPLE_RECORD:
+            samples.setdefault(device, []).append((seconds, (payload, unpack_sensor_packet(payload))))
+
+    devices = [ReplayDevice(index, path, versions.get(index, ''), samples.get(index, []), metrics)
+               for index in range(max(samples) + 1)] if samples else []
+
+    # start with the first sample of the session
+    first = min(device.samples[0][0] for device in devices if device.samples) if devices else 0
+    start_time = time.time() - first / speed
+    for device in devices:
+        device.start(start_time, speed)
+    return devices
+
+
+def main():
+    """
+    Print a session log.
+    """
+    if len(sys.argv) != 2:
+        print('Usage: python -m s2m.s2m_recorder <session log>')
+        sys.exit(1)
+    names = {VERSION_RECORD: 'version', ASCII_SAMPLE_RECORD: 'sample',
+             BINARY_SAMPLE_RECORD: 'sample', COMMAND_RECORD: 'command'}
+    for seconds, record_type, device, payload in read_log(sys.argv[1]):
+        if record_type == BINARY_SAMPLE_RECORD:
+            text = ','.join(unpack_sensor_packet(payload))
+        else:
+            text = payload.decode('utf-8', 'replace')
+        print('{:10.3f} {} {:8} {}'.format(seconds, device, names.get(record_type, '?'), text))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1257 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+# noinspection PyPackageRequirements
+import serial
+# noinspection PyPackageRequirements
+from serial.tools import list_ports
+
+try:
+    # for python 3
+    from s2m.s2m_gestures import GestureDetector
+    from s2m.s2m_metrics import timer
+    from s2m.s2m_shadow import OutputShadow
+except ImportError:
+    # for python 2
+    # noinspection PyUnresolvedReferences
+    from s2m_gestures import GestureDetector
+    # noinspection PyUnresolvedReferences
+    from s2m_metrics import timer
+    # noinspection PyUnresolvedReferences
+    from s2m_shadow import OutputShadow
+
+# USB vendor and product ids of the micro:bit's interface chip
+MICRO_BIT_VID = 0x0d28
+MICRO_BIT_PID = 0x0204
+
+# maximum number of seconds to wait for s2mb.py to answer the handshake
+HANDSHAKE_TIMEOUT = 2
+
+# the first s2mb.py version that is able to stream sensor data
+STREAMING_VERSION = (1, 11)
+
+# the first s2mb.py version that accepts several commands on one line
+BATCHING_VERSION = (1, 12)
+
+# the first s2mb.py version that supports the binary wire protocol
+BINARY_VERSION = (1, 13)
+
+# the first s2mb.py version that can show a whole frame with one command
+FRAME_VERSION = (1, 15)
+
+# the first s2mb.py version that can be told which sensor fields to read
+MASK_VERSION = (1, 16)
+
+# the first s2mb.py version that can be given sensor deadbands and
+# then only sends the sensor fields that have changed
+DEADBAND_VERSION = (1, 17)
+
+# the first s2mb.py version that can change its baud rate
+BAUD_VERSION = (1, 18)
+
+# the baud rate s2mb.py starts at
+DEFAULT_BAUD_RATE = 115200
+
+# the faster baud rates that are tried, fastest first
+BAUD_RATES = (1000000, 921600, 460800, 230400)
+
+# seconds to wait for s2mb.py to answer a baud rate change, seconds
+# to wait before talking at the new rate, and seconds after which
+# s2mb.py has gone back to DEFAULT_BAUD_RATE if the change failed
+BAUD_REPLY_TIMEOUT = .3
+BAUD_SWITCH_DELAY = .05
+BAUD_FALLBACK_DELAY = .6
+
+# seconds to wait for the handshake at each of BAUD_RATES when
+# s2mb.py does not answer at DEFAULT_BAUD_RATE
+BAUD_PROBE_TIMEOUT = .5
+
+# maximum number of seconds to wait for the micro:bit to answer a poll
+REPLY_TIMEOUT = .5
+
+# a write that takes longer than this many seconds means the micro:bit is gone
+WRITE_TIMEOUT = 1
+
+# seconds to wait before the first attempt to reconnect to a micro:bit.
+# The wait doubles after each failed attempt, up to RECONNECT_MAX_DELAY.
+RECONNECT_DELAY = .5
+RECONNECT_MAX_DELAY = 8
+
+# number of seconds the command writer waits for a burst of
+# commands to arrive, so that it can merge them into one write
+BATCH_TICK = .01
+
+# longest line of batched commands sent to s2mb.py
+MAX_BATCH_LENGTH = 60
+
+# most bytes sent to s2mb.py in one write, so that a write fits in the
+# micro:bit's uart receive buffer. Only a scroll line may be longer.
+MAX_WRITE_LENGTH = 64
+
+# seconds between two writes of the same burst, so that s2mb.py can
+# read the previous write out of its receive buffer. s2mb.py versions
+# older than BATCHING_VERSION read one line and then sleep for 16 ms,
+# so they are sent one line per write, LINE_PAUSE apart.
+WRITE_PAUSE = .01
+LINE_PAUSE = .02
+
+
+# Binary wire protocol
+#
+# Every binary frame starts with SYNC_BYTE.
+#
+# host to micro:bit:  SYNC_BYTE, payload length, payload
+#     The payload is the same command text used by the ASCII protocol.
+#
+# micro:bit to host:  SYNC_BYTE, SENSOR_FRAME, sensor packet
+#                     SYNC_BYTE, TEXT_FRAME, text length, text
+#     The sensor packet holds the x, y and z accelerometer values,
+#     a flags byte (bit 0 = button a, bit 1 = button b,
+#     bits 2-4 = digital inputs 0-2) and analog inputs 0-2.
+SYNC_BYTE = 0xa5
+SENSOR_FRAME = ord('S')
+TEXT_FRAME = ord('T')
+SENSOR_PACKET = struct.Struct('<hhhBHHH')
+
+# text values used for the boolean sensor fields
+BOOLEAN_TEXT = ('false', 'true')
+
+# Sensor field masks. Bit n selects field n of a sensor sample: the x, y
+# and z acceleration, buttons a and b, digital inputs 0-2 and analog
+# inputs 0-2. The fields that are not selected are not read by s2mb.py.
+ALL_FIELDS = 0x7ff
+ACCELEROMETER_FIELDS = 0x7
+
+# number of fields in a sensor sample
+FIELD_COUNT = 11
+
+
+def build_frame(payload):
+    """
+    Frame a command for the binary wire protocol.
+
+    :param payload: s2mb.py command text, without a trailing newline
+    :return: bytearray containing the frame
+    """
+    data = payload.encode('utf-8')
+    if len(data) > 255:
+        # don't cut a character in half, s2mb.py would not be able to decode it
+        data = data[:255].decode('utf-8', 'ignore').encode('utf-8')
+    return bytearray([SYNC_BYTE, len(data)]) + bytearray(data)
+
+
+def unpack_sensor_packet(packet):
+    """
+    Convert a binary sensor packet to the list of fields that the
+    ASCII protocol would have provided.
+
+    :param packet: SENSOR_PACKET.size bytes
+    :return: list of 11 sensor field strings
+    """
+    x, y, z, flags, analog0, analog1, analog2 = SENSOR_PACKET.unpack(bytes(packet))
+    return [str(x), str(y), str(z),
+            BOOLEAN_TEXT[flags & 1], BOOLEAN_TEXT[(flags >> 1) & 1],
+            str((flags >> 2) & 1), str((flags >> 3) & 1), str((flags >> 4) & 1),
+            str(analog0), str(analog1), str(analog2)]
+
+
+def get_firmware_version(v_string):
+    """
+    Extract the numeric version from the s2mb.py version string.
+
+    :param v_string: reply to the 'v' command,
+                     e.g. 's2mb.py Version 1.10 14 April 2018'
+    :return: version as a tuple of ints, e.g. (1, 10). (0, 0) if unknown.
+    """
+    match = re.search(r'Version\s+(\d+)\.(\d+)', v_string)
+    if not match:
+        return 0, 0
+    return int(match.group(1)), int(match.group(2))
+
+
+def list_micro_bit_ports():
+    """
+    :return: the serial ports whose USB ids match a micro:bit
+    """
+    return [port[0] for port in list_ports.comports()
+            if getattr(port, 'vid', None) == MICRO_BIT_VID and
+            getattr(port, 'pid', None) == MICRO_BIT_PID]
+
+
+def list_candidate_ports():
+    """
+    List the serial ports that may have a micro:bit attached.
+
+    :return: the ports whose USB ids match a micro:bit. If there are
+             none, every serial port on the system is returned.
+    """
+    micro_bits = list_micro_bit_ports()
+    if micro_bits:
+        return micro_bits
+    return [port[0] for port in list_ports.comports()]
+
+
+def handshake(micro_bit_serial, timeout, found=None):
+    """
+    Perform the s2mb.py handshake: a 'g' request followed by a 'v' request.
+    Replies are read as soon as they arrive.
+
+    :param micro_bit_serial: an open pyserial instance
+    :param timeout: maximum number of seconds to wait for the replies
+    :param found: optional threading.Event. The handshake gives up
+                  early if it is set.
+    :return: (sensor line, version string), or None if s2mb.py did not answer
+    """
+    micro_bit_serial.flushInput()
+    # the leading newline ends anything received at another baud rate
+    micro_bit_serial.write('\ng\nv\n'.encode())
+    sensor_line = None
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if found is not None and found.is_set():
+            break
+        data = micro_bit_serial.readline()
+        if not data:
+            continue
+        line = data.decode('utf-8', 'ignore').strip()
+        if 'Version' in line:
+            return sensor_line, line
+        if line.count(',') in (10, 11):
+            sensor_line = line
+    return None
+
+
+def probe_port(port, found=None, timeout=HANDSHAKE_TIMEOUT, baud_rates=()):
+    """
+    Open a serial port and perform the s2mb.py handshake.
+
+    s2mb.py keeps a faster baud rate until it is told to go back, so if
+    an earlier s2m was killed or the micro:bit kept its power while the
+    USB link failed, it does not answer at DEFAULT_BAUD_RATE.
+
+    :param port: serial port name
+    :param found: optional threading.Event. The probe gives up
+                  early if another probe sets it.
+    :param timeout: maximum number of seconds to wait for the replies
+                    at DEFAULT_BAUD_RATE
+    :param baud_rates: the faster rates to try, in turn, if s2mb.py does
+                       not answer at DEFAULT_BAUD_RATE, e.g. BAUD_RATES
+    :return: (pyserial instance, port, sensor line, version string)
+             or None if s2mb.py did not answer. The pyserial instance
+             is left at the baud rate s2mb.py answered at.
+    """
+    try:
+        micro_bit_serial = serial.Serial(port=port, baudrate=DEFAULT_BAUD_RATE, timeout=.1)
+        # don't let a write to an unplugged micro:bit block forever
+        micro_bit_serial.writeTimeout = WRITE_TIMEOUT
+    except (serial.SerialException, OSError, ValueError):
+        return None
+
+    attempts = [(DEFAULT_BAUD_RATE, timeout)] + [(rate, BAUD_PROBE_TIMEOUT) for rate in baud_rates]
+    try:
+        for rate, rate_timeout in attempts:
+            if found is not None and found.is_set():
+                break
+            try:
+                micro_bit_serial.baudrate = rate
+            except ValueError:
+                # the serial port does not support the rate
+                continue
+            reply = handshake(micro_bit_serial, rate_timeout, found)
+            if reply:
+                return micro_bit_serial, port, reply[0], reply[1]
+    except (serial.SerialException, OSError):
+        pass
+    micro_bit_serial.close()
+    return None
+
+
+def find_micro_bits(ports, count=1, timeout=HANDSHAKE_TIMEOUT, known_ports=False):
+    """
+    Probe all of the ports at the same time and return the ones
+    that have s2mb.py running on them.
+
+    Only the ports that are known to be micro:bits are also probed at
+    each of BAUD_RATES, so that a scan of every port on the system does
+    not take longer, or send faster handshakes to other devices.
+
+    :param ports: list of serial port names
+    :param count: stop probing once this many micro:bits have answered
+    :param timeout: maximum number of seconds to wait for a handshake
+    :param known_ports: True if all of the ports are known to be micro:bits,
+                        e.g. they were given by the user. Otherwise only the
+                        ports whose USB ids match a micro:bit are.
+    :return: list of probe_port results, in the order of the ports list
+    """
+    found = threading.Event()
+    results = []
+    lock = threading.Lock()
+    micro_bits = ports if known_ports else list_micro_bit_ports()
+
+    def probe(port):
+        result = probe_port(port, found, timeout, BAUD_RATES if port in micro_bits else ())
+        if result is None:
+            return
+        with lock:
+            if len(results) < count:
+                results.append(result)
+                if len(results) == count:
+                    found.set()
+            else:
+                # enough ports have already answered
+                result[0].close()
+
+    probes = [threading.Thread(target=probe, args=(port,)) for port in ports]
+    for thread in probes:
+        thread.daemon = True
+        thread.start()
+    for thread in probes:
+        thread.join()
+
+    # keep the device order stable from one run to the next
+    results.sort(key=lambda result: ports.index(result[1]))
+    return results
+
+
+def wait_for_line(micro_bit_serial, expected, timeout):
+    """
+    Read lines until one matches.
+
+    :param micro_bit_serial: an open pyserial instance
+    :param expected: the line to wait for
+    :param timeout: maximum number of seconds to wait
+    :return: True if the line arrived
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        data = micro_bit_serial.readline()
+        if data and data.decode('utf-8', 'ignore').strip() == expected:
+            return True
+    return False
+
+
+def change_baud_rate(micro_bit_serial, rate):
+    """
+    Switch s2mb.py and the serial port to a new baud rate. The change
+    is kept only if s2mb.py echoes a confirmation sent at the new rate,
+    otherwise both ends go back to DEFAULT_BAUD_RATE.
+
+    Must be called while nothing else is reading from or writing to
+    the port, with s2mb.py using the ASCII protocol.
+
+    :param micro_bit_serial: an open pyserial instance
+    :param rate: the new baud rate
+    :return: True if the new rate is in use
+    """
+    command = 'u,' + str(rate)
+    confirmation = command + ',ok'
+    try:
+        micro_bit_serial.flushInput()
+        micro_bit_serial.write((command + '\n').encode())
+        if not wait_for_line(micro_bit_serial, command, BAUD_REPLY_TIMEOUT):
+            return False
+        # let s2mb.py switch before talking to it at the new rate
+        time.sleep(BAUD_SWITCH_DELAY)
+        micro_bit_serial.baudrate = rate
+        micro_bit_serial.flushInput()
+        micro_bit_serial.write((confirmation + '\n').encode())
+        if wait_for_line(micro_bit_serial, confirmation, BAUD_REPLY_TIMEOUT):
+            return True
+    except (serial.SerialException, OSError, ValueError):
+        # the serial port does not support the rate
+        pass
+
+    # s2mb.py goes back to the default rate on its own
+    time.sleep(BAUD_FALLBACK_DELAY)
+    try:
+        micro_bit_serial.baudrate = DEFAULT_BAUD_RATE
+        micro_bit_serial.flushInput()
+    except (serial.SerialException, OSError, ValueError):
+        pass
+    return False
+
+
+def negotiate_baud_rate(micro_bit_serial, max_rate=None):
+    """
+    Find the fastest baud rate that works, trying the rates from
+    fastest to slowest.
+
+    :param micro_bit_serial: an open pyserial instance at DEFAULT_BAUD_RATE
+    :param max_rate: the fastest rate to try, or None to try all of BAUD_RATES.
+                     A rate that is not in BAUD_RATES is tried first.
+    :return: the baud rate in use
+    """
+    if max_rate is None:
+        rates = list(BAUD_RATES)
+    else:
+        rates = [max_rate] + [rate for rate in BAUD_RATES if rate < max_rate]
+    for rate in rates:
+        if rate <= DEFAULT_BAUD_RATE:
+            break
+        if change_baud_rate(micro_bit_serial, rate):
+            return rate
+    return DEFAULT_BAUD_RATE
+
+
+class SensorReader(threading.Thread):
+    """
+    This thread owns all reads from the micro:bit serial port. It keeps
+    a snapshot of the most recent sensor sample and signals a condition
+    variable each time a new one arrives. Samples are received either as
+    ASCII lines or as binary sensor packets.
+
+    When s2mb.py is streaming, polls from Scratch are answered from the
+    snapshot. Otherwise, a poll sends a 'g' and then blocks on the
+    condition variable, with a deadline, until the reply arrives.
+    """
+
+    def __init__(self, micro_bit_serial, binary=False, on_error=None, on_sample=None):
+        """
+        :param micro_bit_serial: an open pyserial instance
+        :param binary: True if s2mb.py is using the binary wire protocol
+        :param on_error: optional function called if the serial port fails
+        :param on_sample: optional function called with every sample as a (raw, fields) tuple
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.micro_bit_serial = micro_bit_serial
+        self.binary = binary
+        self.on_error = on_error
+        self.on_sample = on_sample
+
+        # the most recent sample as a (raw, fields) tuple. raw is the lower
+        # cased, stripped line for the ASCII protocol or the packet bytes for
+        # the binary protocol. fields is the sample as a list of strings.
+        self.latest_sample = None
+
+        # number of samples received since the thread started
+        self.sample_count = 0
+
+        # number of times the micro:bit failed to reply before the deadline
+        self.timeouts = 0
+
+        self.lock = threading.Lock()
+        self.sample_ready = threading.Condition(self.lock)
+        self.running = True
+
+    def run(self):
+        """
+        Read samples until stopped. The serial timeout keeps the reads from
+        blocking forever, so the stop flag is checked regularly.
+        """
+        while self.running:
+            try:
+                if self.binary:
+                    sample = self.read_packet()
+                else:
+                    sample = self.read_line()
+            except (serial.SerialException, OSError, TypeError, AttributeError):
+                # pyserial raises TypeError or AttributeError if
+                # the port is closed while a read is in progress
+                running = self.running
+                self.stop()
+                if running and self.on_error:
+                    self.on_error()
+                break
+            if sample is None:
+                continue
+            self.store_sample(sample)
+
+    def store_sample(self, sample):
+        """
+        Make a sample the latest one and wake anyone waiting for it.
+
+        :param sample: (raw, fields) tuple
+        """
+        if self.on_sample:
+            self.on_sample(sample)
+        with self.sample_ready:
+            self.latest_sample = sample
+            self.sample_count += 1
+            self.sample_ready.notify_all()
+
+    def read_line(self):
+        """
+        Read an ASCII sensor line.
+
+        :return: (line, list of fields), or None if the line is not sensor data
+        """
+        data = self.micro_bit_serial.readline()
+        if not data:
+            return None
+        try:
+            line = data.decode().strip().lower()
+        except UnicodeDecodeError:
+            return None
+
+        # a sensor line contains 11 comma delimited fields
+        # (12 if s2mb.py appended a trailing comma)
+        if line.count(',') not in (10, 11):
+            return None
+        fields = line.split(',')
+
+        # when s2mb.py has deadbands, the fields that have not changed
+        # are empty: they keep the value last received
+        if '' in fields[:FIELD_COUNT] and self.latest_sample:
+            previous = self.latest_sample[1]
+            if not line.strip(','):
+                return self.latest_sample
+            fields = [field or old for field, old in zip(fields, previous)]
+            line = ','.join(fields)
+        return line, fields
+
+    def read_packet(self):
+        """
+        Read a binary frame.
+
+        :return: (packet, list of fields), or None if the frame is not sensor data
+        """
+        # skip anything that is not the start of a frame
+        sync = bytearray(self.micro_bit_serial.read(1))
+        if not sync or sync[0] != SYNC_BYTE:
+            return None
+        frame_type = bytearray(self.micro_bit_serial.read(1))
+        if not frame_type:
+            return None
+        if frame_type[0] == SENSOR_FRAME:
+            packet = self.micro_bit_serial.read(SENSOR_PACKET.size)
+            if len(packet) < SENSOR_PACKET.size:
+                return None
+            return packet, unpack_sensor_packet(packet)
+        elif frame_type[0] == TEXT_FRAME:
+            # text replies are not sensor data, skip over them
+            length = bytearray(self.micro_bit_serial.read(1))
+            if length:
+                self.micro_bit_serial.read(length[0])
+        return None
+
+    def get_latest(self):
+        """
+        :return: the most recent sample as a (raw, fields) tuple,
+                 or None if nothing has been received yet
+        """
+        with self.lock:
+            return self.latest_sample
+
+    def get_sample_count(self):
+        """
+        :return: number of samples received so far. Pass this
+                 to wait_for_sample to wait for the next one.
+        """
+        with self.lock:
+            return self.sample_count
+
+    def wait_for_sample(self, last_count, timeout=REPLY_TIMEOUT, is_reply=True):
+        """
+        Block until a sample newer than last_count arrives.
+
+        :param last_count: value of get_sample_count before the request was sent
+        :param timeout: maximum number of seconds to wait
+        :param is_reply: False if no request was sent, so that the deadline
+                         passing is not counted as a timeout
+        :return: the new sample as a (raw, fields) tuple, or None if the deadline passed
+        """
+        deadline = time.time() + timeout
+        with self.sample_ready:
+            while self.sample_count == last_count:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.running:
+                    if is_reply:
+                        self.timeouts += 1
+                    return None
+                self.sample_ready.wait(remaining)
+            return self.latest_sample
+
+    def stop(self):
+        """
+        Ask the thread to exit after its current read completes and
+        release anyone waiting for a sample.
+        """
+        with self.sample_ready:
+            self.running = False
+            self.sample_ready.notify_all()
+
+
+def get_coalesce_key(command):
+    """
+    Commands that share a key supersede one another: only the most
+    recent one needs to be sent to the micro:bit.
+
+    :param command: s2mb.py command string
+    :return: coalesce key, or None if the command must always be sent
+    """
+    fields = command.split(',')
+    cmd_id = fields[0]
+
+    # analog and digital writes to the same pin
+    if cmd_id in ('a', 't') and len(fields) > 1:
+        return 'pin', fields[1]
+
+    # pixel writes to the same cell
+    elif cmd_id == 'p' and len(fields) > 2:
+        return 'p', fields[1], fields[2]
+
+    # image, scroll, clear and frame each replace the whole display
+    elif cmd_id in ('d', 's', 'c', 'f'):
+        return 'display'
+
+    elif cmd_id in ('r', 'm', 'e'):
+        return cmd_id
+    return None
+
+
+def build_deadband_command(deadbands):
+    """
+    :param deadbands: list of sensor field deadbands, or None
+    :return: s2mb.py command that sets the deadbands, or clears them if None
+    """
+    if not deadbands:
+        return 'e'
+    return 'e,' + ','.join(str(deadband) for deadband in deadbands)
+
+
+class CommandWriter(threading.Thread):
+    """
+    This thread owns all writes to the micro:bit serial port, so any number
+    of HTTP server threads can send commands without interleaving their
+    bytes on the port.
+
+    Commands are held for up to BATCH_TICK seconds so that bursts can be
+    merged. A command replaces any pending command it supersedes (see
+    get_coalesce_key), and everything pending is then sent in as few
+    writes of up to MAX_WRITE_LENGTH bytes as possible. If s2mb.py supports
+    batching, several commands are joined with ';' on one line, otherwise
+    each line is written on its own. With the binary wire protocol, each
+    line is sent as a length prefixed frame instead of being newline
+    terminated.
+    """
+
+    def __init__(self, micro_bit_serial, batching=False, binary=False, metrics=None,
+                 on_error=None):
+        """
+        :param micro_bit_serial: an open pyserial instance
+        :param batching: True if s2mb.py accepts several commands per line
+        :param binary: True if s2mb.py is using the binary wire protocol
+        :param metrics: optional Metrics instance that serial write times are recorded in
+        :param on_error: optional function called if a write fails
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.micro_bit_serial = micro_bit_serial
+        self.batching = batching
+        self.binary = binary
+        self.metrics = metrics
+        self.on_error = on_error
+
+        # commands waiting to be written, in the order they will be sent
+        self.pending = OrderedDict()
+
+        # used to make unique keys for commands that are never coalesced
+        self.sequence = 0
+
+        # True if a pending command is waiting on a reply and should
+        # not be held back for batching
+        self.urgent = False
+
+        # number of commands dropped because a later one superseded them
+        self.coalesced = 0
+
+        # number of writes that failed
+        self.write_errors = 0
+
+        self.lock = threading.Lock()
+        self.pending_ready = threading.Condition(self.lock)
+        self.running = True
+
+    def run(self):
+        """
+        Write pending commands until stopped.
+        """
+        while True:
+            with self.pending_ready:
+                while not self.pending and self.running:
+                    self.pending_ready.wait()
+                if not self.pending:
+                    break
+                urgent = self.urgent
+
+            # give a burst of commands a chance to arrive so it can be merged
+            if not urgent:
+                time.sleep(BATCH_TICK)
+
+            with self.pending_ready:
+                commands = list(self.pending.values())
+                self.pending.clear()
+                self.urgent = False
+
+            for index, data in enumerate(self.build_writes(commands)):
+                if index:
+                    time.sleep(WRITE_PAUSE if self.batching else LINE_PAUSE)
+                start = timer()
+                written = True
+                try:
+                    self.micro_bit_serial.write(data)
+                except (serial.SerialException, OSError):
+                    written = False
+                    self.write_errors += 1
+                    if self.running and self.on_error:
+                        self.on_error()
+                if self.metrics:
+                    self.metrics.record('serial_write', timer() - start)
+                if not written:
+                    break
+
+    def build_writes(self, commands):
+        """
+        Split a list of commands into the writes that send them.
+
+        :param commands: list of s2mb.py command strings
+        :return: list of bytes, one for each write
+        """
+        if not self.batching:
+            return [self.build_line(command) for command in commands]
+
+        lines = []
+        line = ''
+        for command in commands:
+            # scroll text may contain ';' so it always gets a line of its own
+            if command.startswith('s,'):
+                if line:
+                    lines.append(line)
+                lines.append(command)
+                line = ''
+            elif not line:
+                line = command
+            elif len(line) + 1 + len(command) > MAX_BATCH_LENGTH:
+                lines.append(line)
+                line = command
+            else:
+                line += ';' + command
+        if line:
+            lines.append(line)
+
+        writes = []
+        data = b''
+        for line in lines:
+            line = self.build_line(line)
+            if data and len(data) + len(line) > MAX_WRITE_LENGTH:
+                writes.append(data)
+                data = b''
+            data += line
+        if data:
+            writes.append(data)
+        return writes
+
+    def build_line(self, line):
+        """
+        Terminate or frame a line for the wire protocol in use.
+
+        :param line: command line
+        :return: bytes to write
+        """
+        if self.binary:
+            return bytes(build_frame(line))
+        return (line + '\n').encode('utf-8')
+
+    def send(self, command):
+        """
+        Queue a command for the micro:bit. This never blocks.
+
+        :param command: s2mb.py command string without the trailing newline
+        """
+        key = get_coalesce_key(command)
+        with self.pending_ready:
+            if key is None:
+                self.sequence += 1
+                key = self.sequence
+                self.urgent = True
+            elif key in self.pending:
+                del self.pending[key]
+                self.coalesced += 1
+
+            # a whole display command makes any pending pixel writes moot
+            if key == 'display':
+                for pending_key in list(self.pending):
+                    if isinstance(pending_key, tuple) and pending_key[0] == 'p':
+                        del self.pending[pending_key]
+                        self.coalesced += 1
+
+            self.pending[key] = command
+            self.pending_ready.notify()
+
+    def stop(self):
+        """
+        Ask the thread to exit once it has written the commands
+        that are already pending.
+        """
+        with self.pending_ready:
+            self.running = False
+            self.pending_ready.notify()
+
+
+class MicroBitDevice:
+    """
+    A micro:bit running s2mb.py, along with the reader and writer
+    threads that own its serial port.
+    """
+
+    def __init__(self, index, micro_bit_serial, com_port, v_string, metrics=None,
+                 busy_ports=None, recorder=None, ports=None):
+        """
+        :param index: device number used to address this micro:bit
+        :param micro_bit_serial: an open pyserial instance
+        :param com_port: serial port name
+        :param v_string: s2mb.py version string
+        :param metrics: optional Metrics instance
+        :param busy_ports: optional function that returns the ports used by
+                           other micro:bits, which are skipped when reconnecting
+        :param recorder: optional Recorder that samples and commands are logged to
+        :param ports: optional list of the ports given by the user. Only these
+                      are tried when reconnecting.
+        """
+        self.index = index
+        self.micro_bit_serial = micro_bit_serial
+        self.com_port = com_port
+        self.v_string = v_string
+        self.metrics = metrics
+        self.busy_ports = busy_ports
+        self.recorder = recorder
+        self.ports = ports
+        self.firmware_version = get_firmware_version(v_string)
+
+        # the options passed to start, used again when reconnecting
+        self.wire_protocol = 'ascii'
+        self.stream_interval = 0
+        self.max_baud_rate = None
+
+        # the baud rate of the serial link
+        self.baud_rate = DEFAULT_BAUD_RATE
+
+        # True while the serial link is working. When it fails, polls are
+        # answered with the last sample received until the micro:bit is back.
+        self.connected = False
+
+        # True once stop has been called
+        self.closing = False
+        self.connection_lock = threading.Lock()
+
+        # background thread that reads all replies from the micro:bit
+        self.sensor_reader = None
+
+        # background thread that performs all writes to the micro:bit
+        self.command_writer = None
+
+        # True if the micro:bit is pushing sensor data
+        self.streaming = False
+
+        # True if the micro:bit is using the binary wire protocol
+        self.binary = False
+
+        # shake, tilt and free fall detection, fed with every sample received
+        self.gestures = GestureDetector()
+
+        # encoded poll responses, keyed by raw sample and gesture state
+        self.poll_cache = {}
+
+        # model of the micro:bit's outputs, used to drop commands
+        # that would not change anything
+        self.shadow = OutputShadow()
+
+        # held while a command is checked against the shadow and queued,
+        # so that commands reach the writer in the order the shadow saw them
+        self.output_lock = threading.Lock()
+
+        # the sensor fields that are reported to Scratch
+        self.sensor_mask = ALL_FIELDS
+
+        # sensor field deadbands, or None to receive every field
+        self.deadbands = None
+
+    def start(self, wire_protocol='ascii', stream_interval=0, max_baud_rate=None):
+        """
+        Select the baud rate and wire protocol and start the reader and writer threads.
+
+        :param wire_protocol: ascii or binary
+        :param stream_interval: if non-zero, have the micro:bit push sensor
+                                data every stream_interval milliseconds
+        :param max_baud_rate: fastest baud rate to use, see negotiate_baud_rate.
+                              DEFAULT_BAUD_RATE keeps the link at that rate.
+        """
+        self.wire_protocol = wire_protocol
+        self.stream_interval = stream_interval
+        self.max_baud_rate = max_baud_rate
+        self.binary = False
+        self.streaming = False
+
+        # nothing is known about the outputs of a micro:bit that was just opened
+        self.invalidate_shadow()
+
+        if self.recorder:
+            self.recorder.record_version(self.index, self.v_string)
+
+        # probe_port leaves the port at the rate s2mb.py answered at. If an
+        # earlier s2m left s2mb.py at a faster rate, go back to the default
+        # first, so that the negotiation starts from a known rate.
+        self.baud_rate = self.micro_bit_serial.baudrate
+        if self.baud_rate != DEFAULT_BAUD_RATE:
+            change_baud_rate(self.micro_bit_serial, DEFAULT_BAUD_RATE)
+            # if s2mb.py did not answer, both ends stay at the faster rate
+            self.baud_rate = self.micro_bit_serial.baudrate
+        if self.firmware_version >= BAUD_VERSION and max_baud_rate != DEFAULT_BAUD_RATE \
+                and self.baud_rate == DEFAULT_BAUD_RATE:
+            self.baud_rate = negotiate_baud_rate(self.micro_bit_serial, max_baud_rate)
+            print('{}{}\n'.format('Baud rate: ', self.baud_rate))
+
+        # switch s2mb.py over to binary framing if requested and supported
+        if wire_protocol == 'binary':
+            if self.firmware_version >= BINARY_VERSION:
+                self.micro_bit_serial.write('b,1\n'.encode())
+                self.binary = True
+                print('Using the binary wire protocol\n')
+            else:
+                print('The binary wire protocol requires a newer s2mb.py - using ASCII.\n')
+
+        # from here on, all serial reads are done by the sensor reader thread
+        # and all serial writes are done by the command writer thread
+        # after a reconnect, keep answering polls with the last sample
+        # until the new reader receives one
+        last_sample = self.sensor_reader.get_latest() if self.sensor_reader else None
+        self.sensor_reader = SensorReader(self.micro_bit_serial, binary=self.binary,
+                                          on_error=self.handle_disconnect,
+                                          on_sample=self.handle_sample)
+        self.sensor_reader.latest_sample = last_sample
+        self.sensor_reader.start()
+        self.command_writer = CommandWriter(self.micro_bit_serial,
+                                            batching=self.firmware_version >= BATCHING_VERSION,
+                                            binary=self.binary,
+                                            metrics=self.metrics,
+                                            on_error=self.handle_disconnect)
+        self.command_writer.start()
+        self.connected = True
+
+        # s2mb.py keeps its mask until it is reset, so it is always set
+        if self.firmware_version >= MASK_VERSION:
+            self.send_command('m,' + str(self.sensor_mask))
+        if self.deadbands and self.firmware_version >= DEADBAND_VERSION:
+            self.send_command(build_deadband_command(self.deadbands))
+
+        if stream_interval:
+            if self.firmware_version >= STREAMING_VERSION:
+                self.streaming = True
+                self.send_command('r,' + str(stream_interval))
+                print('{}{}{}\n'.format('Streaming sensor data every ', stream_interval, ' ms'))
+            else:
+                print('Sensor streaming requires a newer s2mb.py - using polled mode.\n')
+
+    def request_sample(self):
+        """
+        Send a poll request to the micro:bit without waiting for the reply.
+
+        :return: sample count to pass to sensor_reader.wait_for_sample
+        """
+        # remember how many samples were received before sending the
+        # request, so that the reply can be told apart from older samples
+        sample_count = self.sensor_reader.get_sample_count()
+        self.command_writer.send('g')
+        return sample_count
+
+    def handle_sample(self, sample):
+        """
+        Called by the sensor reader thread with every sample received.
+
+        :param sample: (raw, fields) tuple
+        """
+        # without the accelerometer fields there is nothing to detect
+        if self.sensor_mask & ACCELEROMETER_FIELDS:
+            self.gestures.add_sample(sample[1])
+        if self.recorder:
+            self.recorder.record_sample(self.index, sample[0], self.binary)
+
+    def send_command(self, command):
+        """
+        Send a command to the micro:bit over the serial interface
+        :param command: command sent to micro:bit
+        :return: If the command is a poll request, return the poll response,
+                 or None if the micro:bit did not reply in time
+        """
+        if self.recorder and command != 'g':
+            self.recorder.record_command(self.index, command)
+
+        # commands are dropped while the micro:bit is disconnected,
+        # the shadow is cleared when it comes back
+        if not self.connected:
+            return None
+
+        if command == 'g':
+            return self.sensor_reader.wait_for_sample(self.request_sample())
+
+        # the writer thread sends the command, so this returns immediately
+        with self.output_lock:
+            if self.shadow.apply(command):
+                self.command_writer.send(command)
+
+    def set_sensor_mask(self, mask):
+        """
+        Select the sensor fields that are reported to Scratch.
+        s2mb.py versions that support it only read those fields.
+
+        :param mask: sensor field mask, see ALL_FIELDS
+        """
+        self.sensor_mask = mask
+        if self.firmware_version >= MASK_VERSION:
+            self.send_command('m,' + str(mask))
+
+    def set_deadbands(self, deadbands):
+        """
+        Have s2mb.py only send the sensor fields that change by more
+        than their deadband. The fields that are not sent keep their
+        last value, see SensorReader.read_line.
+
+        :param deadbands: list of FIELD_COUNT deadbands, in sensor field
+                          order, or None to receive every field
+        """
+        self.deadbands = deadbands
+        if self.firmware_version >= DEADBAND_VERSION:
+            self.send_command(build_deadband_command(deadbands))
+        elif deadbands:
+            print('Sensor deadbands require a newer s2mb.py - receiving every sample.\n')
+
+    def invalidate_shadow(self):
+        """
+        Forget the state of the micro:bit's outputs, so that
+        the next commands are sent whatever they are.
+        """
+        with self.output_lock:
+            self.shadow.invalidate()
+
+    def send_frame(self, frame):
+        """
+        Show a whole frame on the display. Nothing is sent if the
+        frame is already being shown.
+
+        :param frame: string of 25 brightness digits, one row after another
+        """
+        if self.firmware_version >= FRAME_VERSION:
+            self.send_command('f,' + frame)
+        else:
+            # older s2mb.py versions are sent a pixel write for each pixel,
+            # the shadow drops the ones that are already showing
+            for i in range(25):
+                self.send_command('p,{},{},{}'.format(i % 5, i // 5, frame[i]))
+
+    def handle_disconnect(self):
+        """
+        Called by the reader or writer thread when the serial port fails.
+        Stops both threads and starts trying to reconnect in the background.
+        """
+        with self.connection_lock:
+            if not self.connected or self.closing:
+                return
+            self.connected = False
+
+        print('{}{}{}{}'.format('micro:bit ', self.index, ' disconnected from ', self.com_port))
+        if self.metrics:
+            self.metrics.count('disconnects')
+        self.command_writer.stop()
+        self.sensor_reader.stop()
+        try:
+            self.micro_bit_serial.close()
+        except (serial.SerialException, OSError):
+            pass
+
+        reconnector = threading.Thread(target=self.reconnect)
+        reconnector.daemon = True
+        reconnector.start()
+
+    def reconnect(self):
+        """
+        Look for the micro:bit until it answers the s2mb.py handshake again,
+        waiting twice as long after each failed attempt. The micro:bit may
+        come back on a different port, see get_reconnect_ports.
+        """
+        delay = RECONNECT_DELAY
+        while not self.closing:
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+            # every one of these ports is known to be a micro:bit
+            found = find_micro_bits(self.get_reconnect_ports(), known_ports=True)
+            if not found:
+                continue
+
+            with self.connection_lock:
+                if self.closing:
+                    found[0][0].close()
+                    return
+                self.micro_bit_serial, self.com_port, sensor_line, self.v_string = found[0]
+            self.firmware_version = get_firmware_version(self.v_string)
+            print('{}{}{}{}'.format('micro:bit ', self.index, ' reconnected on ', self.com_port))
+            if self.metrics:
+                self.metrics.count('reconnects')
+            self.start(self.wire_protocol, self.stream_interval, self.max_baud_rate)
+            return
+
+    def get_reconnect_ports(self):
+        """
+        Unlike at startup, other serial ports are only probed if their USB
+        ids match a micro:bit, as they are probed again and again until
+        the micro:bit is back.
+
+        :return: the port the micro:bit was using, followed by the other
+                 ports given by the user, or if none were given, the other
+                 ports whose USB ids match a micro:bit. Ports used by
+                 other micro:bits are left out.
+        """
+        busy = self.busy_ports() if self.busy_ports else []
+        candidates = self.ports if self.ports else list_micro_bit_ports()
+        return [self.com_port] + [port for port in candidates
+                                  if port != self.com_port and port not in busy]
+
+    def stop(self):
+        """
+        Stop sensor streaming, return s2mb.py to the ASCII protocol
+        and stop the reader and writer threads.
+        """
+        with self.connection_lock:
+            self.closing = True
+            if not self.connected:
+                # the port was closed when the link failed
+                return
+        if self.command_writer:
+            if self.streaming:
+                self.send_command('r,0')
+            if self.binary:
+                self.send_command('b,0')
+            if self.sensor_mask != ALL_FIELDS and self.firmware_version >= MASK_VERSION:
+                self.send_command('m,' + str(ALL_FIELDS))
+            if self.deadbands and self.firmware_version >= DEADBAND_VERSION:
+                self.send_command('e')
+            # s2mb.py goes back to the default rate when the change is not
+            # confirmed, so the next s2m can connect
+            if self.baud_rate != DEFAULT_BAUD_RATE:
+                self.send_command('u,' + str(DEFAULT_BAUD_RATE))
+            # let the writer send the commands above before exiting
+            self.command_writer.stop()
+            self.command_writer.join(1)
+        if self.sensor_reader:
+            self.sensor_reader.stop()
+            if self.sensor_reader.timeouts:
+                print('{}{}{}{}'.format('micro:bit ', self.index, ' poll reply timeouts: ',
+                                        self.sensor_reader.timeouts))
+
+    def get_stats(self):
+        """
+        :return: dictionary of this micro:bit's serial link statistics
+        """
+        stats = {'com_port': self.com_port,
+                 'connected': self.connected,
+                 'version': self.v_string,
+                 'binary': self.binary,
+                 'streaming': self.streaming,
+                 'sensor_mask': self.sensor_mask,
+                 'deadbands': self.deadbands,
+                 'baud_rate': self.baud_rate}
+        if self.sensor_reader:
+            stats['samples'] = self.sensor_reader.sample_count
+            stats['timeouts'] = self.sensor_reader.timeouts
+        if self.command_writer:
+            stats['coalesced'] = self.command_writer.coalesced
+            stats['write_errors'] = self.command_writer.write_errors
+        stats['suppressed'] = self.shadow.suppressed
+        return stats
+
+
+class DeviceManager:
+    """
+    Opens and owns all of the micro:bits served by s2m.
+    The micro:bits are numbered from 0 in the order of their port names.
+    """
+
+    def __init__(self, metrics=None, recorder=None):
+        """
+        :param metrics: optional Metrics instance shared by all of the micro:bits
+        :param recorder: optional Recorder shared by all of the micro:bits
+        """
+        self.devices = []
+        self.metrics = metrics
+        self.recorder = recorder
+
+    def open(self, ports, count=1, wire_protocol='ascii', stream_interval=0, max_baud_rate=None,
+             user_ports=False):
+        """
+        Find micro:bits running s2mb.py and start their reader and writer threads.
+
+        :param ports: list of candidate serial port names
+        :param count: maximum number of micro:bits to open
+        :param wire_protocol: ascii or binary
+        :param stream_interval: sensor streaming interval in ms, 0 to poll
+        :param max_baud_rate: fastest baud rate to use, see negotiate_baud_rate
+        :param user_ports: True if the ports were given by the user. They are
+                           probed at the faster baud rates too, and only they
+                           are tried when reconnecting.
+        :return: the sensor line received during the first micro:bit's handshake
+        """
+        first_sensor_line = None
+        found = find_micro_bits(ports, count, known_ports=user_ports)
+        for micro_bit_serial, com_port, sensor_line, v_string in found:
+            device = MicroBitDevice(len(self.devices), micro_bit_serial, com_port, v_string,
+                                    self.metrics, self.get_busy_ports, self.recorder,
+                                    ports if user_ports else None)
+            if not self.devices:
+                first_sensor_line = sensor_line
+            print('{}{}{}{}\n'.format('micro:bit ', device.index, ' using COM Port:', com_port))
+            print('{}{}\n'.format('s2mb Version: ', v_string))
+            device.start(wire_protocol, stream_interval, max_baud_rate)
+            self.devices.append(device)
+        return first_sensor_line
+
+    def add(self, device):
+        """
+        Add a device that was opened some other way, e.g. a replayed micro:bit.
+
+        :param device: a started MicroBitDevice
+        """
+        self.devices.append(device)
+
+    def get_busy_ports(self):
+        """
+        :return: the ports of the micro:bits that are connected
+        """
+        return [device.com_port for device in self.devices if device.connected]
+
+    def stop(self):
+        """
+        Stop all of the micro:bits.
+        """
+        for device in self.devices:
+            device.stop()
+
+    def __getitem__(self, index):
+        return self.devices[index]
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __len__(self):
+        return len(self.devices)
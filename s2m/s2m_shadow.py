@@ -0,0 +1,122 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+
+def clamp(value, low, high):
+    """
+    Limit a value to a range, the same way s2mb.py does.
+    """
+    return max(low, min(value, high))
+
+
+class OutputShadow:
+    """
+    A model of a micro:bit's outputs, built from the commands sent to it:
+    the pin values and what is on the display.
+
+    Scratch projects often send the same command over and over from a
+    forever loop. A command that would not change anything on the
+    micro:bit does not need to be sent. Scroll commands are always sent,
+    as scrolling the same text again restarts it.
+
+    The model only knows what it has been told. After invalidate(),
+    every command is sent until the model has learned the state again.
+    """
+
+    def __init__(self):
+        # last analog or digital write for each pin, e.g. {0: ('t', 1)}
+        self.pins = {}
+
+        # the last command that replaced the whole display: 'c', 'd,HAPPY'
+        # or 'f,<frame>'. None if the display contents are unknown.
+        self.display = None
+
+        # pixels written since then that differ from the display, {(x, y): value}
+        self.pixels = {}
+
+        # number of commands that did not need to be sent
+        self.suppressed = 0
+
+    def invalidate(self):
+        """
+        Forget everything, e.g. after reconnecting to the micro:bit.
+        """
+        self.pins = {}
+        self.display = None
+        self.pixels = {}
+
+    def get_pixel(self, x, y):
+        """
+        :return: the brightness of a pixel, or None if it is not known
+        """
+        value = self.pixels.get((x, y))
+        if value is not None:
+            return value
+        if self.display == 'c':
+            return 0
+        if self.display and self.display[0] == 'f':
+            return int(self.display[2 + y * 5 + x])
+        return None
+
+    def apply(self, command):
+        """
+        Update the model with a command that is about to be sent.
+
+        :param command: s2mb.py command string
+        :return: True if the command has to be sent, False if it
+                 would not change anything on the micro:bit
+        """
+        fields = command.split(',')
+        cmd_id = fields[0]
+
+        if cmd_id in ('a', 't'):
+            try:
+                pin = int(fields[1])
+                value = (cmd_id, int(fields[2]))
+            except (IndexError, ValueError):
+                return True
+            if self.pins.get(pin) == value:
+                self.suppressed += 1
+                return False
+            self.pins[pin] = value
+
+        elif cmd_id == 'p':
+            try:
+                x = clamp(int(fields[1]), 0, 4)
+                y = clamp(int(fields[2]), 0, 4)
+                value = clamp(int(fields[3]), 0, 9)
+            except (IndexError, ValueError):
+                return True
+            if self.get_pixel(x, y) == value:
+                self.suppressed += 1
+                return False
+            self.pixels[(x, y)] = value
+
+        elif cmd_id in ('c', 'd', 'f'):
+            if command == self.display and not self.pixels:
+                self.suppressed += 1
+                return False
+            self.display = command
+            self.pixels = {}
+
+        elif cmd_id == 's':
+            # the display is blank after a scroll, but it is not known
+            # when it was interrupted by the next display command
+            self.display = None
+            self.pixels = {}
+
+        return True
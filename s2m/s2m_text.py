@@ -0,0 +1,159 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# The micro:bit font only has the printable ASCII characters, anything
+# else is scrolled as a '?'. transliterate replaces the other characters
+# with the closest ASCII text it can find:
+#
+#   - accented and full width letters lose their accents and width
+#   - Japanese kana are written in romaji
+#   - Korean hangul is written in the Revised Romanization
+#   - Hebrew letters are written with their Latin equivalents
+#   - typographic punctuation becomes its ASCII counterpart
+#
+# Characters are looked up once and then kept in a cache.
+
+import re
+import unicodedata
+
+try:
+    # for python 2
+    # noinspection PyUnresolvedReferences
+    unichr
+except NameError:
+    # for python 3
+    unichr = chr
+
+# characters that the micro:bit cannot display
+NOT_DISPLAYABLE = re.compile(u'[^ -~]')
+
+# romaji for the hiragana from U+3041 to U+3096. The katakana
+# from U+30A1 to U+30F6 are in the same order.
+KANA_ROMAJI = ['a', 'a', 'i', 'i', 'u', 'u', 'e', 'e', 'o', 'o',
+               'ka', 'ga', 'ki', 'gi', 'ku', 'gu', 'ke', 'ge', 'ko', 'go',
+               'sa', 'za', 'shi', 'ji', 'su', 'zu', 'se', 'ze', 'so', 'zo',
+               'ta', 'da', 'chi', 'ji', '', 'tsu', 'zu', 'te', 'de', 'to', 'do',
+               'na', 'ni', 'nu', 'ne', 'no',
+               'ha', 'ba', 'pa', 'hi', 'bi', 'pi', 'fu', 'bu', 'pu',
+               'he', 'be', 'pe', 'ho', 'bo', 'po',
+               'ma', 'mi', 'mu', 'me', 'mo',
+               'ya', 'ya', 'yu', 'yu', 'yo', 'yo',
+               'ra', 'ri', 'ru', 're', 'ro',
+               'wa', 'wa', 'wi', 'we', 'wo', 'n', 'vu', 'ka', 'ke']
+HIRAGANA_START = 0x3041
+KATAKANA_START = 0x30a1
+
+# hangul syllables from U+AC00 are made of an initial consonant,
+# a vowel and an optional final consonant
+HANGUL_START = 0xac00
+HANGUL_END = 0xd7a3
+HANGUL_INITIALS = ['g', 'kk', 'n', 'd', 'tt', 'r', 'm', 'b', 'pp', 's',
+                   'ss', '', 'j', 'jj', 'ch', 'k', 't', 'p', 'h']
+HANGUL_VOWELS = ['a', 'ae', 'ya', 'yae', 'eo', 'e', 'yeo', 'ye', 'o', 'wa', 'wae',
+                 'oe', 'yo', 'u', 'wo', 'we', 'wi', 'yu', 'eu', 'ui', 'i']
+HANGUL_FINALS = ['', 'k', 'k', 'k', 'n', 'n', 'n', 't', 'l', 'k', 'm', 'l', 'l', 'l',
+                 'p', 'l', 'm', 'p', 'p', 't', 't', 'ng', 't', 't', 'k', 't', 'p', 't']
+
+# the Hebrew letters from U+05D0 to U+05EA, including the final forms
+HEBREW_LETTERS = ['', 'b', 'g', 'd', 'h', 'v', 'z', 'ch', 't', 'y', 'kh', 'k', 'l', 'm',
+                  'm', 'n', 'n', 's', '', 'f', 'p', 'ts', 'ts', 'k', 'r', 'sh', 't']
+HEBREW_START = 0x05d0
+
+# characters that do not decompose to ASCII
+SPECIAL_CHARACTERS = {u'\u2018': "'", u'\u2019': "'", u'\u201a': "'", u'\u201b': "'",
+                      u'\u201c': '"', u'\u201d': '"', u'\u201e': '"', u'\u00ab': '"',
+                      u'\u00bb': '"', u'\u2013': '-', u'\u2014': '-', u'\u2212': '-',
+                      u'\u30fc': '-', u'\u3001': ',', u'\u3002': '.', u'\u00b7': '.',
+                      u'\u30fb': '.', u'\u00df': 'ss', u'\u00e6': 'ae', u'\u00c6': 'AE',
+                      u'\u0153': 'oe', u'\u0152': 'OE', u'\u00f8': 'o', u'\u00d8': 'O',
+                      u'\u0142': 'l', u'\u0141': 'L', u'\u0111': 'd', u'\u0110': 'D',
+                      u'\u0131': 'i', u'\u00d7': 'x', u'\u00f7': '/', u'\u20ac': 'EUR',
+                      u'\u00b0': 'o'}
+
+# replacement for characters that have no ASCII equivalent
+UNKNOWN = '?'
+
+
+def lookup(character):
+    """
+    Find the ASCII text for a character the micro:bit cannot display.
+
+    :param character: a single character
+    :return: replacement text, possibly empty
+    """
+    if character in SPECIAL_CHARACTERS:
+        return SPECIAL_CHARACTERS[character]
+
+    code = ord(character)
+    if HIRAGANA_START <= code < HIRAGANA_START + len(KANA_ROMAJI):
+        return KANA_ROMAJI[code - HIRAGANA_START]
+    if KATAKANA_START <= code < KATAKANA_START + len(KANA_ROMAJI):
+        return KANA_ROMAJI[code - KATAKANA_START]
+    if HANGUL_START <= code <= HANGUL_END:
+        syllable = code - HANGUL_START
+        return (HANGUL_INITIALS[syllable // 588] +
+                HANGUL_VOWELS[syllable % 588 // 28] +
+                HANGUL_FINALS[syllable % 28])
+    if HEBREW_START <= code < HEBREW_START + len(HEBREW_LETTERS):
+        return HEBREW_LETTERS[code - HEBREW_START]
+
+    # line breaks and tabs would end or garble the command line
+    if character.isspace():
+        return ' '
+    # invisible formatting characters, e.g. right to left marks
+    if unicodedata.category(character) in ('Cc', 'Cf', 'Mn'):
+        return ''
+
+    # remove accents and width, keeping whatever ASCII is left
+    decomposed = NOT_DISPLAYABLE.sub('', unicodedata.normalize('NFKD', character))
+    if decomposed:
+        return str(decomposed)
+    return UNKNOWN
+
+
+class CharacterCache(dict):
+    """
+    Maps character codes to their replacement text, for str.translate.
+    A character is looked up the first time it is seen, and the
+    printable ASCII characters are mapped to themselves.
+    """
+
+    def __missing__(self, code):
+        if 32 <= code <= 126:
+            text = u'' + chr(code)
+        else:
+            text = u'' + lookup(unichr(code))
+        self[code] = text
+        return text
+
+
+# replacements that have been looked up
+_cache = CharacterCache()
+
+
+def transliterate(text):
+    """
+    Make text displayable by the micro:bit.
+
+    :param text: unicode text
+    :return: the text with every character the micro:bit cannot
+             display replaced by ASCII text
+    """
+    # most scroll text is plain ASCII, leave it alone
+    if not NOT_DISPLAYABLE.search(text):
+        return text
+    return text.translate(_cache)
@@ -0,0 +1,380 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# A minimal RFC 6455 WebSocket endpoint, served at ws://localhost:50209/ws
+# by the threaded HTTP server.
+#
+# Sensor data is pushed to every connected client as text messages in the
+# same "reporter value" line format as a /poll response. A client is first
+# sent a full snapshot, and after that only the lines that have changed.
+#
+# Clients send commands as text messages, written the same way as the
+# HTTP request paths, e.g. "display_image/HAPPY" or "1/write_pixel/1/2/9".
+# A command whose handler returns data, e.g. "poll" or "metrics", is
+# answered with a text message. Other commands are not answered. A poll
+# is answered with the latest snapshot.
+#
+# The pushes have their own latch for shakes and free falls, see
+# GestureDetector, so they do not hide these events from Scratch's polls.
+
+import base64
+import hashlib
+import socket
+import struct
+import threading
+import time
+
+try:
+    # for python 3
+    from s2m.s2m_metrics import timer
+except ImportError:
+    # for python 2
+    # noinspection PyUnresolvedReferences
+    from s2m_metrics import timer
+
+# the consumer that the pushes report the gestures to
+WEBSOCKET_CONSUMER = 'websocket'
+
+# appended to the client's key to build the handshake reply
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# frame opcodes
+CONTINUATION = 0x0
+TEXT = 0x1
+BINARY = 0x2
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xa
+
+# close status codes
+PROTOCOL_ERROR = 1002
+MESSAGE_TOO_BIG = 1009
+
+# longest message accepted from a client
+MAX_MESSAGE_SIZE = 65536
+
+# seconds between sensor fetches when the micro:bit is polled,
+# about the rate at which Scratch polls
+POLL_INTERVAL = 1 / 30.0
+
+# shortest number of seconds between two pushes, however fast
+# the micro:bit streams
+MIN_PUSH_INTERVAL = .01
+
+# longest number of seconds to wait for a streamed sample before
+# fetching the sensor data anyway
+IDLE_INTERVAL = 1
+
+
+def accept_key(key):
+    """
+    :param key: the client's Sec-WebSocket-Key header
+    :return: the Sec-WebSocket-Accept header value
+    """
+    digest = hashlib.sha1((key.strip() + WEBSOCKET_GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+
+def encode_frame(payload, opcode=TEXT):
+    """
+    Build an unmasked frame, as sent by a server.
+
+    :param payload: message text or bytes
+    :param opcode: frame opcode
+    :return: the frame as bytes
+    """
+    if not isinstance(payload, bytes):
+        payload = payload.encode('utf-8')
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def read_exactly(rfile, size):
+    """
+    :return: size bytes, or None if the connection closed first
+    """
+    data = rfile.read(size)
+    if data is None or len(data) < size:
+        return None
+    return data
+
+
+def read_frame(rfile):
+    """
+    Read a frame sent by a client.
+
+    :param rfile: file object for the connection
+    :return: (fin, opcode, payload) tuple, None if the connection closed,
+             or a close status code if the frame broke the protocol
+    """
+    header = read_exactly(rfile, 2)
+    if header is None:
+        return None
+    first, second = bytearray(header)
+    fin = bool(first & 0x80)
+    opcode = first & 0x0f
+    length = second & 0x7f
+
+    # every frame sent by a client must be masked
+    if not second & 0x80:
+        return PROTOCOL_ERROR
+
+    if length == 126:
+        data = read_exactly(rfile, 2)
+        if data is None:
+            return None
+        length = struct.unpack('!H', data)[0]
+    elif length == 127:
+        data = read_exactly(rfile, 8)
+        if data is None:
+            return None
+        length = struct.unpack('!Q', data)[0]
+    if length > MAX_MESSAGE_SIZE:
+        return MESSAGE_TOO_BIG
+
+    mask = read_exactly(rfile, 4)
+    payload = read_exactly(rfile, length) if length else b''
+    if mask is None or payload is None:
+        return None
+    mask = bytearray(mask)
+    payload = bytearray(payload)
+    for i in range(length):
+        payload[i] ^= mask[i % 4]
+    return fin, opcode, bytes(payload)
+
+
+class WebSocketSession:
+    """
+    One WebSocket client. The HTTP handler thread that accepted the
+    connection reads the client's messages. Pushes are sent by the
+    SensorBroadcaster thread.
+    """
+
+    def __init__(self, handler):
+        """
+        :param handler: the GetHandler that accepted the connection
+        """
+        self.handler = handler
+        self.open = True
+
+        # frames are sent by the broadcaster and the handler thread
+        self.send_lock = threading.Lock()
+
+    def send(self, frame):
+        """
+        :param frame: an encoded frame
+        :return: False if the client has gone
+        """
+        with self.send_lock:
+            if not self.open:
+                return False
+            try:
+                self.handler.wfile.write(frame)
+                self.handler.wfile.flush()
+            except (socket.error, ValueError):
+                self.open = False
+        return self.open
+
+    def close(self, status=None):
+        """
+        Send a close frame and stop sending.
+
+        :param status: optional close status code
+        """
+        payload = struct.pack('!H', status) if status else b''
+        self.send(encode_frame(payload, CLOSE))
+        with self.send_lock:
+            self.open = False
+
+    def serve(self):
+        """
+        Read and handle the client's messages until it disconnects.
+        """
+        s2m = self.handler.s2m
+        message = b''
+        message_type = None
+        while self.open:
+            try:
+                frame = read_frame(self.handler.rfile)
+            except (socket.error, ValueError):
+                break
+            if frame is None:
+                break
+            if isinstance(frame, int):
+                self.close(frame)
+                break
+            fin, opcode, payload = frame
+
+            if opcode == PING:
+                self.send(encode_frame(payload, PONG))
+                continue
+            if opcode == CLOSE:
+                self.close()
+                break
+            if opcode == PONG:
+                continue
+
+            # a message may be split over several frames
+            if opcode != CONTINUATION:
+                message = b''
+                message_type = opcode
+            message += payload
+            if len(message) > MAX_MESSAGE_SIZE:
+                self.close(MESSAGE_TOO_BIG)
+                break
+            if not fin or message_type != TEXT:
+                continue
+
+            s2m.metrics.count('requests')
+            cmd_list, device = self.handler.parse_command(message.decode('utf-8', 'replace'))
+            if cmd_list[0] == 'poll':
+                s2m.metrics.count('polls')
+                response = s2m.broadcaster.snapshot or s2m.handle_poll(WEBSOCKET_CONSUMER)
+            else:
+                response = self.handler.dispatch(cmd_list, device)
+            if response is not None:
+                self.send(encode_frame(response))
+
+
+class SensorBroadcaster(threading.Thread):
+    """
+    Pushes the sensor data to every WebSocket client. The data is fetched
+    once for all of the clients, with S2M.handle_poll, so a fetch in progress
+    is shared with any HTTP polls, and each push is only encoded once.
+
+    When the first micro:bit is streaming, a fetch is done for each new
+    sample, otherwise every POLL_INTERVAL seconds. Only the reporters whose
+    values have changed are pushed.
+    """
+
+    def __init__(self, s2m):
+        """
+        :param s2m: the S2M instance
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.s2m = s2m
+
+        # clients that have not been sent a snapshot yet, and the others
+        self.new_sessions = []
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.sessions_changed = threading.Condition(self.lock)
+
+        # the line last pushed for each reporter, and the last full response
+        self.values = {}
+        self.snapshot = None
+
+        # sample count of the first micro:bit at the last fetch
+        self.sample_count = 0
+        self.last_push = 0
+
+    def add(self, session):
+        """
+        Start pushing to a client.
+        """
+        with self.sessions_changed:
+            self.new_sessions.append(session)
+            self.sessions_changed.notify()
+
+    def remove(self, session):
+        """
+        Stop pushing to a client.
+        """
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+            if session in self.new_sessions:
+                self.new_sessions.remove(session)
+            if not self.sessions and not self.new_sessions:
+                # nothing is pushed until another client connects, by which
+                # time the last data pushed could be minutes old
+                self.snapshot = None
+                self.values = {}
+
+    def run(self):
+        while True:
+            with self.sessions_changed:
+                while not self.sessions and not self.new_sessions:
+                    self.sessions_changed.wait()
+            self.wait_for_update()
+            response = self.s2m.handle_poll(WEBSOCKET_CONSUMER)
+            if response is not None:
+                self.push(response)
+
+    def wait_for_update(self):
+        """
+        Wait until there may be new sensor data to push.
+        """
+        # however the data arrives, do not push more often than this
+        delay = self.last_push + MIN_PUSH_INTERVAL - timer()
+        if delay > 0:
+            time.sleep(delay)
+
+        device = self.s2m.devices[0]
+        reader = device.sensor_reader
+        if device.streaming and device.connected and reader:
+            reader.wait_for_sample(self.sample_count, IDLE_INTERVAL, is_reply=False)
+            self.sample_count = reader.get_sample_count()
+        else:
+            time.sleep(POLL_INTERVAL)
+        self.last_push = timer()
+
+    def push(self, response):
+        """
+        Send a full snapshot to the new clients and the changes to the others.
+
+        :param response: poll response
+        """
+        snapshot = response
+        if isinstance(response, bytes):
+            response = response.decode('utf-8')
+        changed = []
+        for line in response.splitlines():
+            if not line:
+                continue
+            name = line.split(' ', 1)[0]
+            if self.values.get(name) != line:
+                self.values[name] = line
+                changed.append(line)
+
+        with self.lock:
+            new_sessions = self.new_sessions
+            self.new_sessions = []
+            self.sessions.extend(new_sessions)
+            sessions = list(self.sessions)
+            # unless every client left during the fetch
+            if sessions:
+                self.snapshot = snapshot
+
+        gone = []
+        if new_sessions:
+            frame = encode_frame(response)
+            gone += [session for session in new_sessions if not session.send(frame)]
+        if changed:
+            frame = encode_frame('\n'.join(changed) + '\n')
+            gone += [session for session in sessions
+                     if session not in new_sessions and not session.send(frame)]
+            self.s2m.metrics.count('pushes')
+        for session in gone:
+            self.remove(session)
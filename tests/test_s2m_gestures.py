@@ -0,0 +1,58 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from s2m.s2m_gestures import GestureDetector
+
+
+class TestGestureLatches(unittest.TestCase):
+
+    def shake(self, detector):
+        for x in (0, 2000, -2000, 2000, 0):
+            detector.add_sample([str(x), '0', '-1000'])
+
+    def test_shake_is_reported_once(self):
+        detector = GestureDetector()
+        self.shake(detector)
+        self.assertTrue(detector.poll()[0])
+        self.assertFalse(detector.poll()[0])
+
+    def test_each_consumer_sees_the_shake(self):
+        detector = GestureDetector()
+        self.shake(detector)
+        self.assertTrue(detector.poll('websocket')[0])
+        self.assertFalse(detector.poll('websocket')[0])
+        self.assertTrue(detector.poll()[0])
+
+    def test_freefall_is_reported_while_falling(self):
+        detector = GestureDetector()
+        for _ in range(4):
+            detector.add_sample(['0', '0', '0'])
+        self.assertTrue(detector.poll()[3])
+        detector.add_sample(['0', '0', '0'])
+        self.assertTrue(detector.poll()[3])
+        detector.add_sample(['0', '0', '-1000'])
+        self.assertFalse(detector.poll()[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
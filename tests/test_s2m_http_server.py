@@ -0,0 +1,93 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# Usage: python -m unittest discover tests
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from s2m.s2m_http_server import GetHandler
+from s2m.s2m_metrics import Metrics
+
+
+class NullS2M:
+    """
+    Stands in for the S2M class. Every command handler returns None,
+    except handle_metrics.
+    """
+
+    metrics = Metrics()
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+    def handle_metrics(self, device=0):
+        return '{"requests": 1}'
+
+
+class TestParseCommand(unittest.TestCase):
+
+    def test_command_for_first_micro_bit(self):
+        self.assertEqual(GetHandler.parse_command('/display_image/HAPPY'),
+                         (['display_image', 'HAPPY'], 0))
+
+    def test_micro_bit_number(self):
+        self.assertEqual(GetHandler.parse_command('/1/write_pixel/1/2/9'),
+                         (['write_pixel', '1', '2', '9'], 1))
+
+    def test_micro_bit_number_without_command(self):
+        self.assertEqual(GetHandler.parse_command('/2'), ([''], 2))
+
+    def test_non_ascii_digits_are_a_command(self):
+        self.assertEqual(GetHandler.parse_command(u'/\u00b2/poll'), ([u'\u00b2', 'poll'], 0))
+        self.assertEqual(GetHandler.parse_command(u'/\u0661/poll'), ([u'\u0661', 'poll'], 0))
+
+
+class TestResponses(unittest.TestCase):
+    """
+    The handler is not attached to a socket, responses are written
+    to an in memory buffer.
+    """
+
+    def setUp(self):
+        GetHandler.set_items(NullS2M())
+        self.handler = GetHandler.__new__(GetHandler)
+        self.handler.wfile = io.BytesIO()
+        self.handler.close_connection = False
+
+    def response(self, path):
+        cmd_list, device = GetHandler.parse_command(path)
+        self.handler.process_command(cmd_list, device)
+        return self.handler.wfile.getvalue()
+
+    def test_metrics_are_sent_as_json(self):
+        response = self.response('/metrics')
+        self.assertIn(b'Content-Type: application/json; charset=utf-8\r\n', response)
+        self.assertTrue(response.endswith(b'{"requests": 1}\r\n'))
+
+    def test_commands_are_sent_as_html(self):
+        response = self.response('/display_image/HAPPY')
+        self.assertIn(b'Content-Type: text/html; charset=utf-8\r\n', response)
+        self.assertTrue(response.endswith(b'ok\r\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
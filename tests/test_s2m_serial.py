@@ -0,0 +1,171 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# Usage: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import s2m.s2m_serial
+from s2m.s2m_serial import BAUD_RATES, MAX_WRITE_LENGTH, SYNC_BYTE, CommandWriter, \
+    MicroBitDevice, find_micro_bits, get_coalesce_key
+
+
+class TestCommandCoalescing(unittest.TestCase):
+    """
+    The command writer is not started, so commands stay pending
+    and the coalescing can be checked without a micro:bit.
+    """
+
+    def setUp(self):
+        self.writer = CommandWriter(None, batching=True)
+
+    def pending(self):
+        return list(self.writer.pending.values())
+
+    def test_pin_writes_supersede_each_other(self):
+        self.writer.send('t,0,1')
+        self.writer.send('a,0,512')
+        self.writer.send('t,1,1')
+        self.assertEqual(self.pending(), ['a,0,512', 't,1,1'])
+
+    def test_pixel_writes_supersede_each_other(self):
+        self.writer.send('p,1,2,9')
+        self.writer.send('p,1,2,0')
+        self.assertEqual(self.pending(), ['p,1,2,0'])
+
+    def test_display_drops_pending_pixels(self):
+        self.writer.send('p,1,2,9')
+        self.writer.send('p,3,4,9')
+        self.writer.send('d,HAPPY')
+        self.assertEqual(self.pending(), ['d,HAPPY'])
+        self.assertEqual(self.writer.coalesced, 2)
+
+    def test_display_keeps_pending_pin_writes(self):
+        for pin in range(3):
+            self.writer.send('t,' + str(pin) + ',1')
+        self.writer.send('a,1,512')
+        self.writer.send('p,0,0,9')
+        self.writer.send('d,HAPPY')
+        self.assertEqual(self.pending(), ['t,0,1', 't,2,1', 'a,1,512', 'd,HAPPY'])
+
+    def test_pin_and_pixel_keys_differ(self):
+        self.assertNotEqual(get_coalesce_key('t,0,1'), get_coalesce_key('p,0,1,9'))
+        self.assertIsNone(get_coalesce_key('g'))
+
+
+class TestCommandWrites(unittest.TestCase):
+    """
+    A burst of 25 pixel writes, as sent for a display frame
+    to an s2mb.py version without the 'f' command.
+    """
+
+    def setUp(self):
+        self.commands = ['p,' + str(i % 5) + ',' + str(i // 5) + ',9' for i in range(25)]
+
+    def check_writes(self, writer):
+        writes = writer.build_writes(self.commands)
+        self.assertTrue(all(len(data) <= MAX_WRITE_LENGTH for data in writes))
+        return writes
+
+    def test_batched_ascii_writes(self):
+        writes = self.check_writes(CommandWriter(None, batching=True))
+        self.assertEqual(b''.join(writes).decode().replace('\n', ';').rstrip(';').split(';'),
+                         self.commands)
+
+    def test_batched_binary_writes(self):
+        writes = self.check_writes(CommandWriter(None, batching=True, binary=True))
+        payloads = []
+        for data in writes:
+            data = bytearray(data)
+            # each write holds whole frames
+            while data:
+                self.assertEqual(data[0], SYNC_BYTE)
+                payloads.append(bytes(data[2:data[1] + 2]).decode())
+                data = data[data[1] + 2:]
+        self.assertEqual(';'.join(payloads).split(';'), self.commands)
+
+    def test_one_line_per_write_without_batching(self):
+        writes = self.check_writes(CommandWriter(None))
+        self.assertEqual(writes, [(command + '\n').encode() for command in self.commands])
+
+    def test_scroll_gets_a_write_of_its_own(self):
+        text = 's,' + 'x' * 100
+        writes = CommandWriter(None, batching=True).build_writes(['c', text, 'c'])
+        self.assertEqual(writes, [b'c\n', (text + '\n').encode(), b'c\n'])
+
+
+class TestReconnectPorts(unittest.TestCase):
+    """
+    The ports whose USB ids match a micro:bit are faked, so the
+    choice of ports can be checked without any serial ports.
+    """
+
+    def setUp(self):
+        self.list_micro_bit_ports = s2m.s2m_serial.list_micro_bit_ports
+        s2m.s2m_serial.list_micro_bit_ports = lambda: ['COM5', 'COM3', 'COM4']
+
+    def tearDown(self):
+        s2m.s2m_serial.list_micro_bit_ports = self.list_micro_bit_ports
+
+    def test_only_micro_bit_ports_are_tried(self):
+        device = MicroBitDevice(0, None, 'COM3', 's2mb.py Version 1.18',
+                                busy_ports=lambda: ['COM4'])
+        self.assertEqual(device.get_reconnect_ports(), ['COM3', 'COM5'])
+
+    def test_only_user_ports_are_tried(self):
+        device = MicroBitDevice(0, None, 'COM7', 's2mb.py Version 1.18',
+                                busy_ports=lambda: ['COM8'], ports=['COM7', 'COM8', 'COM9'])
+        self.assertEqual(device.get_reconnect_ports(), ['COM7', 'COM9'])
+
+
+class TestProbeRates(unittest.TestCase):
+    """
+    probe_port is replaced to record the baud rates each port would be
+    probed at, so no serial ports are opened.
+    """
+
+    def setUp(self):
+        self.probe_port = s2m.s2m_serial.probe_port
+        self.list_micro_bit_ports = s2m.s2m_serial.list_micro_bit_ports
+        self.rates = {}
+
+        def probe_port(port, found=None, timeout=None, baud_rates=()):
+            self.rates[port] = baud_rates
+            return None
+
+        s2m.s2m_serial.probe_port = probe_port
+        s2m.s2m_serial.list_micro_bit_ports = lambda: ['COM3']
+
+    def tearDown(self):
+        s2m.s2m_serial.probe_port = self.probe_port
+        s2m.s2m_serial.list_micro_bit_ports = self.list_micro_bit_ports
+
+    def test_only_micro_bit_ports_get_faster_rates(self):
+        find_micro_bits(['COM1', 'COM3'])
+        self.assertEqual(self.rates, {'COM1': (), 'COM3': BAUD_RATES})
+
+    def test_known_ports_get_faster_rates(self):
+        find_micro_bits(['COM1', 'COM3'], known_ports=True)
+        self.assertEqual(self.rates, {'COM1': BAUD_RATES, 'COM3': BAUD_RATES})
+
+
+if __name__ == '__main__':
+    unittest.main()
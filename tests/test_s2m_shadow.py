@@ -0,0 +1,59 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# Usage: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from s2m.s2m_shadow import OutputShadow
+
+
+class TestOutputShadow(unittest.TestCase):
+
+    def setUp(self):
+        self.shadow = OutputShadow()
+
+    def test_repeated_pin_write_is_suppressed(self):
+        self.assertTrue(self.shadow.apply('t,0,1'))
+        self.assertFalse(self.shadow.apply('t,0,1'))
+        self.assertTrue(self.shadow.apply('t,0,0'))
+        self.assertEqual(self.shadow.suppressed, 1)
+
+    def test_repeated_image_is_suppressed(self):
+        self.assertTrue(self.shadow.apply('d,HAPPY'))
+        self.assertFalse(self.shadow.apply('d,HAPPY'))
+        self.assertTrue(self.shadow.apply('p,0,0,0'))
+        self.assertTrue(self.shadow.apply('d,HAPPY'))
+
+    def test_repeated_scroll_is_sent(self):
+        # scrolling the same text again restarts it
+        self.assertTrue(self.shadow.apply('s,Hello'))
+        self.assertTrue(self.shadow.apply('s,Hello'))
+        self.assertEqual(self.shadow.suppressed, 0)
+
+    def test_image_is_sent_after_a_scroll(self):
+        self.assertTrue(self.shadow.apply('d,HAPPY'))
+        self.assertTrue(self.shadow.apply('s,Hello'))
+        self.assertTrue(self.shadow.apply('d,HAPPY'))
+
+
+if __name__ == '__main__':
+    unittest.main()
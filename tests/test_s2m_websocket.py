@@ -0,0 +1,80 @@
+"""
+ Copyright (c) 2017-2018 Alan Yorinks All rights reserved.
+
+ This program is free software; you can redistribute it and/or
+ modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+ Version 3 as published by the Free Software Foundation; either
+ or (at your option) any later version.
+ This library is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+ General Public License for more details.
+
+ You should have received a copy of the GNU AFFERO GENERAL PUBLIC LICENSE
+ along with this library; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+# Usage: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from s2m.s2m_metrics import Metrics
+from s2m.s2m_websocket import SensorBroadcaster
+
+
+class NullS2M:
+    metrics = Metrics()
+
+
+class RecordingSession:
+    """
+    Stands in for a WebSocketSession, keeping the frames sent to it.
+    """
+
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame):
+        self.frames.append(frame)
+        return True
+
+
+class TestSensorBroadcaster(unittest.TestCase):
+    """
+    The broadcaster thread is not started, pushes are made directly.
+    """
+
+    def setUp(self):
+        self.broadcaster = SensorBroadcaster(NullS2M())
+
+    def test_snapshot_is_kept_while_clients_are_connected(self):
+        session = RecordingSession()
+        self.broadcaster.add(session)
+        self.broadcaster.push('shaken false\n')
+        self.assertEqual(self.broadcaster.snapshot, 'shaken false\n')
+        self.assertEqual(len(session.frames), 1)
+
+    def test_snapshot_is_dropped_when_the_last_client_leaves(self):
+        first = RecordingSession()
+        second = RecordingSession()
+        self.broadcaster.add(first)
+        self.broadcaster.add(second)
+        self.broadcaster.push('shaken false\n')
+        self.broadcaster.remove(first)
+        self.assertIsNotNone(self.broadcaster.snapshot)
+        self.broadcaster.remove(second)
+        self.assertIsNone(self.broadcaster.snapshot)
+        self.assertEqual(self.broadcaster.values, {})
+
+    def test_no_snapshot_without_clients(self):
+        self.broadcaster.push('shaken false\n')
+        self.assertIsNone(self.broadcaster.snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()